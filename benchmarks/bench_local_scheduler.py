@@ -0,0 +1,123 @@
+"""Benchmark of plan_schedule: a minimum over all steps per block and SoC (as before) versus window minima.
+
+Run from the root of the repository:
+    python benchmarks/bench_local_scheduler.py
+"""
+from datetime import timedelta
+import os
+import random
+import sys
+import timeit
+from typing import List, Optional
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import local_scheduler as ls  # noqa: E402
+from soc_constraints import Segment  # noqa: E402
+
+RESOLUTION = timedelta(minutes=5)
+HORIZON_HOURS = 27
+BASELINE_NUMBER_OF_STATES = 250
+NUMBER = 5
+
+
+def baseline(blocks: List[ls.SignalBlock], current_soc_kwh: float, soc_minima: List[Segment],
+             soc_maxima: List[Segment], min_soc_kwh: float, capacity_kwh: float, max_charge_power_w: int,
+             max_discharge_power_w: int, roundtrip_efficiency: float, resolution: timedelta,
+             grid_step_kwh: Optional[float] = None) -> Optional[List[float]]:
+    """plan_schedule as before: per block and per SoC a minimum over all steps, with 250 SoC values."""
+    if len(blocks) == 0:
+        return None
+
+    if grid_step_kwh is None:
+        grid_step_kwh = max(0.1, capacity_kwh / BASELINE_NUMBER_OF_STATES)
+    e = roundtrip_efficiency ** 0.5
+    slot_hours = resolution / timedelta(hours=1)
+    number_of_states = int(capacity_kwh / grid_step_kwh) + 1
+    boundaries = [blocks[0][0]] + [end_slot for _, end_slot, _ in blocks]
+    lower, upper = ls.state_bounds(boundaries, soc_minima, soc_maxima, min_soc_kwh, capacity_kwh)
+
+    def penalties(t: int) -> List[float]:
+        return [
+            ls.CONSTRAINT_PENALTY * (max(0.0, lower[t] - j * grid_step_kwh) + max(0.0, j * grid_step_kwh - upper[t]))
+            for j in range(number_of_states)
+        ]
+
+    # The energy left at the end has value, otherwise the schedule would always end with an empty battery.
+    average_value = sum(value * (end - start) for start, end, value in blocks) / (boundaries[-1] - boundaries[0])
+    terminal_penalties = penalties(len(blocks))
+    values_to_go = [
+        terminal_penalties[j] - average_value * j * grid_step_kwh * e / 1000 for j in range(number_of_states)
+    ]
+
+    # Backward pass, per block the best step (change of SoC in grid steps) for every SoC.
+    best_steps = []
+    for t in range(len(blocks) - 1, -1, -1):
+        start_slot, end_slot, value = blocks[t]
+        hours = (end_slot - start_slot) * slot_hours
+        max_up = int(max_charge_power_w / 1000 * hours * e / grid_step_kwh)
+        max_down = int(max_discharge_power_w / 1000 * hours / e / grid_step_kwh)
+        # Costs of each step, from max_down steps down to max_up steps up
+        step_costs = [
+            value * ls.grid_energy_kwh(k * grid_step_kwh, e) / 1000 + ls.CYCLING_PENALTY * abs(k)
+            for k in range(-max_down, max_up + 1)
+        ]
+        block_penalties = penalties(t) if t > 0 else [0.0] * number_of_states
+        new_values_to_go = []
+        steps = []
+        for j in range(number_of_states):
+            lowest = max(-max_down, -j)
+            highest = min(max_up, number_of_states - 1 - j)
+            options = [
+                cost + value_to_go for cost, value_to_go in zip(
+                    step_costs[lowest + max_down:highest + max_down + 1],
+                    values_to_go[j + lowest:j + highest + 1]
+                )
+            ]
+            best = min(range(len(options)), key=options.__getitem__)
+            new_values_to_go.append(block_penalties[j] + options[best])
+            steps.append(lowest + best)
+        values_to_go = new_values_to_go
+        best_steps.append(steps)
+    best_steps.reverse()
+
+    # Forward pass, follow the best steps from the current SoC.
+    j = min(max(int(round(current_soc_kwh / grid_step_kwh)), 0), number_of_states - 1)
+    power_per_slot = []
+    for (start_slot, end_slot, _), steps in zip(blocks, best_steps):
+        k = steps[j]
+        j += k
+        hours = (end_slot - start_slot) * slot_hours
+        power_mw = round(ls.grid_energy_kwh(k * grid_step_kwh, e) / hours / 1000, 6)
+        power_per_slot.extend([power_mw] * (end_slot - start_slot))
+    return power_per_slot
+
+
+
+def case(capacity_kwh: float, signal_minutes: int):
+    """Blocks of random prices (some negative) for the horizon and the other arguments of plan_schedule."""
+    rng = random.Random(1)
+    signal = {i * signal_minutes * 60 * 1000: rng.uniform(-20, 300)
+              for i in range(HORIZON_HOURS * 60 // signal_minutes)}
+    end_slot = HORIZON_HOURS * 60 // 5
+    blocks = ls.signal_blocks(signal, 0, end_slot, RESOLUTION)
+    return (blocks, capacity_kwh * 0.5, [(200, 200, capacity_kwh * 0.8)], [], capacity_kwh * 0.2, capacity_kwh,
+            11000, 11000, 0.85, RESOLUTION)
+
+
+def main():
+    print(f"{'case':36} {'before (ms)':>12} {'after (ms)':>12} {'speedup':>8} {'same grid, same plan':>21}")
+    for capacity_kwh in (24, 60, 100):
+        for signal_minutes in (60, 15):
+            args = case(capacity_kwh, signal_minutes)
+            before = timeit.timeit(lambda: baseline(*args), number=NUMBER) / NUMBER * 1000
+            after = timeit.timeit(lambda: ls.plan_schedule(*args), number=NUMBER) / NUMBER * 1000
+            # With the grid of the baseline both give the same plan
+            grid_step_kwh = max(0.1, capacity_kwh / BASELINE_NUMBER_OF_STATES)
+            same = baseline(*args) == ls.plan_schedule(*args, grid_step_kwh=grid_step_kwh)
+            name = f"{capacity_kwh} kWh, {signal_minutes} min signal ({HORIZON_HOURS} h)"
+            print(f"{name:36} {before:12.1f} {after:12.1f} {before / after:7.0f}x {str(same):>21}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,86 @@
+"""Benchmark of the soc-maxima for trigger_schedule: per-slot datetime lists (as before) versus slot segments.
+
+Run from the root of the repository:
+    python benchmarks/bench_soc_constraints.py
+"""
+from datetime import datetime, timedelta, timezone
+import math
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+import soc_constraints as sc  # noqa: E402
+
+RESOLUTION = timedelta(minutes=5)
+MAX_SOC_KWH = 48.0
+MAX_POWER_W = 11000
+RAMP_STEP_SLOTS = 6
+NUMBER = 50
+
+
+def time_round(time, delta):
+    """As v2g_globals.time_round, which cannot be imported without AppDaemon."""
+    mod = (time - datetime(1970, 1, 1, tzinfo=time.tzinfo)) % delta
+    if mod < (delta / 2):
+        return time - mod
+    return time + (delta - mod)
+
+
+def baseline(now, current_soc_kwh, back_to_max_soc, start_relaxation_window):
+    """The soc_maxima as trigger_schedule built them before: a dict with isoformat datetime per slot."""
+    resolution = RESOLUTION
+    rounded_now = time_round(now, resolution)
+    if back_to_max_soc is None:
+        return [{"value": MAX_SOC_KWH, "datetime": dt.isoformat()}
+                for dt in [rounded_now + x * resolution
+                           for x in range(0, (start_relaxation_window - rounded_now) // resolution)]]
+    minimum_discharge_window = math.ceil((current_soc_kwh - MAX_SOC_KWH) / (MAX_POWER_W / 1000) * 60)
+    end_minimum_discharge_window = time_round(rounded_now - timedelta(minutes=minimum_discharge_window), resolution)
+    if end_minimum_discharge_window > back_to_max_soc:
+        back_to_max_soc = end_minimum_discharge_window
+    maxima = []
+    number_of_steps = (back_to_max_soc - rounded_now) // resolution
+    if number_of_steps > 0:
+        step_kwh = (current_soc_kwh - MAX_SOC_KWH) / number_of_steps
+        maxima += [{"value": current_soc_kwh - (i * step_kwh), "datetime": (rounded_now + i * resolution).isoformat()}
+                   for i in range(number_of_steps)]
+    maxima += [{"value": MAX_SOC_KWH, "datetime": dt.isoformat()}
+               for dt in [back_to_max_soc + x * resolution
+                          for x in range(0, (start_relaxation_window - back_to_max_soc) // resolution)]]
+    return maxima
+
+
+def slot_segments(now, current_soc_kwh, back_to_max_soc, start_relaxation_window):
+    """The soc_maxima as trigger_schedule builds them now: segments on slots, formatted in one pass."""
+    _, segments = sc.build_soc_maxima(
+        now_slot=sc.to_slot(now, RESOLUTION),
+        srw_slot=sc.to_slot(start_relaxation_window, RESOLUTION),
+        current_soc_kwh=current_soc_kwh,
+        max_soc_kwh=MAX_SOC_KWH,
+        b2ms_slot=None if back_to_max_soc is None else sc.to_slot(back_to_max_soc, RESOLUTION),
+        max_discharge_power_w=MAX_POWER_W,
+        resolution=RESOLUTION,
+        ramp_step_slots=RAMP_STEP_SLOTS,
+    )
+    return sc.format_segments(segments, RESOLUTION, timezone.utc)
+
+
+def main():
+    now = datetime(2026, 10, 19, 12, 2, 40, tzinfo=timezone.utc)
+    cases = {
+        "scenario 0, no calendar item (7 days)": (40.0, None, now + timedelta(days=7)),
+        "scenario 1, B2MS in 3 hours (7 days)": (55.0, time_round(now + timedelta(hours=3), RESOLUTION),
+                                                 time_round(now + timedelta(days=7), RESOLUTION)),
+    }
+    print(f"{'case':40} {'before (ms)':>12} {'after (ms)':>12} {'items':>12} {'speedup':>8}")
+    for name, args in cases.items():
+        before = timeit.timeit(lambda: baseline(now, *args), number=NUMBER) / NUMBER * 1000
+        after = timeit.timeit(lambda: slot_segments(now, *args), number=NUMBER) / NUMBER * 1000
+        items = f"{len(baseline(now, *args))} -> {len(slot_segments(now, *args))}"
+        print(f"{name:40} {before:12.3f} {after:12.3f} {items:>12} {before / after:7.0f}x")
+
+
+if __name__ == "__main__":
+    main()
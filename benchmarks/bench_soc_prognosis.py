@@ -0,0 +1,79 @@
+"""Benchmark of the SoC prognosis for the graph: a record per slot (as before) versus the simplified prognosis.
+
+Run from the root of the repository:
+    python benchmarks/bench_soc_prognosis.py
+"""
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from soc_prognosis import expected_soc_values, prognosis_records  # noqa: E402
+
+RESOLUTION = timedelta(minutes=5)
+MAX_SOC_KWH = 62.0
+ROUNDTRIP_EFFICIENCY = 0.85
+NUMBER = 50
+
+
+def convert_MW_to_percentage_points(values_in_MW, resolution: timedelta, max_soc_in_kWh: float,
+                                    round_trip_efficiency: float):
+    """As v2g_liberty converted the schedule before soc_prognosis."""
+    e = round_trip_efficiency ** 0.5
+    scalar = resolution / timedelta(hours=1) * 1000 * 100 / max_soc_in_kWh
+    lst = []
+    for v in values_in_MW:
+        if v >= 0:
+            lst.append(v * scalar * e)
+        else:
+            lst.append(v * scalar / e)
+    return lst
+
+
+def baseline(start, values, soc):
+    """The records for input_text.soc_prognosis as schedule_charge_point made them before."""
+    exp_soc_values = list(accumulate([soc] + convert_MW_to_percentage_points(values, RESOLUTION, MAX_SOC_KWH,
+                                                                             ROUNDTRIP_EFFICIENCY)))
+    exp_soc_datetimes = [start + i * RESOLUTION for i in range(len(exp_soc_values))]
+    return [dict(time=t.isoformat(), soc=round(v, 2)) for v, t in zip(exp_soc_values, exp_soc_datetimes)]
+
+
+def simplified(start, values, soc):
+    """The records for input_text.soc_prognosis as schedule_charge_point makes them now."""
+    return prognosis_records(start, RESOLUTION, expected_soc_values(values, RESOLUTION, soc, MAX_SOC_KWH,
+                                                                    ROUNDTRIP_EFFICIENCY))
+
+
+def schedule(number_of_slots: int, run_length: int):
+    """A schedule with runs of equal power, as the scheduler of FM returns them."""
+    rng = random.Random(1)
+    values = []
+    while len(values) < number_of_slots:
+        values += [rng.choice([-0.011, -0.005, 0.0, 0.0, 0.005, 0.011])] * run_length
+    return values[:number_of_slots]
+
+
+def main():
+    start = datetime(2026, 10, 19, 12, 5, tzinfo=timezone.utc)
+    cases = {
+        "1 day, runs of 1 hour": schedule(288, 12),
+        "7 days, runs of 1 hour": schedule(7 * 288, 12),
+        "7 days, runs of 10 minutes": schedule(7 * 288, 2),
+    }
+    print(f"{'case':28} {'before (ms)':>12} {'after (ms)':>12} {'records':>14} {'size (kB)':>14}")
+    for name, values in cases.items():
+        before = timeit.timeit(lambda: baseline(start, values, 40.0), number=NUMBER) / NUMBER * 1000
+        after = timeit.timeit(lambda: simplified(start, values, 40.0), number=NUMBER) / NUMBER * 1000
+        before_records = baseline(start, values, 40.0)
+        after_records = simplified(start, values, 40.0)
+        records = f"{len(before_records)} -> {len(after_records)}"
+        size = f"{len(str(before_records)) // 1000} -> {len(str(after_records)) // 1000}"
+        print(f"{name:28} {before:12.3f} {after:12.3f} {records:>14} {size:>14}")
+
+
+if __name__ == "__main__":
+    main()
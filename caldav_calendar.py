@@ -0,0 +1,237 @@
+from datetime import date, datetime, timezone, tzinfo
+from typing import List, Optional
+import xml.etree.ElementTree as ET
+
+import pytz
+import requests
+
+# XML namespaces used in CalDAV requests and responses
+DAV = "DAV:"
+CALDAV = "urn:ietf:params:xml:ns:caldav"
+CALENDARSERVER = "http://calendarserver.org/ns/"
+
+PROPFIND_CTAG = f"""<?xml version="1.0" encoding="utf-8"?>
+<d:propfind xmlns:d="{DAV}" xmlns:cs="{CALENDARSERVER}">
+  <d:prop><cs:getctag/></d:prop>
+</d:propfind>"""
+
+REPORT_ETAGS = """<?xml version="1.0" encoding="utf-8"?>
+<c:calendar-query xmlns:d="{dav}" xmlns:c="{caldav}">
+  <d:prop><d:getetag/></d:prop>
+  <c:filter>
+    <c:comp-filter name="VCALENDAR">
+      <c:comp-filter name="VEVENT">
+        <c:time-range start="{start}" end="{end}"/>
+      </c:comp-filter>
+    </c:comp-filter>
+  </c:filter>
+</c:calendar-query>"""
+
+REPORT_MULTIGET = """<?xml version="1.0" encoding="utf-8"?>
+<c:calendar-multiget xmlns:d="{dav}" xmlns:c="{caldav}">
+  <d:prop>
+    <d:getetag/>
+    <c:calendar-data><c:expand start="{start}" end="{end}"/></c:calendar-data>
+  </d:prop>
+  {hrefs}
+</c:calendar-multiget>"""
+
+
+class CalDAVCalendar:
+    """Reads the items (events) of a CalDAV calendar collection, fetching only what has changed.
+
+    + The collection ctag changes on every change in the calendar, if it is unchanged nothing is requested.
+    + Otherwise, the etags of all items in the window are listed and only new or changed items are fetched.
+
+    Recurring items are expanded by the server for the requested window. As the window moves over time, a
+    forced sync (that ignores the ctag) refetches recurring items, so new occurrences are picked up.
+    """
+
+    url: str
+    session: requests.Session
+    tz: tzinfo
+    timeout: int
+
+    _ctag: Optional[str]
+    # Per item (href): its etag, whether it is recurring and the list of its events in the window
+    _items: dict
+
+    def __init__(self, url: str, username: str, password: str, tz: tzinfo, timeout: int = 30):
+        self.url = url
+        self.session = requests.Session()
+        self.session.auth = (username, password)
+        self.tz = tz
+        self.timeout = timeout
+        self._ctag = None
+        self._items = {}
+
+    def events(self) -> List[dict]:
+        """All cached events, as dicts with uid, start, end (isoformat), summary and description."""
+        return [event for item in self._items.values() for event in item["events"]]
+
+    def sync(self, start: datetime, end: datetime, force: bool = False) -> bool:
+        """Bring the local cache of events between start and end in line with the server.
+
+        Parameters:
+            start, end (datetime): the window of events to keep
+            force (bool): also check the items if the ctag is unchanged, and refetch recurring items
+        Returns:
+            True if the cache has changed.
+        Raises:
+            requests.RequestException or ET.ParseError if communication with the server fails.
+        """
+        ctag = self.get_ctag()
+        if not force and ctag is not None and ctag == self._ctag:
+            return False
+
+        window = {"dav": DAV, "caldav": CALDAV, "start": to_caldav_utc(start), "end": to_caldav_utc(end)}
+        etags = self.get_etags(window)
+
+        changed = False
+        for href in list(self._items.keys()):
+            if href not in etags:
+                del self._items[href]
+                changed = True
+
+        to_fetch = [
+            href for href, etag in etags.items()
+            if href not in self._items
+            or self._items[href]["etag"] != etag
+            or (force and self._items[href]["recurring"])
+        ]
+        if len(to_fetch) > 0:
+            for href, item in self.get_items(to_fetch, window).items():
+                if self._items.get(href) != item:
+                    self._items[href] = item
+                    changed = True
+
+        self._ctag = ctag
+        return changed
+
+    def get_ctag(self) -> Optional[str]:
+        """The ctag of the calendar collection, None if the server does not provide one."""
+        res = self.request("PROPFIND", PROPFIND_CTAG, depth="0")
+        ctag = ET.fromstring(res.content).find(f".//{{{CALENDARSERVER}}}getctag")
+        if ctag is None or not ctag.text:
+            return None
+        return ctag.text
+
+    def get_etags(self, window: dict) -> dict:
+        """The etag per item (href) for all items in the window."""
+        res = self.request("REPORT", REPORT_ETAGS.format(**window), depth="1")
+        etags = {}
+        for response in ET.fromstring(res.content).iter(f"{{{DAV}}}response"):
+            href = response.findtext(f"{{{DAV}}}href")
+            etag = response.findtext(f".//{{{DAV}}}getetag")
+            if href and etag:
+                etags[href] = etag
+        return etags
+
+    def get_items(self, hrefs: List[str], window: dict) -> dict:
+        """Fetch the items with these hrefs, with recurring items expanded for the window."""
+        body = REPORT_MULTIGET.format(hrefs="".join(f"<d:href>{href}</d:href>" for href in hrefs), **window)
+        res = self.request("REPORT", body, depth="1")
+        items = {}
+        for response in ET.fromstring(res.content).iter(f"{{{DAV}}}response"):
+            href = response.findtext(f"{{{DAV}}}href")
+            data = response.findtext(f".//{{{CALDAV}}}calendar-data")
+            if not href or data is None:
+                continue
+            events = parse_vevents(data, self.tz)
+            items[href] = {
+                "etag": response.findtext(f".//{{{DAV}}}getetag"),
+                "recurring": "RECURRENCE-ID" in data or "RRULE" in data,
+                "events": events,
+            }
+        return items
+
+    def request(self, method: str, body: str, depth: str) -> requests.Response:
+        res = self.session.request(
+            method,
+            self.url,
+            data=body.encode("utf-8"),
+            headers={"Depth": depth, "Content-Type": "application/xml; charset=utf-8"},
+            timeout=self.timeout,
+        )
+        res.raise_for_status()
+        return res
+
+
+def to_caldav_utc(dt: datetime) -> str:
+    return dt.astimezone(timezone.utc).strftime("%Y%m%dT%H%M%SZ")
+
+
+def parse_vevents(ical: str, tz: tzinfo) -> List[dict]:
+    """Parse the VEVENT components of an iCalendar text to events.
+
+    Only the properties needed for targets are read: UID, DTSTART, DTEND, SUMMARY and DESCRIPTION.
+    """
+    events = []
+    event = None
+    for line in unfold_lines(ical):
+        name, params, value = split_property(line)
+        if name == "BEGIN" and value == "VEVENT":
+            event = {}
+        elif name == "END" and value == "VEVENT":
+            if event is not None and "start" in event:
+                events.append(event)
+            event = None
+        elif event is not None:
+            if name == "UID":
+                event["uid"] = value
+            elif name in ("DTSTART", "DTEND"):
+                key = "start" if name == "DTSTART" else "end"
+                event[key] = parse_ical_datetime(value, params, tz).isoformat()
+            elif name == "SUMMARY":
+                event["summary"] = unescape_text(value)
+            elif name == "DESCRIPTION":
+                event["description"] = unescape_text(value)
+    return events
+
+
+def unfold_lines(ical: str) -> List[str]:
+    """Undo the folding of long lines (a line break followed by a space or tab)."""
+    lines = []
+    for line in ical.replace("\r\n", "\n").split("\n"):
+        if line[:1] in (" ", "\t") and lines:
+            lines[-1] += line[1:]
+        elif line:
+            lines.append(line)
+    return lines
+
+
+def split_property(line: str):
+    """Split a content line like 'DTSTART;TZID=Europe/Amsterdam:20240302T080000' into name, params and value."""
+    name_and_params, _, value = line.partition(":")
+    parts = name_and_params.split(";")
+    params = {}
+    for part in parts[1:]:
+        key, _, param_value = part.partition("=")
+        params[key.upper()] = param_value.strip('"')
+    return parts[0].upper(), params, value
+
+
+def parse_ical_datetime(value: str, params: dict, tz: tzinfo) -> datetime:
+    """Parse a DATE or DATE-TIME value, in UTC (Z), with a TZID or floating (then tz is used)."""
+    if params.get("VALUE") == "DATE" or len(value) == 8:
+        day = date(int(value[0:4]), int(value[4:6]), int(value[6:8]))
+        return localize(datetime.combine(day, datetime.min.time()), tz)
+    dt = datetime.strptime(value[:15], "%Y%m%dT%H%M%S")
+    if value.endswith("Z"):
+        return dt.replace(tzinfo=timezone.utc).astimezone(tz)
+    if "TZID" in params:
+        try:
+            return localize(dt, pytz.timezone(params["TZID"])).astimezone(tz)
+        except pytz.UnknownTimeZoneError:
+            pass
+    return localize(dt, tz)
+
+
+def localize(dt: datetime, tz: tzinfo) -> datetime:
+    if hasattr(tz, "localize"):
+        return tz.localize(dt)
+    return dt.replace(tzinfo=tz)
+
+
+def unescape_text(value: str) -> str:
+    return value.replace("\\n", "\n").replace("\\N", "\n").replace("\\,", ",").replace("\\;", ";").replace("\\\\", "\\")
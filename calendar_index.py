@@ -0,0 +1,82 @@
+from bisect import bisect_left, insort
+from datetime import datetime, tzinfo
+from typing import List, Optional, Tuple
+
+from calendar_target import CalendarTarget, parse_calendar_datetime, target_from_text
+
+
+class CalendarIndex:
+    """Index of all calendar items (events) in the coming week, sorted by start.
+
+    Each event is parsed to a CalendarTarget once, when it is added. Updates are incremental: an update with the
+    current list of events only removes the events that are gone and adds the ones that are new (an edited event
+    is both). Lookups by time use bisect on the sorted start timestamps.
+    """
+
+    # Sorted list of (start timestamp, event key), the event key makes items with the same start unique.
+    _index: List[Tuple[float, tuple]]
+    _targets: dict
+
+    def __init__(self):
+        self._index = []
+        self._targets = {}
+
+    def __len__(self):
+        return len(self._index)
+
+    def update(self, events: List[dict], tz: tzinfo) -> bool:
+        """Bring the index in line with events, a list of calendar items as returned by the HA calendar.
+
+        Parameters:
+            events (list): dicts with start, end (isoformat) and summary, description (optional)
+            tz (tzinfo): timezone for items without timezone
+        Returns:
+            True if the index has changed.
+        """
+        new_keys = {event_key(event): event for event in events}
+        removed = [key for key in self._targets if key not in new_keys]
+        added = [key for key in new_keys if key not in self._targets]
+
+        for key in removed:
+            target = self._targets.pop(key)
+            i = bisect_left(self._index, (target.start.timestamp(), key))
+            del self._index[i]
+
+        for key in added:
+            event = new_keys[key]
+            start = parse_calendar_datetime(event["start"], tz)
+            # Depending on the type of calendar the summary or description contains the possible target_soc.
+            text_to_search_in = " ".join(filter(None, [event.get("summary"), event.get("description")]))
+            self._targets[key] = target_from_text(start, text_to_search_in)
+            insort(self._index, (start.timestamp(), key))
+
+        return len(removed) > 0 or len(added) > 0
+
+    def targets_before(self, end: datetime) -> List[CalendarTarget]:
+        """All targets with a start before end, in order of their start."""
+        i = bisect_left(self._index, (end.timestamp(),))
+        return [self._targets[key] for _, key in self._index[:i]]
+
+    def targets_between(self, start: datetime, end: datetime) -> List[CalendarTarget]:
+        """All targets with a start from start up to end, in order of their start."""
+        i = bisect_left(self._index, (start.timestamp(),))
+        j = bisect_left(self._index, (end.timestamp(),))
+        return [self._targets[key] for _, key in self._index[i:j]]
+
+    def first_target_after(self, moment: datetime) -> Optional[CalendarTarget]:
+        """The first target that starts at or after moment."""
+        i = bisect_left(self._index, (moment.timestamp(),))
+        if i == len(self._index):
+            return None
+        return self._targets[self._index[i][1]]
+
+
+def event_key(event: dict) -> tuple:
+    """Identification of a calendar item, changes when the item is edited."""
+    return (
+        event.get("uid") or "",
+        event["start"],
+        event.get("end") or "",
+        event.get("summary") or "",
+        event.get("description") or "",
+    )
@@ -0,0 +1,103 @@
+from datetime import datetime, time, tzinfo
+import re
+from typing import Optional
+
+import isodate
+
+import constants as c
+
+
+# Units that can be used in the message or description of a calendar item to set a target, in order of priority.
+# Forgives errors in incorrect capitalization of the unit and missing/double spaces.
+TARGET_UNIT_PATTERNS = {
+    "kWh": re.compile(r"(?P<quantity>\d+) *kwh"),
+    "%": re.compile(r"(?P<quantity>\d+) *%"),
+    "km": re.compile(r"(?P<quantity>\d+) *km"),
+}
+
+
+class CalendarTarget:
+    """A target for the schedule derived from a calendar item."""
+
+    start: datetime
+    # The target in kWh, always between c.CAR_MIN_SOC_IN_KWH and c.CAR_MAX_CAPACITY_IN_KWH
+    soc_kwh: float
+    # Description of how the target was derived, for logging
+    explanation: str
+
+    def __init__(self, start: datetime, soc_kwh: float, explanation: str):
+        self.start = start
+        self.soc_kwh = soc_kwh
+        self.explanation = explanation
+
+    def __repr__(self):
+        return f"CalendarTarget(start={self.start.isoformat()}, soc_kwh={self.soc_kwh}, {self.explanation})"
+
+
+def parse_calendar_datetime(value: str, tz: tzinfo) -> datetime:
+    """Parse a start/end of a calendar item, these come with or without time (all-day items) and timezone."""
+    value = value.replace(" ", "T")
+    if "T" in value:
+        dt = isodate.parse_datetime(value)
+    else:
+        dt = datetime.combine(isodate.parse_date(value), time())
+    if dt.tzinfo is None:
+        dt = tz.localize(dt) if hasattr(tz, "localize") else dt.replace(tzinfo=tz)
+    return dt.astimezone(tz)
+
+
+def target_from_text(start: datetime, text: str) -> CalendarTarget:
+    """Derive the target soc for a calendar item starting at start from its text.
+
+    The text is searched for a number in kWh, then in %, then in km. Without any of these the target is
+    the maximum capacity of the car battery.
+    A target in km is converted with the average usage of the car and comes on top of the minimum soc.
+    """
+    target_soc = c.CAR_MAX_CAPACITY_IN_KWH
+    explanation = "no target in calendar item, using max capacity"
+
+    found_target_in_kwh = search_for_soc_target("kWh", text)
+    if found_target_in_kwh is not None:
+        target_soc = found_target_in_kwh
+        explanation = f"target {found_target_in_kwh} kWh"
+    else:
+        found_target_in_percentage = search_for_soc_target("%", text)
+        if found_target_in_percentage is not None:
+            target_soc = round(float(found_target_in_percentage) / 100 * c.CAR_MAX_CAPACITY_IN_KWH, 2)
+            explanation = f"target {found_target_in_percentage} %"
+        else:
+            found_target_in_km = search_for_soc_target("km", text)
+            if found_target_in_km is not None:
+                target_soc = round(found_target_in_km * c.CAR_AVERAGE_WH_PER_KM / 1000 + c.CAR_MIN_SOC_IN_KWH, 2)
+                explanation = f"target {found_target_in_km} km"
+
+    # Prevent target_soc above max_capacity
+    if target_soc > c.CAR_MAX_CAPACITY_IN_KWH:
+        explanation += f", {target_soc} kWh too high, adjusted to {c.CAR_MAX_CAPACITY_IN_KWH} kWh"
+        target_soc = c.CAR_MAX_CAPACITY_IN_KWH
+    elif target_soc < c.CAR_MIN_SOC_IN_KWH:
+        explanation += f", {target_soc} kWh too low, adjusted to {c.CAR_MIN_SOC_IN_KWH} kWh"
+        target_soc = c.CAR_MIN_SOC_IN_KWH
+
+    return CalendarTarget(start=start, soc_kwh=target_soc, explanation=explanation)
+
+
+def search_for_soc_target(search_unit: str, string_to_search_in: str) -> Optional[int]:
+    """Search description for the first occurrence of some (integer) number of the search_unit.
+
+    Parameters:
+        search_unit (str): The unit to search for, one of the keys of TARGET_UNIT_PATTERNS, found directly
+                           following the number
+        string_to_search_in (str): The string in which the soc in searched
+    Returns:
+        integer number or None if nothing is found
+
+    Forgives errors in incorrect capitalization of the unit and missing/double spaces.
+    """
+    if string_to_search_in is None:
+        return None
+    match = TARGET_UNIT_PATTERNS[search_unit].search(string_to_search_in.lower())
+    if match:
+        return int(float(match.group("quantity")))
+
+    return None
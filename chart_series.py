@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta
+from typing import Callable, Dict, List, Optional, Tuple
+
+from series_cache import Series, to_ms
+
+
+class ChartPublisher:
+    """Publishes series (e.g. prices) to the HA entities that the charts in the UI render.
+
+    Only what the chart can show is published: each series is trimmed to the view window of the chart and, if it
+    still has more than max_points points, downsampled with min/max bucketing. The state is only written if the
+    published records change, so HA (the recorder) and the open dashboards are not bothered with the same data.
+
+    The view window slides with time, so the series are kept and re-trimmed with refresh (e.g. hourly). The
+    window is widened to whole TRIM_STEPs, so a re-trim only changes the records once per TRIM_STEP.
+    """
+
+    TRIM_STEP: timedelta = timedelta(hours=6)
+
+    # Called with the entity_id, state and attributes, e.g. the set_state of the app
+    set_state: Callable
+    # The view window of the chart: it starts view_before before now and lasts view_duration
+    view_before: timedelta
+    view_duration: timedelta
+    max_points: int
+
+    # Per entity_id: the name of the value in the records, the series, its (converted) values and the state
+    _sources: Dict[str, Tuple[str, Series, list, str]]
+    # Per entity_id: the records that were published last
+    _published: Dict[str, list]
+
+    def __init__(self, set_state: Callable, view_before: timedelta, view_duration: timedelta, max_points: int):
+        self.set_state = set_state
+        self.view_before = view_before
+        self.view_duration = view_duration
+        self.max_points = max_points
+        self._sources = {}
+        self._published = {}
+
+    def publish(self, entity_id: str, name: str, series: Series, values: list, state: str, now: datetime) -> bool:
+        """Publish a series to entity_id, if the part of it in the view window differs from what is published.
+
+        Parameters:
+            entity_id (str): the entity the chart renders, e.g. input_text.epex_prices
+            name (str): key of the value in the records, e.g. "price"
+            series (Series): the series to publish
+            values (list): the (converted) values of the series to publish
+            state (str): state of the entity, e.g. the moment the data was collected
+            now (datetime): the current time
+        Returns:
+            True if the state was written.
+        """
+        self._sources[entity_id] = (name, series, values, state)
+        return self._publish(entity_id, now)
+
+    def refresh(self, now: datetime):
+        """Publish the series again for the window at now, only those for which the records change are written."""
+        for entity_id in self._sources:
+            self._publish(entity_id, now)
+
+    def window(self, now: datetime) -> Tuple[int, int]:
+        """The start and end (in ms) of the view window at now, widened to whole TRIM_STEPs."""
+        step = int(self.TRIM_STEP.total_seconds() * 1000)
+        start = to_ms(now - self.view_before)
+        start -= start % step
+        end = to_ms(now - self.view_before + self.view_duration)
+        end += -end % step
+        return start, end
+
+    def _publish(self, entity_id: str, now: datetime) -> bool:
+        name, series, values, state = self._sources[entity_id]
+        start, end = self.window(now)
+        event_starts, values = trim(series.event_starts, values, start, end)
+        event_starts, values = downsample_min_max(event_starts, values, self.max_points)
+        records = Series(event_starts, values).records(name)
+        if records == self._published.get(entity_id):
+            return False
+        self.set_state(entity_id, state=state, attributes={"records": records})
+        self._published[entity_id] = records
+        return True
+
+
+def trim(event_starts: List[int], values: list, start: int, end: int) -> Tuple[List[int], list]:
+    """The events of a series (sorted by event_start) from start to end, both in ms.
+
+    The last event before start is kept (at start), as a step line starts with the value that holds at start.
+    """
+    trimmed_starts, trimmed_values = [], []
+    last_before: Optional[Tuple[int, object]] = None
+    for event_start, value in zip(event_starts, values):
+        if event_start < start:
+            last_before = (event_start, value)
+        elif event_start < end:
+            trimmed_starts.append(event_start)
+            trimmed_values.append(value)
+    if last_before is not None and (len(trimmed_starts) == 0 or trimmed_starts[0] > start):
+        trimmed_starts.insert(0, start)
+        trimmed_values.insert(0, last_before[1])
+    return trimmed_starts, trimmed_values
+
+
+def downsample_min_max(event_starts: List[int], values: list, max_points: int) -> Tuple[List[int], list]:
+    """Reduce a series to at most max_points points with min/max bucketing.
+
+    The events are divided in max_points / 2 buckets of (nearly) equal size, of each bucket the events with the
+    minimum and maximum value are kept, in order of time. Unlike averaging, this keeps the peaks (e.g. negative
+    prices) that the chart is looked at for. None values are left out of the buckets.
+    """
+    if len(event_starts) <= max_points or max_points < 2:
+        return event_starts, values
+    number_of_buckets = max_points // 2
+    bucket_size = len(event_starts) / number_of_buckets
+    downsampled_starts, downsampled_values = [], []
+    for bucket in range(number_of_buckets):
+        indices = [
+            i for i in range(int(bucket * bucket_size), int((bucket + 1) * bucket_size)) if values[i] is not None
+        ]
+        if len(indices) == 0:
+            continue
+        low = min(indices, key=lambda i: values[i])
+        high = max(indices, key=lambda i: values[i])
+        for i in sorted({low, high}):
+            downsampled_starts.append(event_starts[i])
+            downsampled_values.append(values[i])
+    return downsampled_starts, downsampled_values
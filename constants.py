@@ -106,3 +106,7 @@ CHARGER_MAX_DIS_CHARGE_POWER: int = 1380
 # See remark for charger constants
 # Defaults to 24 (to be safe)
 CAR_MAX_CAPACITY_IN_KWH: int = 24
+
+# Average electricity usage of the car in Wh per km, used for targets in km and the remaining range.
+# Defaults to 174 (a Nissan Leaf)
+CAR_AVERAGE_WH_PER_KM: int = 174
@@ -0,0 +1,121 @@
+from collections import deque
+from datetime import datetime
+import threading
+from typing import Callable, Optional
+
+# In-process publish/subscribe between the V2G Liberty apps.
+#
+# All apps run in the same AppDaemon process, so events can be handed over directly instead of through
+# (blocking) get_app calls or HA entities. Publishing never blocks: the event is put in a (bounded) queue per
+# subscription and the subscriber drains its queue in its own thread, through a run_in of its app.
+# HA entities are only used where the UI needs them.
+
+
+class Event:
+    """Base class of all events on the bus."""
+
+    def __repr__(self):
+        return f"{type(self).__name__}({self.__dict__})"
+
+
+class ScheduleReady(Event):
+    """A new schedule, from FM or the local scheduler, for V2Gliberty to execute."""
+
+    def __init__(self, schedule: dict, schedule_id: Optional[str] = None):
+        self.schedule = schedule
+        self.schedule_id = schedule_id
+
+
+class NoScheduleError(Event):
+    """A change in one of the reasons why no (valid) schedule is available, see V2Gliberty.no_schedule_errors."""
+
+    def __init__(self, error_name: str, error_state: bool):
+        self.error_name = error_name
+        self.error_state = error_state
+
+
+class ScheduleInputChanged(Event):
+    """An input of the schedule changed (e.g. the calendar or the prices), V2Gliberty decides on a new schedule."""
+
+    def __init__(self, reason: str):
+        self.reason = reason
+
+
+class MeteringInterval(Event):
+    """An interval (of FM_EVENT_RESOLUTION_IN_MINUTES) has been concluded by set_fm_data."""
+
+    def __init__(self, end: datetime, power: float, availability: float, soc: Optional[int]):
+        # Average power in MW, availability in % and SoC in % (None if no car is connected)
+        self.end = end
+        self.power = power
+        self.availability = availability
+        self.soc = soc
+
+
+class Subscription:
+    """The queue of events of one type for one callback of an app."""
+
+    def __init__(self, app, callback: Callable[[Event], None], max_queue_length: Optional[int]):
+        self.app = app
+        self.callback = callback
+        self.queue = deque(maxlen=max_queue_length)
+        self.drain_is_planned = False
+
+
+class EventBus:
+    """Delivers published events to the subscribers of their type.
+
+    If a subscriber cannot keep up, the oldest events in its queue are dropped, unless it subscribed with an
+    unbounded queue.
+    """
+
+    # Per event type: dict of subscriptions keyed by (app name, callback name)
+    _subscriptions: dict
+    _lock: threading.Lock
+
+    def __init__(self):
+        self._subscriptions = {}
+        self._lock = threading.Lock()
+
+    def subscribe(self, event_type: type, app, callback: Callable[[Event], None],
+                  max_queue_length: Optional[int] = 100):
+        """Let callback (a method of app) be called with each event of event_type.
+
+        Use max_queue_length None for events that must not be dropped (e.g. schedules and error states, where
+        dropping the one that resolves an error would leave it standing).
+        Subscribing again with the same app and callback (e.g. when the app is reloaded) replaces the
+        previous subscription.
+        """
+        with self._lock:
+            subscriptions = self._subscriptions.setdefault(event_type, {})
+            subscriptions[(app.name, callback.__name__)] = Subscription(app, callback, max_queue_length)
+
+    def publish(self, event: Event):
+        """Queue the event for all subscribers of its type, without waiting for them."""
+        with self._lock:
+            subscriptions = list(self._subscriptions.get(type(event), {}).values())
+            to_drain = []
+            for subscription in subscriptions:
+                subscription.queue.append(event)
+                if not subscription.drain_is_planned:
+                    subscription.drain_is_planned = True
+                    to_drain.append(subscription)
+        for subscription in to_drain:
+            subscription.app.run_in(self._drain, 0, subscription=subscription)
+
+    def _drain(self, kwargs):
+        subscription = kwargs["subscription"]
+        while True:
+            with self._lock:
+                if len(subscription.queue) == 0:
+                    subscription.drain_is_planned = False
+                    return
+                event = subscription.queue.popleft()
+            try:
+                subscription.callback(event)
+            except Exception as e:
+                subscription.app.log(f"Handling {event} failed: {e}")
+
+
+# The bus shared by all apps
+bus = EventBus()
@@ -1,12 +1,17 @@
 from datetime import datetime, timedelta
 import time
 import json
-import math
-import re
-import requests
 import isodate
+import pytz
+import requests
+from typing import Optional
 import constants as c
-from v2g_globals import time_round
+import soc_constraints as sc
+import local_scheduler
+from calendar_index import CalendarIndex
+from caldav_calendar import CalDAVCalendar
+from event_bus import bus, NoScheduleError, ScheduleInputChanged, ScheduleReady
+from single_flight import SingleFlight
 
 import appdaemon.plugins.hass.hassapi as hass
 
@@ -15,8 +20,8 @@ class FlexMeasuresClient(hass.Hass):
     """ This class manages the communication with the FlexMeasures platform, which delivers the charging schedules.
 
     - Gets input from car calendar (see config setting: fm_car_reservation_calendar)
-    - Saves charging schedule locally (input_text.chargeschedule)
-    - Reports on errors via v2g_liberty module handle_no_schedule()
+    - Hands charging schedules over to the v2g_liberty module with ScheduleReady events
+    - Reports on errors with NoScheduleError events
 
     """
 
@@ -32,18 +37,40 @@ class FlexMeasuresClient(hass.Hass):
     DELAY_FOR_REATTEMPTS: int  # number of seconds
     CAR_RESERVATION_CALENDAR: str
 
+    # All calendar items in the coming week (CALENDAR_WINDOW), parsed to targets
+    calendar_index: CalendarIndex
+    calendar_timezone: pytz.BaseTzInfo
+    CALENDAR_WINDOW: timedelta = timedelta(days=7)
+    # Optional direct connection to a CalDAV calendar, instead of the calendar entity in Home Assistant
+    caldav_calendar: Optional[CalDAVCalendar]
+    CALDAV_POLL_INTERVAL: int  # number of seconds
+    CALDAV_FULL_SYNC_INTERVAL: timedelta = timedelta(hours=1)
+    caldav_last_full_sync: Optional[datetime]
+
     # A slack for the constraint_relaxation_window in minutes
     WINDOW_SLACK: int = 60
 
+    # Duration of the steps in which gradually lowered soc_maxima are sent (scenario 1).
+    RAMP_SEGMENT_DURATION: timedelta = timedelta(minutes=60)
+
     # FM Authentication token
     fm_token: str
-    # Helper to prevent parallel calls to FM for getting a schedule
-    fm_busy_getting_schedule: bool
-    # Helper to prevent blocking the sequence of getting schedules.
-    # Sometimes the previous bool is not reset (why we don't know), then it needs a timed reset.
-    # stores the date_time of the last successful received schedule
-    fm_date_time_last_schedule: datetime
+    # Only one schedule is triggered and retrieved at a time. A request with the same inputs joins the one in flight,
+    # a request with changed inputs supersedes it. The lease of a request covers all attempts to retrieve the
+    # schedule, so a request that got 'lost' cannot block getting schedules.
+    schedule_flight: SingleFlight
     fm_max_seconds_between_schedules: int
+    # Incremented on each change of the calendar, part of the inputs of a schedule request.
+    calendar_revision: int
+
+    # Schedules for known upcoming moments at which the constraints change (a calendar item starts, the relaxation
+    # window opens or back_to_max_soc is reached) are requested ahead, with the projected SoC at that moment.
+    # The prefetched schedule is swapped in at that moment if the actual SoC is within PREFETCH_SOC_TOLERANCE.
+    prefetch_moment: Optional[datetime]
+    # Timer for the prefetch and, once that is done, for the swap
+    prefetch_timer_handle: Optional[str]
+    prefetched_schedule: Optional[dict]
+    PREFETCH_SOC_TOLERANCE: int = 2  # in %
 
     # Helper to see if FM connection/ping has too many errors
     connection_error_counter: int
@@ -55,9 +82,6 @@ class FlexMeasuresClient(hass.Hass):
         self.log("Initializing FlexMeasuresClient")
 
         self.fm_token = ""
-        self.fm_busy_getting_schedule = False
-        self.log(f"Init, fm_busy_getting_schedule: {self.fm_busy_getting_schedule}.")
-        self.fm_date_time_last_schedule = self.get_now()
 
         base_url = c.FM_SCHEDULE_URL + str(c.FM_ACCOUNT_POWER_SENSOR_ID)
         self.FM_URL = base_url + c.FM_SCHEDULE_SLUG
@@ -72,7 +96,40 @@ class FlexMeasuresClient(hass.Hass):
         # Add an extra attempt to prevent the last attempt not being able to finish.
         self.fm_max_seconds_between_schedules = \
             self.DELAY_FOR_REATTEMPTS * (self.MAX_NUMBER_OF_REATTEMPTS + 1) + self.DELAY_FOR_INITIAL_ATTEMPT
+        self.schedule_flight = SingleFlight(lease=timedelta(seconds=self.fm_max_seconds_between_schedules))
+        self.calendar_revision = 0
+        self.prefetch_moment = None
+        self.prefetch_timer_handle = None
+        self.prefetched_schedule = None
         self.CAR_RESERVATION_CALENDAR = self.args["fm_car_reservation_calendar"]
+        self.calendar_timezone = pytz.timezone(self.get_timezone())
+        self.calendar_index = CalendarIndex()
+        self.caldav_calendar = None
+        self.caldav_last_full_sync = None
+        caldav_url = self.args.get("caldav_url")
+        caldav_username = self.args.get("caldav_username")
+        caldav_password = self.args.get("caldav_password")
+        if caldav_url:
+            for key, value in (("caldav_username", caldav_username), ("caldav_password", caldav_password)):
+                if not value:
+                    self.log(f"Configuration error: caldav_url is set but {key} is missing, using the calendar "
+                             f"{self.CAR_RESERVATION_CALENDAR} from HA instead.")
+                    caldav_url = None
+        if caldav_url:
+            # Read the calendar directly, only a changed ctag leads to fetching (the changed) items.
+            self.caldav_calendar = CalDAVCalendar(
+                url=caldav_url,
+                username=caldav_username,
+                password=caldav_password,
+                tz=self.calendar_timezone,
+            )
+            self.CALDAV_POLL_INTERVAL = int(self.args.get("caldav_poll_interval", 60))
+            self.run_every(self.sync_caldav_calendar, "now", self.CALDAV_POLL_INTERVAL)
+        else:
+            self.listen_state(self.handle_calendar_change, self.CAR_RESERVATION_CALENDAR, attribute="all")
+            # Calendar items move into the window over time without a change of the calendar entity,
+            # so the index also gets refreshed periodically.
+            self.run_every(self.refresh_calendar_index, "now", 60 * 60)
 
         if c.OPTIMISATION_MODE == "price":
             self.FM_OPTIMISATION_CONTEXT = {"consumption-price-sensor": c.FM_PRICE_CONSUMPTION_SENSOR_ID,
@@ -94,13 +151,20 @@ class FlexMeasuresClient(hass.Hass):
         """ Ping function to check if server is alive """
         url = c.FM_PING_URL
 
-        res = requests.get(url)
-        if res.status_code == 200:
+        try:
+            res = requests.get(url)
+            is_alive = res.status_code == 200
+        except requests.exceptions.RequestException as e:
+            # Most of the time an unreachable server results in an exception instead of an error status code.
+            self.log(f"Ping to FM failed: {e}")
+            is_alive = False
+
+        if is_alive:
             if self.connection_error_counter > 0:
                 # There was an error before as the counter > 0
                 # So a timer must be running, but it is not needed anymore, so cancel it.
                 self.cancel_timer(self.handle_for_repeater)
-                self.get_app("v2g_liberty").handle_no_new_schedule("no_communication_with_fm", False)
+                bus.publish(NoScheduleError("no_communication_with_fm", False))
             self.connection_error_counter = 0
         else:
             self.connection_error_counter += 1
@@ -109,7 +173,7 @@ class FlexMeasuresClient(hass.Hass):
             # A first error occurred, retry in every minute now
             self.handle_for_repeater = self.run_every(self.ping_server, "now+60", 60)
             self.log("No communication with FM! Increase tracking frequency.")
-            self.get_app("v2g_liberty").handle_no_new_schedule("no_communication_with_fm", True)
+            bus.publish(NoScheduleError("no_communication_with_fm", True))
 
     def authenticate_with_fm(self):
         """Authenticate with the FlexMeasures server and store the returned auth token.
@@ -160,43 +224,42 @@ class FlexMeasuresClient(hass.Hass):
 
     def get_new_schedule(self, current_soc_kwh: float, back_to_max_soc: datetime):
         """Get a new schedule from FlexMeasures.
-           But not if still busy with getting previous schedule.
+           If a schedule for the same inputs is being retrieved already, its result will do.
+           If a schedule for other inputs is being retrieved, that request is superseded.
         Trigger a new schedule to be computed and set a timer to retrieve it, by its schedule id.
         """
-        if self.fm_busy_getting_schedule:
-            seconds_since_last_schedule = int((self.get_now() - self.fm_date_time_last_schedule).total_seconds())
-            if seconds_since_last_schedule > self.fm_max_seconds_between_schedules:
-                self.log("Retrieving previous schedule is taking too long,"
-                         " assuming call got 'lost'. Getting new schedule.")
-            else:
-                self.log("Not getting new schedule, still processing previous request.")
-                return
-
-        # This has to be set here instead of in get_schedule because that function is called with a delay
-        # and during this delay this get_new_schedule could be called.
-        self.fm_busy_getting_schedule = True
+        inputs = (current_soc_kwh, back_to_max_soc, self.calendar_revision)
+        generation = self.schedule_flight.start(inputs, self.get_now())
+        if generation is None:
+            self.log("Not getting new schedule, a schedule for the same inputs is being retrieved.")
+            return
 
         # Ask to compute a new schedule by posting flex constraints while triggering the scheduler
         schedule_id = self.trigger_schedule(current_soc_kwh=current_soc_kwh, back_to_max_soc=back_to_max_soc)
         if schedule_id is None:
             self.log("Failed to trigger new schedule, schedule ID is None. Cannot call get_schedule")
-            self.fm_busy_getting_schedule = False
+            self.schedule_flight.finish(generation)
             return
 
         # Set a timer to get the schedule a little later
         s = self.DELAY_FOR_INITIAL_ATTEMPT
         self.log(f"Attempting to get schedule in {s} seconds")
-        self.run_in(self.get_schedule, delay=s, schedule_id=schedule_id)
+        self.run_in(self.get_schedule, delay=s, schedule_id=schedule_id, generation=generation)
 
     def get_schedule(self, kwargs, **fnc_kwargs):
         """GET a schedule message that has been requested by trigger_schedule.
            The ID for this is schedule_id.
            Then store the retrieved schedule.
 
-        Pass the schedule id using kwargs["schedule_id"]=<schedule_id>.
+        Pass the schedule id using kwargs["schedule_id"]=<schedule_id> and the generation of the request in
+        schedule_flight using kwargs["generation"]=<generation>.
         """
-        # Just to be sure also set this her, it's primary point for setting to true is in get_new_schedule
-        self.fm_busy_getting_schedule = True
+        # A prefetched schedule is retrieved alongside the regular ones
+        prefetch_moment = kwargs.get("prefetch_moment", None)
+        generation = kwargs.get("generation", None)
+        if prefetch_moment is None and not self.schedule_flight.is_current(generation, self.get_now()):
+            self.log(f"Not getting schedule {kwargs['schedule_id']}, its request has been superseded or has expired.")
+            return
 
         schedule_id = kwargs["schedule_id"]
         url = self.FM_URL + schedule_id
@@ -227,223 +290,343 @@ class FlexMeasuresClient(hass.Hass):
             if attempts_left >= 1:
                 self.log(f"Reattempting to get schedule in {s} seconds (attempts left: {attempts_left})")
                 self.run_in(self.get_schedule, delay=s, attempts_left=attempts_left - 1,
-                            schedule_id=schedule_id)
+                            schedule_id=schedule_id, generation=generation, prefetch_moment=prefetch_moment,
+                            projected_soc=kwargs.get("projected_soc"))
+            elif prefetch_moment is not None:
+                self.log("Prefetched schedule cannot be retrieved, a schedule will be requested as usual.")
             else:
                 self.log("Schedule cannot be retrieved. Any previous charging schedule will keep being followed.")
-                self.fm_busy_getting_schedule = False
-                self.get_app("v2g_liberty").handle_no_new_schedule("timeouts_on_schedule", True)
+                self.schedule_flight.finish(generation)
+                bus.publish(NoScheduleError("timeouts_on_schedule", True))
 
             return
 
+        if prefetch_moment is not None:
+            self.log(f"GET prefetched schedule for {prefetch_moment} success.")
+            self.prefetched_schedule = dict(
+                moment=prefetch_moment,
+                schedule_id=schedule_id,
+                projected_soc=kwargs["projected_soc"],
+                schedule=res.json(),
+            )
+            return
+
+        if not self.schedule_flight.is_current(generation, self.get_now()):
+            # Superseded while waiting for the response
+            self.log(f"Discarding schedule {schedule_id}, its request has been superseded or has expired.")
+            return
         self.log(f"GET schedule success: retrieved {res.status_code}")
-        self.fm_busy_getting_schedule = False
-        self.get_app("v2g_liberty").handle_no_new_schedule("timeouts_on_schedule", False)
-        self.fm_date_time_last_schedule = self.get_now()
+        self.schedule_flight.finish(generation)
+        bus.publish(NoScheduleError("timeouts_on_schedule", False))
 
         schedule = res.json()
-        self.log(f"Schedule {schedule}")
-        # To trigger state change we add the date to the state. State change is not triggered by attributes.
-        self.set_state("input_text.chargeschedule",
-                       state="ChargeScheduleAvailable" + self.fm_date_time_last_schedule.isoformat(),
-                       attributes=schedule)
+        self.log(f"Schedule {schedule_id}: {len(schedule['values'])} values from {schedule['start']}, "
+                 f"scheduler: {schedule['scheduler_info']['scheduler']}.")
+        self.deliver_schedule(schedule, schedule_id)
+        self.plan_prefetch()
 
-    def trigger_schedule(self, *args, **fnc_kwargs):
-        """Request a new schedule to be generated by calling the schedule triggering endpoint, while
-        POSTing flex constraints.
-        Return the schedule id for later retrieval of the asynchronously computed schedule.
+    def deliver_schedule(self, schedule: dict, schedule_id: Optional[str] = None):
+        """Hand a schedule over to v2g_liberty, in process so the (large) schedule does not go through HA."""
+        bus.publish(ScheduleReady(schedule, schedule_id))
+
+    def plan_prefetch(self):
+        """Set a timer to request a schedule ahead of the first upcoming moment at which the constraints change.
+
+        These moments are the start of a calendar item, the start of its relaxation window and back_to_max_soc.
+        The request is made early enough for all attempts to retrieve the schedule to fit in before the moment.
+        A prefetch that is planned or in progress is kept if its moment is still the first.
+        """
+        now = self.get_now()
+        lead_time = timedelta(seconds=self.fm_max_seconds_between_schedules)
+        resolution = timedelta(minutes=c.FM_EVENT_RESOLUTION_IN_MINUTES)
+        moments = []
+        calendar_target = self.calendar_index.first_target_after(now + lead_time)
+        if calendar_target is not None:
+            target_slot = sc.to_slot(calendar_target.start, resolution)
+            moments.append(target_slot)
+            relaxation_slot = sc.relaxation_window_start_slot(
+                target_slot, calendar_target.soc_kwh, c.CAR_MAX_SOC_IN_KWH, c.CHARGER_MAX_CHARGE_POWER,
+                self.WINDOW_SLACK, resolution)
+            if relaxation_slot is not None:
+                moments.append(relaxation_slot)
+        v2g_liberty = self.get_app("v2g_liberty")
+        if v2g_liberty is not None and isinstance(v2g_liberty.back_to_max_soc, datetime):
+            moments.append(sc.to_slot(v2g_liberty.back_to_max_soc, resolution))
+
+        moments = [sc.slot_to_datetime(slot, resolution, now.tzinfo) for slot in moments]
+        moments = [moment for moment in moments if moment > now + lead_time or moment == self.prefetch_moment]
+        moment = min(moments) if len(moments) > 0 else None
+        if moment is not None and moment == self.prefetch_moment:
+            return
+
+        self.cancel_timer(self.prefetch_timer_handle, True)
+        self.prefetch_timer_handle = None
+        self.prefetched_schedule = None
+        self.prefetch_moment = moment
+        if moment is None:
+            return
+        self.log(f"Planning to prefetch a schedule for {moment.isoformat()}.")
+        self.prefetch_timer_handle = self.run_at(self.prefetch_schedule, moment - lead_time,
+                                                 moment=moment.isoformat())
+
+    def prefetch_schedule(self, kwargs):
+        """Trigger a schedule that starts at kwargs["moment"], with the SoC projected by the current schedule."""
+        moment = isodate.parse_datetime(kwargs["moment"])
+        v2g_liberty = self.get_app("v2g_liberty")
+        projected_soc = v2g_liberty.get_expected_soc(moment)
+        if projected_soc is None:
+            self.log("Not prefetching a schedule, the SoC at the moment cannot be projected.")
+            return
+
+        schedule_id = self.trigger_schedule(
+            current_soc_kwh=round(projected_soc / 100 * c.CAR_MAX_CAPACITY_IN_KWH, 2),
+            back_to_max_soc=v2g_liberty.back_to_max_soc,
+            start=moment,
+        )
+        if schedule_id is None:
+            return
+        self.run_in(self.get_schedule, delay=self.DELAY_FOR_INITIAL_ATTEMPT, schedule_id=schedule_id,
+                    prefetch_moment=kwargs["moment"], projected_soc=projected_soc)
+        self.prefetch_timer_handle = self.run_at(self.swap_in_prefetched_schedule, moment, moment=kwargs["moment"])
+
+    def swap_in_prefetched_schedule(self, kwargs):
+        """Use the prefetched schedule if it is there and the SoC is (still) as projected."""
+        prefetched = self.prefetched_schedule
+        self.prefetched_schedule = None
+        self.prefetch_moment = None
+        self.prefetch_timer_handle = None
+        v2g_liberty = self.get_app("v2g_liberty")
+        if not v2g_liberty.is_car_connected():
+            self.log("Not using prefetched schedule, car is not connected.")
+            return
+        if prefetched is None or prefetched["moment"] != kwargs["moment"]:
+            self.log("No prefetched schedule available, requesting a new schedule.")
+            v2g_liberty.decide_whether_to_ask_for_new_schedule()
+            return
+
+        drift = v2g_liberty.connected_car_soc - prefetched["projected_soc"]
+        if abs(drift) > self.PREFETCH_SOC_TOLERANCE:
+            self.log(f"Not using prefetched schedule, SoC differs {round(drift, 1)}% from projection.")
+            v2g_liberty.decide_whether_to_ask_for_new_schedule()
+            return
+
+        self.log(f"Using prefetched schedule for {prefetched['moment']}.")
+        # A regular request that is still in flight is for the constraints from before this moment.
+        self.schedule_flight.cancel()
+        self.deliver_schedule(prefetched["schedule"], prefetched["schedule_id"])
+        self.plan_prefetch()
+
+    def handle_calendar_change(self, entity, attribute, old, new, kwargs):
+        """Handle a change in the car reservation calendar entity."""
+        self.refresh_calendar_index()
+
+    def refresh_calendar_index(self, *args):
+        """Bring the index of calendar items in line with the calendar.
+
+        All items in the CALENDAR_WINDOW are requested through the calendar.get_events service. If the service
+        is not available (older Home Assistant versions) only the first item, from the calendar entity, is used.
         """
+        now = self.get_now()
+        events = self.get_calendar_events(now, now + self.CALENDAR_WINDOW)
+        if events is None:
+            car_reservation = self.get_state(self.CAR_RESERVATION_CALENDAR, attribute="all")
+            if car_reservation is None:
+                self.log("No calendar item found, no calendar configured?")
+                events = []
+            else:
+                # This should get the first item from the calendar. If no item is found (i.e. items are too far
+                # into the future) it returns a general entity that does not contain a start_time.
+                events = first_event_from_calendar_state(car_reservation)
 
-        # Prepare the SoC measurement to be sent along with the scheduling request
-        current_soc_kwh = fnc_kwargs["current_soc_kwh"]
-        self.log(f"trigger_schedule called with current_soc_kwh: {current_soc_kwh} kWh.")
+        self.update_calendar_index(events)
 
-        # Snap to sensor resolution
-        soc_datetime = self.get_now()
+    def sync_caldav_calendar(self, *args):
+        """Poll the CalDAV calendar for changes and bring the index of calendar items in line with it.
+
+        Every CALDAV_FULL_SYNC_INTERVAL the items are checked even if the ctag did not change, as items move
+        into the window over time.
+        """
+        now = self.get_now()
+        force = self.caldav_last_full_sync is None or now - self.caldav_last_full_sync > self.CALDAV_FULL_SYNC_INTERVAL
+        try:
+            changed = self.caldav_calendar.sync(now, now + self.CALENDAR_WINDOW, force=force)
+        except Exception as e:
+            self.log(f"Could not sync CalDAV calendar, keeping the known items: {e}")
+            return
+        if force:
+            self.caldav_last_full_sync = now
+        if changed:
+            self.update_calendar_index(self.caldav_calendar.events())
+
+    def update_calendar_index(self, events: list) -> bool:
+        """Update the index of calendar items with events, returns True if it has changed.
+
+        Used for both the HA calendar entity and the CalDAV calendar. Do not wait for the next (SoC based) trigger,
+        a changed reservation needs a new schedule.
+        """
+        changed = self.calendar_index.update(events, self.calendar_timezone)
+        if changed:
+            self.calendar_revision += 1
+            self.log(f"Calendar changed, {len(self.calendar_index)} item(s) in the coming "
+                     f"{self.CALENDAR_WINDOW.days} days.")
+            self.plan_prefetch()
+            bus.publish(ScheduleInputChanged("calendar"))
+        return changed
+
+    def get_calendar_events(self, start: datetime, end: datetime) -> Optional[list]:
+        """Get the items of the car reservation calendar between start and end.
+
+        Returns:
+            List of events (dicts with start, end, summary and description) or None if this failed.
+        """
+        try:
+            res = self.call_service(
+                "calendar/get_events",
+                entity_id=self.CAR_RESERVATION_CALENDAR,
+                start_date_time=start.isoformat(),
+                end_date_time=end.isoformat(),
+                return_result=True,
+            )
+        except Exception as e:
+            self.log(f"Could not get calendar events via service calendar/get_events: {e}")
+            return None
+        return find_calendar_events(res, self.CAR_RESERVATION_CALENDAR)
+
+    def get_local_schedule(self, current_soc_kwh: float, back_to_max_soc: datetime):
+        """Compute a schedule locally, for when FM cannot deliver a (valid) schedule.
+
+        The same constraints as for the FM trigger message are used, optimised on the prices or emissions that
+        get_fm_data has cached. The schedule is handed over to v2g_liberty, as one from FM is.
+        """
         resolution = timedelta(minutes=c.FM_EVENT_RESOLUTION_IN_MINUTES)
-        soc_datetime = time_round(soc_datetime, resolution).isoformat()
+        now_slot, soc_minima, soc_maxima = self.get_soc_constraints(current_soc_kwh, back_to_max_soc, resolution)
+        end_slot = now_slot + isodate.parse_duration(self.FM_SCHEDULE_DURATION) // resolution
+
+        signal = self.get_app("get_fm_data").get_optimisation_signal()
+        blocks = local_scheduler.signal_blocks(signal, now_slot, end_slot, resolution)
+        values = local_scheduler.plan_schedule(
+            blocks=blocks,
+            current_soc_kwh=current_soc_kwh,
+            soc_minima=soc_minima,
+            soc_maxima=soc_maxima,
+            min_soc_kwh=c.CAR_MIN_SOC_IN_KWH,
+            capacity_kwh=c.CAR_MAX_CAPACITY_IN_KWH,
+            max_charge_power_w=c.CHARGER_MAX_CHARGE_POWER,
+            max_discharge_power_w=c.CHARGER_MAX_DIS_CHARGE_POWER,
+            roundtrip_efficiency=c.CHARGER_PLUS_CAR_ROUNDTRIP_EFFICIENCY,
+            resolution=resolution,
+        )
+        if values is None:
+            self.log("Cannot compute a local schedule, no cached prices/emissions for the coming period.")
+            return
 
-        url = self.FM_TIGGER_URL
+        now = self.get_now()
+        schedule = {
+            "start": sc.slot_to_datetime(now_slot, resolution, now.tzinfo).isoformat(),
+            "duration": isodate.duration_isoformat(len(values) * resolution),
+            "values": values,
+            "unit": "MW",
+            "scheduler_info": {"scheduler": local_scheduler.SCHEDULER_NAME},
+        }
+        self.log(f"Local schedule computed for {schedule['duration']} from {schedule['start']}.")
+        self.deliver_schedule(schedule)
+
+    def get_soc_constraints(self, current_soc_kwh: float, back_to_max_soc: Optional[datetime],
+                            resolution: timedelta, start: Optional[datetime] = None):
+        """The soc-minima and soc-maxima for a schedule starting now (or at start), as segments of slots.
+
+        Returns:
+            Tuple of the slot of now (or start), the soc_minima and the soc_maxima.
+        """
+        # Snap to sensor resolution
+        now = start if start is not None else self.get_now()
+        now_slot = sc.to_slot(now, resolution)
 
         # AJO 2022-02-26:
         # ToDo: Getting target should be in v2g_liberty module.
         # AJO 2023-03-31:
         # ToDo: Would it be more efficient to determine the target every 15/30/60? minutes instead of at every schedule
         # Set default target_soc to 100% one week from now
-        target_datetime = (time_round(self.get_now(), resolution) + timedelta(days=7))
+        target_slot = now_slot + sc.minutes_to_slots(7 * 24 * 60, resolution)
         # By default, we assume no calendar item so no relaxation window is needed
-        start_relaxation_window = target_datetime
+        srw_slot = target_slot
         target_soc = c.CAR_MAX_CAPACITY_IN_KWH
 
-        # Check if calendar has a relevant item that is within one week (*) from now.
+        # Check if calendar has relevant items that are within one week (*) from now.
         # (*) 7 days is the setting in v2g_liberty_package.yaml
-        # If so try to retrieve target_soc
-        car_reservation = self.get_state(self.CAR_RESERVATION_CALENDAR, attribute="all")
-        # This should get the first item from the calendar. If no item is found (i.e. items are too far into the future)
-        # it returns a general entity that does not contain a start_time, message or description.
-
-        if car_reservation is None:
-            self.log("No calendar item found, no calendar configured?")
+        # Each of these items results in a soc-minimum, the relaxation window starts before the first item
+        # that has a target above CAR_MAX_SOC_IN_KWH.
+        soc_minima = []
+        # Items that start before the slot of now (or start) have passed, the index keeps them until the next
+        # calendar update.
+        targets = self.calendar_index.targets_between(
+            sc.slot_to_datetime(now_slot, resolution, now.tzinfo) - resolution / 2,
+            sc.slot_to_datetime(target_slot, resolution, now.tzinfo)
+        )
+        for calendar_target in targets:
+            calendar_item_slot = sc.to_slot(calendar_target.start, resolution)
+            soc_minima.append((calendar_item_slot, calendar_item_slot, calendar_target.soc_kwh))
+
+            # The relaxation window is the period before a calendar item where no
+            # soc_maxima should be sent to allow the schedule to reach a target higher
+            # than the CAR_MAX_SOC_IN_KWH.
+            relaxation_slot = sc.relaxation_window_start_slot(
+                calendar_item_slot, calendar_target.soc_kwh, c.CAR_MAX_SOC_IN_KWH, c.CHARGER_MAX_CHARGE_POWER,
+                self.WINDOW_SLACK, resolution)
+            if relaxation_slot is not None and relaxation_slot < srw_slot:
+                srw_slot = relaxation_slot
+        if len(soc_minima) == 0:
+            soc_minima.append((target_slot, target_slot, target_soc))
         else:
-            self.log(f"Calender: {car_reservation}")
-            calendar_item_start = car_reservation["attributes"].get("start_time", None)
-            if calendar_item_start is not None:
-                # Prepare for date parsing
-                TZ = isodate.parse_tzinfo(self.get_timezone())
-                calendar_item_start = calendar_item_start.replace(" ", "T")
-                calendar_item_start = isodate.parse_datetime(calendar_item_start).astimezone(TZ)
-                self.log(f"calendar_item_start: {calendar_item_start}.")
-                if calendar_item_start < target_datetime:
-                    # There is a relevant calendar item with a start date less than a week in the future.
-                    # Set the calendar_item_start as the target for the schedule
-                    target_datetime = time_round(calendar_item_start, resolution)
-
-                    # Now try to retrieve target_soc.
-                    # Depending on the type of calendar the description or message contains the possible target_soc.
-                    m = car_reservation["attributes"]["message"]
-                    d = car_reservation["attributes"]["description"]
-                    # Prevent concatenation of possible None values
-                    text_to_search_in = " ".join(filter(None, [m, d]))
-
-                    # First try searching for a number in kWh
-                    found_target_soc_in_kwh = search_for_soc_target("kWh", text_to_search_in)
-                    if found_target_soc_in_kwh is not None:
-                        self.log(f"Target SoC from calendar: {found_target_soc_in_kwh} kWh.")
-                        target_soc = found_target_soc_in_kwh
-                    else:
-                        # No kWh number found, try searching for a number in %
-                        found_target_soc_in_percentage = search_for_soc_target("%", text_to_search_in)
-                        if found_target_soc_in_percentage is not None:
-                            self.log(f"Target SoC from calendar: {found_target_soc_in_percentage} %.")
-                            target_soc = round(float(found_target_soc_in_percentage) / 100 * c.CAR_MAX_CAPACITY_IN_KWH,
-                                               2)
-                    # ToDo: Add possibility to set target in km
-
-                    # Prevent target_soc above max_capacity
-                    if target_soc > c.CAR_MAX_CAPACITY_IN_KWH:
-                        self.log(f"Target SoC from calendar too high: {target_soc}, "
-                                 f"adjusted to {c.CAR_MAX_CAPACITY_IN_KWH}kWh.")
-                        target_soc = c.CAR_MAX_CAPACITY_IN_KWH
-                    elif target_soc < c.CAR_MIN_SOC_IN_KWH:
-                        self.log(f"Target SoC from calendar too low: {target_soc}, "
-                                 f"adjusted to {c.CAR_MIN_SOC_IN_KWH}kWh.")
-                        target_soc = c.CAR_MIN_SOC_IN_KWH
-
-                    # The relaxation window is the period before a calendar item where no
-                    # soc_maxima should be sent to allow the schedule to reach a target higher
-                    # than the CAR_MAX_SOC_IN_KWH.
-                    if target_soc > c.CAR_MAX_SOC_IN_KWH:
-                        window_duration = math.ceil((target_soc - c.CAR_MAX_SOC_IN_KWH) / (c.CHARGER_MAX_CHARGE_POWER / 1000) * 60) + self.WINDOW_SLACK
-                        start_relaxation_window = time_round((target_datetime - timedelta(minutes=window_duration)), resolution)
+            self.log(f"Targets from calendar: {targets}.")
 
         ######## Setting the soc_maxima ##########
-        # The soc_maxima are used to set the boundaries for the charge schedule. They are set per interval (resolution),
-        # and the schedule cannot go above them at that given interval.
-        #
-        # Assume:
-        # CTM  = Charge Target Moment which is the start of the first upcoming calendar item.
-        #        By default if there is no calendar item, the CTM is one week from now. This gives the
-        #        schedule enough freedom for the coming 27 hours (total duration of the schedule).
-        # SRW  = Start of the relaxation window for the CTM, including the slack of 1 hour.
-        #        Only relevant for calendar items with a target SoC above the CAR_MAX_SOC_IN_KWH.
-        #        Relaxation refers to the fact that in this window the schedule does not get soc-maxima so that
-        #        it can charge above the CAR_MAX_SOC_IN_KWH to reach the higher target SoC.
-        #        To keep things simple, the SRW is always based on CAR_MAX_SOC_IN_KWH, even if the current soc is higher.
-        # B2MS = The datetime at which the ALLOWED_DURATION_ABOVE_MAX_SOC ends, it cannot be in the past.
-        #        It serves as a target with a maximum SoC (where regular targets have a minimum).
-        #        The CTM has a higher priority than the B2MS.
-        # EMDW = End of Minimum Discharge Window. Minimum Discharge Window (MDW) = time needed to discharge from current
-        #        SoC to CAR_MAX_SOC_IN_KWH with available discharge power. EMDW = Now + MDW.
-        #        Scenario A: In case of EMDW > B2MS then the latter is extended to EMDW.
-        #
-        # The following scenarios need to be handled, they might in time flow from one into the other:
-        # 0. No B2MS
-        #    The soc-maxima are based on the CAR_MAX_SOC_IN_KWH and run from "now" up to SRW.
-        # 1. NOW < B2MS < SRW < CTM
-        #    The B2MS is not influenced by the first calendar item (or there is none)
-        #    SoC maxima are gradually lowered from current soc until B2MS from where they are set to CAR_MAX_SOC_IN_KWH.
-        #    TODO: A drawback of the gradual approach is that there might be discharging with low power which usually is
-        #          less efficient. So, if the trigger message could handle the concept "only discharge during this window"
-        #          it would result in better schedules. This should then replace the gradually lowered soc_maxima.
-        # 2. NOW < SRW < B2MS < CTM and NOW < SRW < CTM < B2MS
-        #    In this case, the B2MS and CTM do not play a role. The soc-maxima are based on the current SoC and
-        #    run from "now" up to SRW.
-        # 3. SRW < NOW < B2MS < CTM and SRW < NOW < CTM < B2MS
-        #    Here the priority is to reach the CTM and so not soc-maxima.
-        #
-        # Note that the situation where CTM < NOW is not relevant anymore and is covered by scenario 1.
-
-        rounded_now = time_round(self.get_now(), resolution)
-        soc_maxima = []
-
-        if start_relaxation_window < rounded_now:
-            # This is when the target SoC cannot be reached at the calendar-item_start,
-            # Scenario 3.
-            soc_maxima = []
-            self.log("Strategy for soc_maxima: Priority for calendar target (Scenario 3), no soc_maxima.")
-        else:
-            back_to_max_soc = fnc_kwargs["back_to_max_soc"]
-            if isinstance(back_to_max_soc, datetime):
-                # There is a B2MS
-                minimum_discharge_window = math.ceil((current_soc_kwh - c.CAR_MAX_SOC_IN_KWH) / (c.CHARGER_MAX_DIS_CHARGE_POWER / 1000) * 60)
-                end_minimum_discharge_window = time_round((rounded_now - timedelta(minutes=minimum_discharge_window)), resolution)
-                if end_minimum_discharge_window > back_to_max_soc:
-                    # Scenario A.
-                    back_to_max_soc = end_minimum_discharge_window
-                
-                self.log(f"trigger_schedule, back_to_max_soc: '{back_to_max_soc}'.")
-
-                if back_to_max_soc >= start_relaxation_window:
-                    # Scenario 2.
-                    soc_maxima = [
-                        {
-                            "value": current_soc_kwh,
-                            "datetime": dt.isoformat(),
-                        } for dt in [rounded_now + x * resolution for x in range(0, (start_relaxation_window - rounded_now) // resolution) ]
-                    ]
-                    self.log("Strategy for soc_maxima: Maxima current_soc until Start of relaxation window (Scenario 2).")
-                else:
-                    # Scenario 1.
-                    soc_maxima_higher_max_soc = []
-                    number_of_steps = (back_to_max_soc - rounded_now) // resolution
-                    if number_of_steps > 0:
-                        step_kwh = (current_soc_kwh - c.CAR_MAX_SOC_IN_KWH) / number_of_steps
-                        soc_maxima_higher_max_soc += [
-                            {
-                                "value": current_soc_kwh - (i * step_kwh),
-                                "datetime": (rounded_now + i * resolution).isoformat()
-                            } for i in range(number_of_steps)
-                        ]
-                    soc_maxima_original_max_soc = [
-                        {
-                            "value": c.CAR_MAX_SOC_IN_KWH,
-                            "datetime": dt.isoformat(),
-                        } for dt in [back_to_max_soc + x * resolution for x in range(0, (start_relaxation_window - back_to_max_soc) // resolution) ]
-                    ]
-                    soc_maxima = soc_maxima_higher_max_soc + soc_maxima_original_max_soc
-                    self.log(f"Strategy for soc_maxima: Gradually decrease SoC to reach {c.CAR_MAX_SOC_IN_KWH}kWh (Scenario 1).")
-            else:
-                # Scenario 0.
-                soc_maxima = [
-                    {
-                        "value": c.CAR_MAX_SOC_IN_KWH,
-                        "datetime": dt.isoformat(),
-                    } for dt in [rounded_now + x * resolution for x in range(0, (start_relaxation_window - rounded_now) // resolution) ]
-                ]
-                self.log(f"Strategy for soc_maxima: Maxima CAR_MAX_SOC_IN_KWH until Start of relaxation window (Scenario 0).")
+        # The soc_maxima are used to set the boundaries for the charge schedule, see soc_constraints.build_soc_maxima
+        # for an explanation of the scenarios (CTM, SRW, B2MS and EMDW).
+        b2ms_slot = None
+        if isinstance(back_to_max_soc, datetime):
+            b2ms_slot = sc.to_slot(back_to_max_soc, resolution)
+        scenario, soc_maxima = sc.build_soc_maxima(
+            now_slot=now_slot,
+            srw_slot=srw_slot,
+            current_soc_kwh=current_soc_kwh,
+            max_soc_kwh=c.CAR_MAX_SOC_IN_KWH,
+            b2ms_slot=b2ms_slot,
+            max_discharge_power_w=c.CHARGER_MAX_DIS_CHARGE_POWER,
+            resolution=resolution,
+            ramp_step_slots=self.RAMP_SEGMENT_DURATION // resolution,
+        )
+        self.log(f"Strategy for soc_maxima: scenario {scenario}, {len(soc_maxima)} segment(s).")
+        return now_slot, soc_minima, soc_maxima
+
+    def trigger_schedule(self, *args, **fnc_kwargs):
+        """Request a new schedule to be generated by calling the schedule triggering endpoint, while
+        POSTing flex constraints.
+        Return the schedule id for later retrieval of the asynchronously computed schedule.
+        """
+
+        # Prepare the SoC measurement to be sent along with the scheduling request
+        current_soc_kwh = fnc_kwargs["current_soc_kwh"]
+        self.log(f"trigger_schedule called with current_soc_kwh: {current_soc_kwh} kWh.")
+
+        url = self.FM_TIGGER_URL
+        resolution = timedelta(minutes=c.FM_EVENT_RESOLUTION_IN_MINUTES)
+        now_slot, soc_minima, soc_maxima = self.get_soc_constraints(
+            current_soc_kwh, fnc_kwargs["back_to_max_soc"], resolution, fnc_kwargs.get("start", None))
+
+        # Format all constraints in one pass
+        tz = self.get_now().tzinfo
+        soc_maxima = sc.format_segments(soc_maxima, resolution, tz)
+        soc_minima = sc.format_segments(soc_minima, resolution, tz)
 
         message = {
-            "start": soc_datetime,
+            "start": sc.slot_to_datetime(now_slot, resolution, tz).isoformat(),
             "flex-model": {
                 "soc-at-start": current_soc_kwh,
                 "soc-unit": "kWh",
                 "soc-min": c.CAR_MIN_SOC_IN_KWH,
                 "soc-max": c.CAR_MAX_CAPACITY_IN_KWH,
-                "soc-minima": [
-                    {
-                        "value": target_soc,
-                        "datetime": target_datetime.isoformat(),
-                    }
-                ],
+                "soc-minima": soc_minima,
                 "soc-maxima": soc_maxima,
                 "roundtrip-efficiency": c.CHARGER_PLUS_CAR_ROUNDTRIP_EFFICIENCY,
                 "power-capacity": str(c.CHARGER_MAX_CHARGE_POWER) + "W"
@@ -457,8 +640,7 @@ class FlexMeasuresClient(hass.Hass):
             headers={"Authorization": self.fm_token},
         )
 
-        tmp = str(message)
-        self.log(f"Trigger_schedule on url '{url}', with message: '{tmp[0:275]} . . . . . {tmp[-275:]}'.")
+        self.log(f"Trigger_schedule on url '{url}', with message: '{message}'.")
 
         self.check_deprecation_and_sunset(url, res)
 
@@ -471,13 +653,17 @@ class FlexMeasuresClient(hass.Hass):
         if res.status_code == 200:
             schedule_id = res.json()["schedule"]  # can still be None in case something went wong
 
+        # A failing prefetch (with a start) is no problem, the schedule will be requested as usual.
+        is_prefetch = fnc_kwargs.get("start", None) is not None
         if schedule_id is None:
             self.log_failed_response(res, url)
-            self.get_app("v2g_liberty").handle_no_new_schedule("timeouts_on_schedule", True)
+            if not is_prefetch:
+                bus.publish(NoScheduleError("timeouts_on_schedule", True))
             return None
 
         self.log(f"Successfully triggered schedule. Schedule id: {schedule_id}")
-        self.get_app("v2g_liberty").handle_no_new_schedule("timeouts_on_schedule", False)
+        if not is_prefetch:
+            bus.publish(NoScheduleError("timeouts_on_schedule", False))
         return schedule_id
 
     def try_solve_authentication_error(self, res, url, fnc, *fnc_args, **fnc_kwargs):
@@ -489,24 +675,31 @@ class FlexMeasuresClient(hass.Hass):
             fnc(*fnc_args, **fnc_kwargs)
 
 
-# TODO AJO 2022-02-26: would it be better to have this in v2g_liberty module?
-def search_for_soc_target(search_unit: str, string_to_search_in: str) -> int:
-    """Search description for the first occurrence of some (integer) number of the search_unit.
-
-    Parameters:
-        search_unit (int): The unit to search for, typically % or kWh, found directly following the number
-        string_to_search_in (str): The string in which the soc in searched
-    Returns:
-        integer number or None if nothing is found
+def find_calendar_events(response, entity_id: str) -> Optional[list]:
+    """Find the list of events for entity_id in the response of the calendar.get_events service.
 
-    Forgives errors in incorrect capitalization of the unit and missing/double spaces.
+    Depending on the AppDaemon version the service response is wrapped in one or more result dicts.
     """
-    if string_to_search_in is None:
+    if not isinstance(response, dict):
         return None
-    string_to_search_in = string_to_search_in.lower()
-    pattern = re.compile(rf"(?P<quantity>\d+) *{search_unit.lower()}")
-    match = pattern.search(string_to_search_in)
-    if match:
-        return int(float(match.group("quantity")))
-
+    if entity_id in response and isinstance(response[entity_id], dict):
+        return response[entity_id].get("events")
+    for value in response.values():
+        events = find_calendar_events(value, entity_id)
+        if events is not None:
+            return events
     return None
+
+
+def first_event_from_calendar_state(calendar_state: dict) -> list:
+    """The first calendar item from the state of a calendar entity, as a list of (at most) one event."""
+    attributes = calendar_state.get("attributes", {})
+    start = attributes.get("start_time", None)
+    if start is None:
+        return []
+    return [{
+        "start": start,
+        "end": attributes.get("end_time"),
+        "summary": attributes.get("message"),
+        "description": attributes.get("description"),
+    }]
@@ -1,12 +1,20 @@
-from datetime import datetime, timedelta
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
 import json
 import pytz
 import math
 import re
 import requests
+import sqlite3
 import time
 import constants as c
-from typing import AsyncGenerator, List, Optional
+from chart_series import ChartPublisher
+from event_bus import bus, MeteringInterval, ScheduleInputChanged
+from rolling_statistics import RollingStatistics, charged_energy_intervals, energy_contributions, interval_start
+from rollups import Rollups, availability_percentage, daily_totals, day_of
+from series_cache import Series, SeriesCache, series_caches, to_ms
+from series_store import SeriesStore, local_sensor_id, open_store, series_store_path
+from typing import AsyncGenerator, Callable, List, Optional
 
 import appdaemon.plugins.hass.hassapi as hass
 import isodate
@@ -24,25 +32,69 @@ class FlexMeasuresDataImporter(hass.Hass):
 
     # Variables
     fm_token: str
+    # From the (expected) publication time of the data for tomorrow until the last poll time, FM is checked every
+    # PUBLICATION_POLL_INTERVAL with a small request for new data, until the data for tomorrow is there.
     first_try_time_price_data: str
-    second_try_time_price_data: str
+    last_poll_time_price_data: str
 
     first_try_time_emissions_data: str
-    second_try_time_emissions_data: str
-
-    # Emissions /kwh in the last 7 days to now. Populated by a call to FM.
+    last_poll_time_emissions_data: str
+
+    PUBLICATION_POLL_INTERVAL: int = 10 * 60  # number of seconds
+    # Timer of the next poll, per url
+    poll_timer_handles: dict
+
+    # Totals over the last 7 days, updated with each interval concluded by set_fm_data (MeteringInterval events)
+    # and reconciled with the data from FM when that is retrieved.
+    STATISTICS_WINDOW: timedelta = timedelta(days=7)
+    energy_statistics: RollingStatistics
+    cost_statistics: RollingStatistics
+
+    # Totals per day and per month (for "this month" and "last 12 months"), updated with each interval concluded
+    # by set_fm_data. The days of which FM revises the data are re-rolled from the series store.
+    rollups: Rollups
+
+    # Independent sensor fetches run concurrently, at most MAX_PARALLEL_FETCHES at a time,
+    # over the connection pool of a shared session.
+    MAX_PARALLEL_FETCHES: int = 4
+    session: requests.Session
+    fetch_pool: ThreadPoolExecutor
+
+    # Local copies of the FM sensor data, per sensor. Only events after the last one held (minus the
+    # SERIES_REVISION_OVERLAP) are fetched and merged into the cache.
+    # The caches are shared per sensor in the process (see series_caches): when two of them are the same sensor
+    # (e.g. the prices and emissions of a provider that uses one sensor for both) it is downloaded once.
+    prices_cache: SeriesCache
+    emissions_cache: SeriesCache
+    charging_cost_cache: SeriesCache
+    charge_power_cache: SeriesCache
+    SERIES_REVISION_OVERLAP: timedelta = timedelta(hours=2)
+    # The caches write through to the local store, which keeps the data for SERIES_RETENTION.
+    series_store: SeriesStore
+    SERIES_RETENTION: timedelta = timedelta(days=400)
+
+    # Publishes the prices and emissions for the chart in the UI, trimmed to the part of the data the chart shows.
+    # The view window of the chart in the dashboard starts 4 hours before now and spans 24 hours.
+    charts: ChartPublisher
+    CHART_REFRESH_INTERVAL: int = 60 * 60  # number of seconds
+
+    # Emissions /kwh in the last 7 days to now, the values of emissions_cache.
     # Used for:
     # + Intermediate storage to fill an entity for displaying the data in the graph
     # + Calculation of the emmision (savings) in the last 7 days.
     emission_intensities: dict
 
+    # Consumption prices in €/MWh (as in FM, without VAT/markup) from the start of yesterday, the values of
+    # prices_cache. Used, together with emission_intensities, as signal for the local scheduler.
+    consumption_prices: dict
+
     def initialize(self):
         """Daily get EPEX prices, emissions and cost data for display in the UI.
 
         Try to get EPEX price data from the FM server on a daily basis.
         Normally the prices are available around 14:35.
-        When this fails retry at 18:30. These times are related to the
-        attempts in the server for retrieving EPEX price data.
+        Until they are there, check every 10 minutes (with a small request for new prices) until 18:30.
+        These times are related to the attempts in the server for retrieving EPEX price data.
 
         The retrieved data is written to the HA input_text.epex_prices,
         HA handles this to render the price data in the UI (chart).
@@ -68,33 +120,104 @@ class FlexMeasuresDataImporter(hass.Hass):
         self.CHARGING_COST_URL = c.FM_GET_DATA_URL + str(c.FM_ACCOUNT_COST_SENSOR_ID) + c.FM_GET_DATA_SLUG
         self.CHARGE_POWER_URL = c.FM_GET_DATA_URL + str(c.FM_ACCOUNT_POWER_SENSOR_ID) + c.FM_GET_DATA_SLUG
 
+        self.session = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_maxsize=self.MAX_PARALLEL_FETCHES)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+        self.fetch_pool = ThreadPoolExecutor(max_workers=self.MAX_PARALLEL_FETCHES,
+                                             thread_name_prefix="get_fm_data")
+
+        # The caches are filled from the local store, so after a restart only the events since the last run
+        # are fetched.
+        self.series_store = open_store(series_store_path(self.args, self.config_dir))
+        week = timedelta(days=7)
+        self.prices_cache = self.create_series_cache(c.FM_PRICE_CONSUMPTION_SENSOR_ID, timedelta(days=1), "prices")
+        self.emissions_cache = self.create_series_cache(c.FM_EMISSIONS_SENSOR_ID, week, "emissions")
+        self.charging_cost_cache = self.create_series_cache(c.FM_ACCOUNT_COST_SENSOR_ID, week, "charging cost")
+        self.charge_power_cache = self.create_series_cache(c.FM_ACCOUNT_POWER_SENSOR_ID, week, "charge power")
+        self.consumption_prices = self.prices_cache.values
+        self.emission_intensities = self.emissions_cache.values
+
+        self.charts = ChartPublisher(
+            set_state=self.set_state,
+            view_before=timedelta(hours=float(self.args.get("chart_view_hours_before_now", 4))),
+            view_duration=timedelta(hours=float(self.args.get("chart_view_hours", 24))),
+            max_points=int(self.args.get("chart_max_points", 200)),
+        )
+        # The view window slides, the charts are re-trimmed (only written if that changes them)
+        self.run_every(self.refresh_charts, f"now+{self.CHART_REFRESH_INTERVAL}", self.CHART_REFRESH_INTERVAL)
+
+        window = int(self.STATISTICS_WINDOW.total_seconds() * 1000)
+        self.energy_statistics = RollingStatistics(window)
+        self.cost_statistics = RollingStatistics(window)
+
+        try:
+            self.rollups = Rollups(self.series_store)
+            if self.rollups.is_empty():
+                # First run with rollups: roll up the history that is in the store
+                self.reroll_stored_days(self.get_now())
+        except sqlite3.Error as e:
+            self.log(f"Could not read the rollups from the series store: {e}.")
+            self.rollups = Rollups(None)
+        self.publish_rollups(self.get_now())
+
         # Price data should normally be available just after 13:00 when data can be
         # retrieved from its original source (ENTSO-E) but sometimes there is a delay of several hours.
+        self.poll_timer_handles = {}
         self.first_try_time_price_data = "14:32:00"
-        self.second_try_time_price_data = "18:32:00"
+        self.last_poll_time_price_data = "18:32:00"
         self.run_daily(self.daily_kickoff_price_data, self.first_try_time_price_data)
-        # At init also run this as (re-) start is not always around self.first_try_time
-        self.daily_kickoff_price_data()
 
-        self.emission_intensities = {}
         self.first_try_time_emissions_data = "15:16:17"
-        self.second_try_time_emissions_data = "19:18:17"
+        self.last_poll_time_emissions_data = "19:18:17"
         self.run_daily(self.daily_kickoff_emissions_data, self.first_try_time_emissions_data)
-        # At init also run this as (re-) start is not always around self.first_try_time
-        self.daily_kickoff_emissions_data()
 
         self.GET_CHARGING_DATA_AT = "01:15:00"
         self.run_daily(self.daily_kickoff_charging_data, self.GET_CHARGING_DATA_AT)
-        # At init also run this as (re-) start is not always around self.first_try_time
-        self.daily_kickoff_charging_data()
+
+        # At init also get all data as (re-) start is not always around the daily times
+        self.kickoff_all_data()
+        bus.subscribe(MeteringInterval, self, self.handle_metering_interval)
 
         self.log(
             f"Completed initializing FlexMeasuresDataImporter: check daily at {self.first_try_time_price_data} for new price data with FM.")
 
+    def terminate(self):
+        self.fetch_pool.shutdown(wait=False)
+        self.session.close()
+
+    def kickoff_all_data(self):
+        """ Get all data at once: fetch concurrently, then process in order.
+
+        The emissions are processed before the charged energy, as its totals need the emission intensities.
+        """
+        now = self.get_now()
+        self.authenticate_with_fm()
+        responses = self.fetch_in_parallel({
+            "prices": lambda: self.fetch_epex_prices(now),
+            "emissions": lambda: self.fetch_emission_intensities(now),
+            "charging cost": lambda: self.fetch_charging_cost(now),
+            "charge power": lambda: self.fetch_charged_energy(now),
+        })
+        self.process_epex_prices(responses["prices"], now)
+        self.process_emission_intensities(responses["emissions"], now)
+        self.process_charging_cost(responses["charging cost"], now)
+        self.process_charged_energy(responses["charge power"], now)
+
     def daily_kickoff_charging_data(self, *args):
         """ This sets off the daily routine to check for charging cost."""
-        self.get_charging_cost()
-        self.get_charged_energy()
+        try:
+            self.series_store.delete_before(to_ms(self.get_now() - self.SERIES_RETENTION))
+        except sqlite3.Error as e:
+            self.log(f"Could not apply retention to the series store: {e}.")
+        now = self.get_now()
+        self.authenticate_with_fm()
+        responses = self.fetch_in_parallel({
+            "charging cost": lambda: self.fetch_charging_cost(now),
+            "charge power": lambda: self.fetch_charged_energy(now),
+        })
+        self.process_charging_cost(responses["charging cost"], now)
+        self.process_charged_energy(responses["charge power"], now)
 
     def daily_kickoff_price_data(self, *args):
         """ This sets off the daily routine to check for new prices."""
@@ -111,6 +234,146 @@ class FlexMeasuresDataImporter(hass.Hass):
         except json.decoder.JSONDecodeError:
             self.log(f"{endpoint} failed ({res.status_code}) with response {res}")
 
+    def fetch_in_parallel(self, fetches: dict) -> dict:
+        """Run independent fetches concurrently in the fetch pool and wait for all of them.
+
+        The fetches only do the requests and update their own cache, processing the results (e.g. setting
+        entities in HA) is left to the caller, in the thread of the app.
+
+        Parameters:
+            fetches (dict): callables without arguments that return a response, by name
+        Returns:
+            Dict of the responses by name, None for a fetch that failed.
+        """
+        futures = {name: self.fetch_pool.submit(fetch) for name, fetch in fetches.items()}
+        responses = {}
+        for name, future in futures.items():
+            try:
+                responses[name] = future.result()
+            except Exception as e:
+                # One failing fetch (e.g. an unexpected response) should not keep the others from being processed.
+                self.log(f"Fetching {name} failed: {e}")
+                responses[name] = None
+        return responses
+
+    def create_series_cache(self, sensor_id: int, window: timedelta, consumer: str) -> SeriesCache:
+        """The (shared) cache for the data of an FM sensor, it covers (at least) the window for consumer."""
+        return series_caches.open(self.series_store, sensor_id, self.SERIES_REVISION_OVERLAP, consumer,
+                                  start_of_day(self.get_now() - window))
+
+    def update_series(self, cache: SeriesCache, url: str, now: datetime, consumer: str, window_start: datetime,
+                      window_end: Optional[datetime] = None, keep: Optional[Callable[[Series], List[bool]]] = None):
+        """Fetch the events that are not in the cache (yet) from FM and merge them into the cache.
+
+        When another consumer of the sensor is refreshing the cache at the same time, its response is used
+        instead of downloading the same data again.
+
+        Parameters:
+            cache (SeriesCache): the cache of the sensor the url is for
+            url (str): the FM url to get the sensor data
+            now (datetime): the current time
+            consumer (str): name of the code path the data is for, e.g. "prices"
+            window_start (datetime): start of the period consumer needs, values before the windows of all
+                                     consumers of the cache are removed
+            window_end (datetime): optional end of the period the cache should cover
+            keep (callable): optional filter, returns a mask of the events of the fetched series to cache
+        Returns:
+            The response of FM, the cache is only updated if the request succeeded (status 200).
+            Status 304 means the data has not changed since the same request was made last.
+        """
+        series_caches.touch(cache)
+        cache.request_window(consumer, window_start)
+        return cache.refresh(lambda: self.download_series(cache, url, now, window_end, keep))
+
+    def download_series(self, cache: SeriesCache, url: str, now: datetime, window_end: Optional[datetime],
+                        keep: Optional[Callable[[Series], List[bool]]]) -> requests.Response:
+        """Fetch the new events for the window of the cache and merge them into the cache, see update_series."""
+        window_start = datetime.fromtimestamp(cache.window_start / 1000, tz=now.tzinfo)
+        fetch_start = cache.fetch_start(window_start, now)
+        url_params = {
+            "event_starts_after": fetch_start.isoformat(),
+        }
+        if window_end is not None:
+            url_params["event_ends_before"] = window_end.isoformat()
+
+        headers = {"Authorization": self.fm_token}
+        headers.update(cache.conditional_headers(url_params))
+        res = self.session.get(
+            url,
+            params=url_params,
+            headers=headers,
+        )
+        if res.status_code != 200:
+            return res
+        cache.remember_validators(url_params, res.headers)
+
+        series = Series.from_events(res.json())
+        if keep is not None:
+            series = series.select(keep(series))
+        cache.trim()
+        try:
+            cache.merge(series.to_dict(), fetch_start, window_end)
+        except sqlite3.Error as e:
+            self.log(f"Could not write series {cache.sensor_id} to the store: {e}.")
+        return res
+
+    def probe_series(self, cache: SeriesCache, url: str) -> Optional[bool]:
+        """Check with a small request whether FM has events after the last one in the cache.
+
+        Returns:
+            True if there are new events, False if not and None if the check failed.
+        """
+        last_event_start = cache.last_event_start
+        if last_event_start is None:
+            return True
+        after = datetime.fromtimestamp(last_event_start / 1000, tz=self.get_now().tzinfo) + timedelta(seconds=1)
+        res = self.session.get(
+            url,
+            params={"event_starts_after": after.isoformat()},
+            headers={"Authorization": self.fm_token},
+        )
+        if res.status_code == 401:
+            # Probably the token expired, the next poll uses a new one.
+            self.authenticate_with_fm()
+            return None
+        if res.status_code != 200:
+            self.log_failed_response(res, f"Probe {url}")
+            return None
+        return any(event['event_value'] is not None for event in res.json())
+
+    def plan_poll(self, fetch: Callable, cache: SeriesCache, url: str, first_try_time: str,
+                  last_poll_time: str) -> bool:
+        """Check FM for new data after PUBLICATION_POLL_INTERVAL, if that is still in the publication window.
+
+        Parameters:
+            fetch (callable): method that fetches and processes the data, called when there is new data
+            cache (SeriesCache): the cache of the data
+            url (str): the FM url to get the data
+            first_try_time (str): start of the publication window
+            last_poll_time (str): end of the publication window
+        Returns:
+            False if the window has passed (or not started yet), then no poll is planned.
+        """
+        if not self.now_is_between(first_try_time, last_poll_time):
+            return False
+        self.cancel_timer(self.poll_timer_handles.get(url), True)
+        self.poll_timer_handles[url] = self.run_in(
+            self.poll_for_new_data, self.PUBLICATION_POLL_INTERVAL,
+            fetch=fetch, cache=cache, url=url, first_try_time=first_try_time, last_poll_time=last_poll_time,
+        )
+        return True
+
+    def poll_for_new_data(self, kwargs):
+        """Fetch the data if FM has new events, otherwise plan the next poll."""
+        url = kwargs["url"]
+        self.poll_timer_handles.pop(url, None)
+        if self.probe_series(kwargs["cache"], url):
+            kwargs["fetch"]()
+            return
+        if not self.plan_poll(kwargs["fetch"], kwargs["cache"], url, kwargs["first_try_time"],
+                              kwargs["last_poll_time"]):
+            self.log(f"No new data from {url} in the publication window, check again at {kwargs['first_try_time']}.")
+
     def get_charging_cost(self, *args, **kwargs):
         """ Communicate with FM server and check the results.
 
@@ -120,20 +383,18 @@ class FlexMeasuresDataImporter(hass.Hass):
         """
         now = self.get_now()
         self.authenticate_with_fm()
+        self.process_charging_cost(self.fetch_charging_cost(now), now, *args, **kwargs)
 
+    def fetch_charging_cost(self, now: datetime) -> requests.Response:
+        """Fetch the charging costs of the last 7 days into the cache, can run in the fetch pool."""
         # Getting data since a week ago so that user can look back a further than just current window.
-        dt = str(now + timedelta(days=-7))
-        start = dt[:10] + "T00:00:00" + dt[-6:]
+        start = start_of_day(now + timedelta(days=-7))
+        return self.update_series(self.charging_cost_cache, self.CHARGING_COST_URL, now, "charging cost", start)
 
-        url_params = {
-            "event_starts_after": start,
-        }
-
-        res = requests.get(
-            self.CHARGING_COST_URL,
-            params=url_params,
-            headers={"Authorization": self.fm_token},
-        )
+    def process_charging_cost(self, res: Optional[requests.Response], now: datetime, *args, **kwargs):
+        """Make the (cached) charging costs available in HA, res is the response to fetch_charging_cost."""
+        if res is None:
+            return
 
         # Authorisation error, retry
         if res.status_code == 401:
@@ -141,27 +402,36 @@ class FlexMeasuresDataImporter(hass.Hass):
             self.try_solve_authentication_error(res, self.CHARGING_COST_URL, self.get_charging_cost, *args, **kwargs)
             return
 
-        if res.status_code != 200:
+        if res.status_code not in (200, 304):
             self.log_failed_response(res, "Get FM CHARGING COST data")
             # Currently there is no reason to retry as the server will not re-run scheduled script for cost calculation
-        charging_costs = res.json()
-
-        total_charging_cost_last_7_days = 0
-        charging_cost_points = []
-        for charging_cost in charging_costs:
-            data_point = {}
-            data_point['time'] = datetime.fromtimestamp(charging_cost['event_start'] / 1000).isoformat()
-            data_point['cost'] = round(float(charging_cost['event_value']), 2)
-            total_charging_cost_last_7_days += data_point['cost']
-            charging_cost_points.append(data_point)
-        total_charging_cost_last_7_days = round(total_charging_cost_last_7_days, 2)
-        self.log(f"Cost data: {charging_cost_points}, total costs: {total_charging_cost_last_7_days}")
+            # The cached costs are shown
+
+        series = self.charging_cost_cache.series()
+        costs = [round(float(cost), 2) for cost in series.values]
+        charging_cost_points = series.records("cost", costs)
+        self.log(f"Cost data: {charging_cost_points}")
 
         # To make sure HA considers this as new info a datetime is added
         new_state = "Costs collected at " + now.isoformat()
         result = {}
         result['records'] = charging_cost_points
         self.set_state("input_text.charging_costs", state=new_state, attributes=result)
+
+        # The costs from FM replace the estimates of the intervals they cover
+        resolution = self.charging_cost_cache.resolution or 24 * 60 * 60 * 1000
+        if len(series) > 0:
+            self.cost_statistics.reconcile(
+                intervals=[(event_start, {"cost": cost}) for event_start, cost in zip(series.event_starts, costs)],
+                until=series.event_starts[-1] + resolution,
+                now=to_ms(now),
+            )
+        self.publish_cost_statistics()
+        self.reroll_revised_days(now)
+
+    def publish_cost_statistics(self):
+        """Make the total of the costs over the last 7 days available in HA."""
+        total_charging_cost_last_7_days = round(self.cost_statistics.total("cost"), 2)
         self.set_value("input_number.total_charging_cost_last_7_days", total_charging_cost_last_7_days)
 
     def get_charged_energy(self, *args, **kwargs):
@@ -173,93 +443,180 @@ class FlexMeasuresDataImporter(hass.Hass):
 
         """
         now = self.get_now()
-        # Getting data since start of yesterday so that user can look back a little further than just current window.
+        self.authenticate_with_fm()
+        self.process_charged_energy(self.fetch_charged_energy(now), now, *args, **kwargs)
 
-        dt = str(now + timedelta(days=-7))
-        startDataPeriod = dt[:10] + "T00:00:00" + dt[-6:]
-        dt = str(now)
-        endDataPeriod = dt[:10] + "T00:00:00" + dt[-6:]
+    def fetch_charged_energy(self, now: datetime) -> requests.Response:
+        """Fetch the charge power of the last 7 days into the cache, can run in the fetch pool."""
+        # Getting data since a week ago up to now, the rolling statistics continue from there.
+        start_data_period = start_of_day(now + timedelta(days=-7))
+        # The API returns both actual and scheduled power, ignore the values from the schedules
+        return self.update_series(self.charge_power_cache, self.CHARGE_POWER_URL, now, "charge power",
+                                  start_data_period, window_end=now,
+                                  keep=lambda series: [t != "scheduler" for t in series.source_types])
 
-        url_params = {
-            "event_starts_after": startDataPeriod,
-            "event_ends_before": endDataPeriod,
-        }
+    def process_charged_energy(self, res: Optional[requests.Response], now: datetime, *args, **kwargs):
+        """Make the totals of the (cached) charge power available in HA, res is the response to fetch_charged_energy.
 
-        res = requests.get(
-            self.CHARGE_POWER_URL,
-            params=url_params,
-            headers={"Authorization": self.fm_token},
-        )
+        The emission intensities need to be up-to-date, they are used for the emission totals.
+        """
+        if res is None:
+            return
 
         # Authorisation error, retry
         if res.status_code == 401:
             self.log_failed_response(res, "Get FM CHARGE POWER")
-            self.try_solve_authentication_error(res, self.CHARGE_POWER_URL, self.get_charging_energy, *args, **kwargs)
+            self.try_solve_authentication_error(res, self.CHARGE_POWER_URL, self.get_charged_energy, *args, **kwargs)
             return
 
-        if res.status_code != 200:
+        if res.status_code not in (200, 304):
             self.log_failed_response(res, "Get FM CHARGE POWER")
             # Currently there is no reason to retry as the server will not re-run scheduled script for cost calculation
-        charge_power_points = res.json()
-
-        total_charged_energy_last_7_days = 0
-        total_discharged_energy_last_7_days = 0
-        total_emissions_last_7_days = 0
-        total_saved_emissions_last_7_days = 0
-        total_minutes_charged = 0
-        total_minutes_discharged = 0
-        charging_energy_points = {}
-        resolution_in_miliseconds = c.FM_EVENT_RESOLUTION_IN_MINUTES * 60 * 1000
-
-        for charge_power in charge_power_points:
-            # The API returns both actual and scheduled power, ignore the values from the schedules
-            if charge_power['source']['type'] == "scheduler":
-                continue
-
-            power = float(charge_power['event_value'])
-            key = charge_power['event_start']
-            charging_energy_points[key] = power
-            if power is None:
-                continue
-
-            # Look up the emission matching with power['event_start'], this will be a match every 3 items
-            # as emission has a resolution of 15 minutes and power of 5 min.
-            # ToDo: check if resolutions match X times, if not, raise an error.
-            emission_intensity = 0
-            i = 0
-            while i < 3:
-                em = self.emission_intensities.get(key, None)
-                if em is None:
-                    # Try a resolution step (5 min.) earlier
-                    key -= resolution_in_miliseconds
-                    i += 1
-                else:
-                    emission_intensity = em
-                    break
-
-            if power < 0:
-                # Strangely we add power to energy... this is practical, we later convert this to energy.
-                total_discharged_energy_last_7_days += power
-                total_minutes_discharged += c.FM_EVENT_RESOLUTION_IN_MINUTES
-                # We strangely add 5 min. periods as if they are hours, we later converty this
-                total_saved_emissions_last_7_days += power * emission_intensity
-            elif power > 0:
-                # Strangely we add power to energy... this is practical, we later convert this to energy.
-                total_charged_energy_last_7_days += power
-                total_minutes_charged += c.FM_EVENT_RESOLUTION_IN_MINUTES
-                # We strangely add 5 min. periods as if they are hours, we later converty this
-                total_emissions_last_7_days += power * emission_intensity
-
-        # Convert the returned average power in MW over event_resolution ( 5 minutes)
-        # periods to kWh *1000/12 to energy in kWh
-        conversionfactor = 1000 / (60 / c.FM_EVENT_RESOLUTION_IN_MINUTES)
-        total_discharged_energy_last_7_days = int(round(total_discharged_energy_last_7_days * conversionfactor, 0))
-        total_charged_energy_last_7_days = int(round(total_charged_energy_last_7_days * conversionfactor, 0))
-
-        # Convert the returned average MW * kg/MWh over event_resolution (5 minutes) periods to kg (/12)
-        conversionfactor = 1 / (60 / c.FM_EVENT_RESOLUTION_IN_MINUTES)
-        total_saved_emissions_last_7_days = round(total_saved_emissions_last_7_days * conversionfactor, 1)
-        total_emissions_last_7_days = round(total_emissions_last_7_days * conversionfactor, 1)
+            # The totals are calculated from the cached values
+
+        default_resolution = c.FM_EVENT_RESOLUTION_IN_MINUTES * 60 * 1000
+        series_caches.touch(self.emissions_cache)
+        intervals = charged_energy_intervals(self.charge_power_cache.values, self.emission_intensities,
+                                             default_resolution=default_resolution)
+        if len(intervals) > 0:
+            # The data from FM replaces the (live) intervals it covers
+            resolution = self.charge_power_cache.resolution or default_resolution
+            self.energy_statistics.reconcile(intervals, until=intervals[-1][0] + resolution, now=to_ms(now))
+        self.publish_energy_statistics()
+        self.reroll_revised_days(now)
+
+    def handle_metering_interval(self, event: MeteringInterval):
+        """Add an interval concluded by set_fm_data to the rolling statistics.
+
+        The emissions and (estimated) cost of the interval are based on the cached emission intensities and
+        prices. An interval that is already covered by data from FM is ignored.
+        """
+        for cache in (self.charge_power_cache, self.emissions_cache, self.prices_cache, self.charging_cost_cache):
+            series_caches.touch(cache)
+        duration = c.FM_EVENT_RESOLUTION_IN_MINUTES * 60 * 1000
+        start = interval_start(to_ms(event.end), duration)
+        end = start + duration
+        power = event.power
+
+        day = day_of(start, event.end.tzinfo)
+        minutes = duration / (60 * 1000)
+        rollup = {"metered_minutes": minutes, "available_minutes": minutes * event.availability / 100}
+
+        if start >= self.covered_until(self.charge_power_cache, duration):
+            emission_intensity = self.emissions_cache.value_at(start)
+            emission_intensity = 0.0 if emission_intensity is None else float(emission_intensity)
+            contributions = energy_contributions(power, duration, emission_intensity)
+            self.energy_statistics.add(start, contributions, end)
+            rollup.update(contributions)
+            self.publish_energy_statistics()
+
+        price = self.prices_cache.value_at(start)
+        if price is not None and start >= self.covered_until(self.charging_cost_cache, 24 * 60 * 60 * 1000):
+            # From average MW to kWh
+            energy = power * duration / (60 * 60 * 1000) * 1000
+            cost = energy * self.price_per_kwh(float(price))
+            self.cost_statistics.add(start, {"cost": cost}, end)
+            rollup["cost"] = cost
+            self.publish_cost_statistics()
+
+        try:
+            self.rollups.add(day, rollup)
+        except sqlite3.Error as e:
+            self.log(f"Could not write the rollups to the series store: {e}.")
+        self.publish_rollups(event.end)
+
+    def price_per_kwh(self, price: float) -> float:
+        """A consumption price from FM in €/MWh as €/kWh, with markup and VAT (as shown in the UI)."""
+        return ((price / 10) + self.MARKUP) * self.VAT / 100
+
+    def reroll_revised_days(self, now: datetime):
+        """Re-roll the (past) days of which data has been revised or added by FM since the last call."""
+        revisions = set()
+        for cache in (self.charge_power_cache, self.charging_cost_cache, self.emissions_cache, self.prices_cache):
+            revisions.update(cache.take_revisions())
+        # Forecasts (e.g. of emissions) do not affect the rollups until their day has come
+        today = now.date()
+        days = {day for day in (day_of(event_start, now.tzinfo) for event_start in revisions) if day <= today}
+        if len(days) > 0:
+            self.reroll_days(days, now)
+
+    def reroll_stored_days(self, now: datetime):
+        """Roll up all days of which the store has (charge power) data."""
+        event_starts = set(self.series_store.get_range(c.FM_ACCOUNT_POWER_SENSOR_ID))
+        event_starts.update(self.series_store.get_range(local_sensor_id(c.FM_ACCOUNT_POWER_SENSOR_ID)))
+        today = now.date()
+        days = {day for day in (day_of(event_start, now.tzinfo) for event_start in event_starts) if day <= today}
+        if len(days) > 0:
+            self.reroll_days(days, now)
+
+    def reroll_days(self, days: set, now: datetime):
+        """Replace the rollups of days by totals computed from the data in the series store."""
+        # The range is padded with a day on both sides, so it covers the local days in any timezone
+        first_day, last_day = min(days), max(days)
+        start = to_ms(datetime(first_day.year, first_day.month, first_day.day, tzinfo=timezone.utc) - timedelta(days=1))
+        end = to_ms(datetime(last_day.year, last_day.month, last_day.day, tzinfo=timezone.utc) + timedelta(days=2))
+        try:
+            stored = {
+                sensor_id: self.series_store.get_range(sensor_id, start, end)
+                for sensor_id in (c.FM_ACCOUNT_POWER_SENSOR_ID, c.FM_ACCOUNT_AVAILABILITY_SENSOR_ID,
+                                  c.FM_ACCOUNT_COST_SENSOR_ID, c.FM_EMISSIONS_SENSOR_ID,
+                                  c.FM_PRICE_CONSUMPTION_SENSOR_ID)
+            }
+            # The local metering fills in the intervals that have not been sent to (or processed by) FM yet
+            for sensor_id in (c.FM_ACCOUNT_POWER_SENSOR_ID, c.FM_ACCOUNT_AVAILABILITY_SENSOR_ID):
+                local_values = self.series_store.get_range(local_sensor_id(sensor_id), start, end)
+                local_values.update(stored[sensor_id])
+                stored[sensor_id] = local_values
+            totals = daily_totals(
+                power_values=stored[c.FM_ACCOUNT_POWER_SENSOR_ID],
+                availabilities=stored[c.FM_ACCOUNT_AVAILABILITY_SENSOR_ID],
+                costs=stored[c.FM_ACCOUNT_COST_SENSOR_ID],
+                emission_intensities=stored[c.FM_EMISSIONS_SENSOR_ID],
+                prices=stored[c.FM_PRICE_CONSUMPTION_SENSOR_ID],
+                price_per_kwh=self.price_per_kwh,
+                tz=now.tzinfo,
+                default_resolution=c.FM_EVENT_RESOLUTION_IN_MINUTES * 60 * 1000,
+            )
+            self.rollups.replace_days({day: totals.get(day, {}) for day in days})
+        except sqlite3.Error as e:
+            self.log(f"Could not re-roll {len(days)} days in the series store: {e}.")
+            return
+        self.log(f"Re-rolled {len(days)} days, from {min(days)} to {max(days)}.")
+        self.publish_rollups(now)
+
+    def publish_rollups(self, now: datetime):
+        """Make the totals of this month and of the last 12 months (including this month) available in HA."""
+        today = now.date()
+        for period, totals in (("this_month", self.rollups.month_totals(today)),
+                               ("last_12_months", self.rollups.last_months_totals(today))):
+            self.set_value(f"input_number.total_charged_energy_{period}",
+                           int(round(totals.get("charged_energy", 0), 0)))
+            self.set_value(f"input_number.total_discharged_energy_{period}",
+                           int(round(totals.get("discharged_energy", 0), 0)))
+            self.set_value(f"input_number.total_charging_cost_{period}", round(totals.get("cost", 0), 2))
+            self.set_value(f"input_number.total_emissions_{period}", round(totals.get("emissions", 0), 1))
+            self.set_value(f"input_number.total_saved_emissions_{period}",
+                           round(totals.get("saved_emissions", 0), 1))
+            availability = availability_percentage(totals)
+            self.set_value(f"input_number.availability_{period}",
+                           0 if availability is None else round(availability, 1))
+
+    def covered_until(self, cache: SeriesCache, default_resolution: int) -> int:
+        """The end (in ms) of the data of the cache, 0 if it is empty."""
+        last_event_start = cache.last_event_start
+        if last_event_start is None:
+            return 0
+        return last_event_start + (cache.resolution or default_resolution)
+
+    def publish_energy_statistics(self):
+        """Make the totals of energy, time and emissions over the last 7 days available in HA."""
+        totals = self.energy_statistics
+        total_charged_energy_last_7_days = int(round(totals.total("charged_energy"), 0))
+        total_discharged_energy_last_7_days = int(round(totals.total("discharged_energy"), 0))
+        total_emissions_last_7_days = round(totals.total("emissions"), 1)
+        total_saved_emissions_last_7_days = round(totals.total("saved_emissions"), 1)
+        total_minutes_charged = int(round(totals.total("charged_minutes")))
+        total_minutes_discharged = int(round(totals.total("discharged_minutes")))
 
         self.set_value("input_number.total_discharged_energy_last_7_days", total_discharged_energy_last_7_days)
         self.set_value("input_number.total_charged_energy_last_7_days", total_charged_energy_last_7_days)
@@ -290,18 +647,19 @@ class FlexMeasuresDataImporter(hass.Hass):
         """
         now = self.get_now()
         self.authenticate_with_fm()
+        self.process_epex_prices(self.fetch_epex_prices(now), now, *args, **kwargs)
+
+    def fetch_epex_prices(self, now: datetime) -> requests.Response:
+        """Fetch the prices from the start of yesterday into the cache, can run in the fetch pool."""
         # Getting prices since start of yesterday so that user can look back a little further than just current window.
-        dt = str(now + timedelta(days=-1))
-        start_data_period = dt[:10] + "T00:00:00" + dt[-6:]
+        start_data_period = start_of_day(now + timedelta(days=-1))
+        return self.update_series(self.prices_cache, self.PRICES_URL, now, "prices", start_data_period,
+                                  keep=lambda series: [v is not None for v in series.values])
 
-        url_params = {
-            "event_starts_after": start_data_period,
-        }
-        res = requests.get(
-            self.PRICES_URL,
-            params=url_params,
-            headers={"Authorization": self.fm_token},
-        )
+    def process_epex_prices(self, res: Optional[requests.Response], now: datetime, *args, **kwargs):
+        """Make the (cached) prices available in HA, res is the response to fetch_epex_prices."""
+        if res is None:
+            return
 
         # Authorisation error, retry
         if res.status_code == 401:
@@ -309,13 +667,11 @@ class FlexMeasuresDataImporter(hass.Hass):
             self.try_solve_authentication_error(res, self.PRICES_URL, self.get_epex_prices, *args, **kwargs)
             return
 
-        if res.status_code != 200:
+        if res.status_code not in (200, 304):
             self.log_failed_response(res, "Get FM EPEX data")
 
-            # Only retry once at second_try_time.
-            if self.now_is_between(self.first_try_time_price_data, self.second_try_time_price_data):
-                self.log(f"Retry at {self.second_try_time_price_data}.")
-                self.run_at(self.get_epex_prices, self.second_try_time_price_data)
+            if self.plan_poll_for_prices():
+                self.log(f"Retry in {self.PUBLICATION_POLL_INTERVAL} seconds.")
             else:
                 self.log(f"Retry tomorrow.")
                 self.get_app("v2g_liberty").notify_user(
@@ -328,36 +684,33 @@ class FlexMeasuresDataImporter(hass.Hass):
                 )
             return
 
-        prices = res.json()
-
         # From FM format (€/MWh) to user desired format (€ct/kWh)
         # = * 100/1000 = 1/10.
         conversion = 1 / 10
 
-        epex_price_points = []
-        has_negative_prices = False
-        for price in prices:
-            data_point = {}
-            data_point['time'] = datetime.fromtimestamp(price['event_start'] / 1000).isoformat()
-            data_point['price'] = round(((price['event_value'] * conversion) + self.MARKUP) * self.VAT, 2)
-            if data_point['price'] < 0:
-                has_negative_prices = True
-            epex_price_points.append(data_point)
+        series = self.prices_cache.series()
+        prices = [round(((price * conversion) + self.MARKUP) * self.VAT, 2) for price in series.values]
+        has_negative_prices = any(price < 0 for price in prices)
 
-        # To make sure HA considers this as new info a datetime is added
-        new_state = "EPEX prices collected at " + now.isoformat()
-        result = {}
-        result['records'] = epex_price_points
-        self.set_state("input_text.epex_prices", state=new_state, attributes=result)
+        # Only written if the part of the prices the chart shows has changed
+        self.charts.publish("input_text.epex_prices", "price", series, prices,
+                            state="EPEX prices collected at " + now.isoformat(), now=now)
 
         # FM returns all the prices it has, sometimes it has not retrieved new
         # prices yet, than it communicates the prices it does have.
-        date_latest_price = datetime.fromtimestamp(prices[-1].get('event_start') / 1000).isoformat()
+        if self.prices_cache.last_event_start is None:
+            date_latest_price = None
+        else:
+            date_latest_price = datetime.fromtimestamp(self.prices_cache.last_event_start / 1000).isoformat()
         date_tomorrow = (now + timedelta(days=1)).isoformat()
-        if date_latest_price < date_tomorrow:
-            self.log(f"FM EPEX prices seem not renewed yet, latest price at: {date_latest_price}, " \
-                    f"Retry at {self.second_try_time_price_data}.")
-            self.run_at(self.get_epex_prices, self.second_try_time_price_data)
+        if date_latest_price is None or date_latest_price < date_tomorrow:
+            if self.plan_poll_for_prices():
+                self.log(f"FM EPEX prices seem not renewed yet, latest price at: {date_latest_price}, "
+                         f"checking every {self.PUBLICATION_POLL_INTERVAL} seconds until "
+                         f"{self.last_poll_time_price_data}.")
+            else:
+                self.log(f"FM EPEX prices seem not renewed yet, latest price at: {date_latest_price}, "
+                         f"check again at {self.first_try_time_price_data}.")
         else:
             if has_negative_prices:
                 self.get_app("v2g_liberty").notify_user(
@@ -369,6 +722,18 @@ class FlexMeasuresDataImporter(hass.Hass):
                     ttl         = 12*60*60
                 )
             self.log(f"FM EPEX prices successfully retrieved. Latest price at: {date_latest_price}.")
+            if c.OPTIMISATION_MODE == "price":
+                # Do not wait for the next trigger, the schedule can now take the new prices into account.
+                bus.publish(ScheduleInputChanged("prices"))
+
+    def refresh_charts(self, *args):
+        """Re-trim the series of the charts to the view window at this moment."""
+        self.charts.refresh(self.get_now())
+
+    def plan_poll_for_prices(self) -> bool:
+        """Poll for new prices if in the publication window, returns False if not."""
+        return self.plan_poll(self.get_epex_prices, self.prices_cache, self.PRICES_URL,
+                              self.first_try_time_price_data, self.last_poll_time_price_data)
 
     def get_emission_intensities(self, *args, **kwargs):
         """ Communicate with FM server and check the results.
@@ -381,20 +746,21 @@ class FlexMeasuresDataImporter(hass.Hass):
 
         now = self.get_now()
         self.authenticate_with_fm()
+        self.process_emission_intensities(self.fetch_emission_intensities(now), now, *args, **kwargs)
+
+    def fetch_emission_intensities(self, now: datetime) -> requests.Response:
+        """Fetch the emissions from a week ago into the cache, can run in the fetch pool."""
         # Getting emissions since a week ago. This is needed for calculation of CO2 savings
         # and will be (more than) enough for the graph to show.
         # Because we want to show it in the graph we do not use an end url param.
-        dt = str(now + timedelta(days=-7))
-        start_data_period = dt[:10] + "T00:00:00" + dt[-6:]
-        url_params = {
-            "event_starts_after": start_data_period,
-        }
+        start_data_period = start_of_day(now + timedelta(days=-7))
+        return self.update_series(self.emissions_cache, self.EMISSIONS_URL, now, "emissions", start_data_period,
+                                  keep=lambda series: [v not in ("null", None) for v in series.values])
 
-        res = requests.get(
-            self.EMISSIONS_URL,
-            params=url_params,
-            headers={"Authorization": self.fm_token},
-        )
+    def process_emission_intensities(self, res: Optional[requests.Response], now: datetime, *args, **kwargs):
+        """Make the (cached) emissions available in HA, res is the response to fetch_emission_intensities."""
+        if res is None:
+            return
 
         # Authorisation error, retry
         if res.status_code == 401:
@@ -402,55 +768,61 @@ class FlexMeasuresDataImporter(hass.Hass):
             self.try_solve_authentication_error(res, self.EMISSIONS_URL, self.get_emission_intensities, *args, **kwargs)
             return
 
-        if res.status_code != 200:
+        if res.status_code not in (200, 304):
             self.log_failed_response(res, "Get FM CO2 emissions data")
 
-            # Only retry once at second_try_time.
-            if self.now_is_between(self.first_try_time_emissions_data, self.second_try_time_emissions_data):
-                self.log(f"Retry at {self.second_try_time_emissions_data}.")
-                self.run_at(self.get_emission_intensities, self.second_try_time_emissions_data)
+            if self.plan_poll_for_emissions():
+                self.log(f"Retry in {self.PUBLICATION_POLL_INTERVAL} seconds.")
             return
 
-        results = res.json()
         # For use in graph
-        emission_points = []
-        # For use in calculations, it is cleared as we collect new values.
-        self.emission_intensities.clear()
-        for emission in results:
-            emission_value = emission['event_value']
-            if emission_value == "null" or emission_value is None:
-                continue
-            # Set the real value for use in calculations later
-            self.emission_intensities[emission['event_start']] = emission_value
-            # Adapt value for showing in graph
-            emission_value = int(round(float(emission_value) / 10, 0))
-            period_start = datetime.fromtimestamp(emission['event_start'] / 1000).isoformat()
-            # ToDO: only make and add data_point if less then 5 hours old this keeps the graph clean.
-            data_point = {'time': period_start, 'emission': emission_value}
-            emission_points.append(data_point)
+        series = self.emissions_cache.series()
+        # Adapt value for showing in graph
+        emissions = [int(round(float(emission_value) / 10, 0)) for emission_value in series.values]
 
-        # To make sure HA considers this as new info a datetime is added
-        new_state = "Emissions collected at " + now.isoformat()
-        result = {'records': emission_points}
-        self.set_state("input_text.co2_emissions", state=new_state, attributes=result)
+        # Only the part of the week the graph shows is published, and only if it has changed
+        self.charts.publish("input_text.co2_emissions", "emission", series, emissions,
+                            state="Emissions collected at " + now.isoformat(), now=now)
 
         # FM returns all the prices it has, sometimes it has not retrieved new
         # prices yet, than it communicates the prices it does have.
-        date_latest_emission = datetime.fromtimestamp(results[-1].get('event_start') / 1000).isoformat()
+        if self.emissions_cache.last_event_start is None:
+            date_latest_emission = None
+        else:
+            date_latest_emission = datetime.fromtimestamp(self.emissions_cache.last_event_start / 1000).isoformat()
         date_tomorrow = (now + timedelta(days=1)).isoformat()
-        if date_latest_emission < date_tomorrow:
-            self.log(
-                f"FM CO2 emissions seem not renewed yet. {date_latest_emission}, retry at {self.second_try_time_emissions_data}.")
-            self.run_at(self.get_emission_intensities, self.second_try_time_emissions_data)
+        if date_latest_emission is None or date_latest_emission < date_tomorrow:
+            if self.plan_poll_for_emissions():
+                self.log(f"FM CO2 emissions seem not renewed yet. {date_latest_emission}, checking every "
+                         f"{self.PUBLICATION_POLL_INTERVAL} seconds until {self.last_poll_time_emissions_data}.")
+            else:
+                self.log(f"FM CO2 emissions seem not renewed yet. {date_latest_emission}, "
+                         f"check again at {self.first_try_time_emissions_data}.")
         else:
             self.log(f"FM CO2 successfully retrieved. Latest price at: {date_latest_emission}.")
+            if c.OPTIMISATION_MODE != "price":
+                # Do not wait for the next trigger, the schedule can now take the new emissions into account.
+                bus.publish(ScheduleInputChanged("emission intensities"))
+
+    def plan_poll_for_emissions(self) -> bool:
+        """Poll for new emissions if in the publication window, returns False if not."""
+        return self.plan_poll(self.get_emission_intensities, self.emissions_cache, self.EMISSIONS_URL,
+                              self.first_try_time_emissions_data, self.last_poll_time_emissions_data)
+
+    def get_optimisation_signal(self) -> dict:
+        """The cached signal that is optimised on (see OPTIMISATION_MODE), values keyed by event_start in ms."""
+        if c.OPTIMISATION_MODE == "price":
+            series_caches.touch(self.prices_cache)
+            return self.consumption_prices
+        series_caches.touch(self.emissions_cache)
+        return self.emission_intensities
 
     def authenticate_with_fm(self):
         """Authenticate with the FlexMeasures server and store the returned auth token.
         Hint: the lifetime of the token is limited, so also call this method whenever the server returns a 401 status code.
         """
         self.log(f"Authenticating with FlexMeasures on URL '{c.FM_AUTHENTICATION_URL}'.")
-        res = requests.post(
+        res = self.session.post(
             c.FM_AUTHENTICATION_URL,
             json=dict(
                 email=self.args["fm_data_user_email"],
@@ -468,3 +840,8 @@ class FlexMeasuresDataImporter(hass.Hass):
             self.authenticate_with_fm()
             fnc_kwargs["retry_auth_once"] = False
             fnc(*fnc_args, **fnc_kwargs)
+
+
+def start_of_day(moment: datetime) -> datetime:
+    """The start (00:00) of the day of moment, in the timezone of moment."""
+    return moment.replace(hour=0, minute=0, second=0, microsecond=0)
@@ -0,0 +1,267 @@
+from datetime import timedelta
+import math
+from typing import Dict, List, Optional, Tuple
+
+from series_cache import series_resolution
+from soc_constraints import Segment, resolution_in_seconds
+
+# A local scheduler to fall back on when FlexMeasures cannot deliver a (valid) schedule.
+#
+# The schedule is optimised with dynamic programming over a grid of SoC values. The steps (stages) of the
+# optimisation follow the blocks of the price (or emission) signal, as within a block the costs are constant.
+# All SoC constraints are soft: missing them is heavily penalised, so there always is a schedule and it meets
+# the constraints where possible.
+
+# Reported as scheduler in the scheduler_info of the schedule, like the FM schedulers are.
+SCHEDULER_NAME = "V2GLibertyLocalScheduler"
+
+# A signal block is a tuple of (start_slot, end_slot, value), the end_slot is exclusive.
+SignalBlock = Tuple[int, int, float]
+
+# Costs per kWh of SoC outside the constraints, way above any price.
+CONSTRAINT_PENALTY = 1e6
+# Costs per grid step of (dis)charging, so that of equal options the one with the least cycling is chosen.
+CYCLING_PENALTY = 1e-6
+# Caps the SoC values in the optimisation for large batteries. For a 27 hour horizon plan_schedule then takes
+# 5-10 ms with an hourly signal and 17-27 ms with a 15 minute signal (benchmarks/bench_local_scheduler.py).
+MAX_NUMBER_OF_STATES = 150
+
+
+def signal_blocks(signal: Dict[int, float], start_slot: int, end_slot: int,
+                  resolution: timedelta) -> List[SignalBlock]:
+    """Cut the signal into blocks of constant value, between start_slot and end_slot.
+
+    Parameters:
+        signal (dict): values keyed by their event_start in milliseconds, as retrieved from FM
+        start_slot, end_slot (int): the period to cover, end_slot is exclusive
+        resolution (timedelta): the duration of a slot
+    Returns:
+        List of blocks, covering the period from start_slot up to the first gap in the signal (or end_slot).
+    """
+    res_ms = resolution_in_seconds(resolution) * 1000
+    starts = sorted(event_start for event_start, value in signal.items() if value is not None)
+    if len(starts) == 0:
+        return []
+    # Derived from all events, the missing values (None or left out) are gaps and do not lengthen the events.
+    event_duration = series_resolution(sorted(signal)) or 60 * 60 * 1000
+
+    blocks = []
+    for event_start in starts:
+        block_start = max(event_start // res_ms, start_slot)
+        block_end = min((event_start + event_duration) // res_ms, end_slot)
+        if block_end <= block_start:
+            continue
+        if blocks and blocks[-1][1] != block_start:
+            # A gap in the signal, the schedule cannot go beyond it.
+            break
+        if not blocks and block_start != start_slot:
+            return []
+        blocks.append((block_start, block_end, float(signal[event_start])))
+    return blocks
+
+
+def plan_schedule(blocks: List[SignalBlock], current_soc_kwh: float, soc_minima: List[Segment],
+                  soc_maxima: List[Segment], min_soc_kwh: float, capacity_kwh: float, max_charge_power_w: int,
+                  max_discharge_power_w: int, roundtrip_efficiency: float, resolution: timedelta,
+                  grid_step_kwh: Optional[float] = None) -> Optional[List[float]]:
+    """Plan the (dis)charge power with the lowest costs for the signal blocks.
+
+    Parameters:
+        blocks (list): the price/emission signal in €/MWh or kg/MWh, see signal_blocks
+        current_soc_kwh (float): SoC at the start of the first block
+        soc_minima, soc_maxima (list): the segments as used for the FM trigger message
+        min_soc_kwh (float): SoC to stay above (unless the current SoC is below it)
+        capacity_kwh (float): usable capacity of the car battery
+        max_charge_power_w, max_discharge_power_w (int): limits of the charger
+        roundtrip_efficiency (float): efficiency of charging and then discharging
+        resolution (timedelta): the duration of a slot
+        grid_step_kwh (float): granularity of the SoC in the optimisation, by default 0.1 kWh, coarser for
+                               large batteries to keep the number of SoC values around MAX_NUMBER_OF_STATES
+    Returns:
+        The power in MW for every slot from the start of the first block to the end of the last block,
+        or None if there are no blocks.
+    """
+    if len(blocks) == 0:
+        return None
+
+    if grid_step_kwh is None:
+        grid_step_kwh = max(0.1, capacity_kwh / MAX_NUMBER_OF_STATES)
+    e = roundtrip_efficiency ** 0.5
+    slot_hours = resolution / timedelta(hours=1)
+    number_of_states = int(capacity_kwh / grid_step_kwh) + 1
+    boundaries = [blocks[0][0]] + [end_slot for _, end_slot, _ in blocks]
+    lower, upper = state_bounds(boundaries, soc_minima, soc_maxima, min_soc_kwh, capacity_kwh)
+
+    # The penalties only depend on the bounds, most boundaries share the default bounds.
+    penalty_tables = {}
+
+    def penalties(t: int) -> List[float]:
+        bounds = (lower[t], upper[t])
+        if bounds not in penalty_tables:
+            penalty_tables[bounds] = [
+                CONSTRAINT_PENALTY * (max(0.0, lower[t] - j * grid_step_kwh) + max(0.0, j * grid_step_kwh - upper[t]))
+                for j in range(number_of_states)
+            ]
+        return penalty_tables[bounds]
+
+    # The energy left at the end has value, otherwise the schedule would always end with an empty battery.
+    average_value = sum(value * (end - start) for start, end, value in blocks) / (boundaries[-1] - boundaries[0])
+    terminal_penalties = penalties(len(blocks))
+    values_to_go = [
+        terminal_penalties[j] - average_value * j * grid_step_kwh * e / 1000 for j in range(number_of_states)
+    ]
+    no_penalties = [0.0] * number_of_states
+
+    # Backward pass, per block the lowest costs to go for every SoC (in grid steps).
+    # The costs of a step are linear in its size, with one slope up (charging) and one down (discharging). So the
+    # best step up from SoC j costs the minimum of values_to_go[i] + slope_up * i over the window j..j + max_up,
+    # minus slope_up * j, and likewise down. These window minima take a few passes over the states.
+    block_values_to_go = []
+    step_limits = []
+    for t in range(len(blocks) - 1, -1, -1):
+        start_slot, end_slot, value = blocks[t]
+        hours = (end_slot - start_slot) * slot_hours
+        max_up = int(max_charge_power_w / 1000 * hours * e / grid_step_kwh)
+        max_down = int(max_discharge_power_w / 1000 * hours / e / grid_step_kwh)
+        # Costs per grid step up and down, as grid_energy_kwh plus the cycling penalty
+        slope_up = value * grid_step_kwh / e / 1000 + CYCLING_PENALTY
+        slope_down = value * grid_step_kwh * e / 1000 - CYCLING_PENALTY
+        best_up = window_minima([v + slope_up * i for i, v in enumerate(values_to_go)], max_up)
+        best_down = window_minima([v + slope_down * i for i, v in enumerate(values_to_go)][::-1], max_down)[::-1]
+        block_penalties = penalties(t) if t > 0 else no_penalties
+        block_values_to_go.append(values_to_go)
+        step_limits.append((max_up, max_down))
+        values_to_go = [
+            penalty + (up if up < down else down)
+            for up, down, penalty in zip(
+                [cost - slope_up * j for j, cost in enumerate(best_up)],
+                [cost - slope_down * j for j, cost in enumerate(best_down)],
+                block_penalties,
+            )
+        ]
+    block_values_to_go.reverse()
+    step_limits.reverse()
+
+    # Forward pass from the current SoC, per block the best step given the costs to go after it.
+    j = min(max(int(round(current_soc_kwh / grid_step_kwh)), 0), number_of_states - 1)
+    power_per_slot = []
+    for (start_slot, end_slot, value), values_to_go, (max_up, max_down) in zip(blocks, block_values_to_go,
+                                                                                step_limits):
+        lowest = max(-max_down, -j)
+        highest = min(max_up, number_of_states - 1 - j)
+        # Of equal options the smallest step
+        k = min(
+            range(lowest, highest + 1),
+            key=lambda k: value * grid_energy_kwh(k * grid_step_kwh, e) / 1000 + CYCLING_PENALTY * abs(k)
+            + values_to_go[j + k]
+        )
+        j += k
+        hours = (end_slot - start_slot) * slot_hours
+        power_mw = round(grid_energy_kwh(k * grid_step_kwh, e) / hours / 1000, 6)
+        power_per_slot.extend([power_mw] * (end_slot - start_slot))
+    return power_per_slot
+
+
+def window_minima(costs: List[float], width: int) -> List[float]:
+    """For every index j, the minimum of the costs from j to j + width (within the list).
+
+    Computed per block of width + 1 costs from the running minima within the blocks (van Herk/Gil-Werman): the
+    window from j is covered by the rest of the block of j and the start of the next block. This takes three
+    passes, whatever the width.
+    """
+    n = len(costs)
+    size = width + 1
+    if size >= n:
+        # Every window reaches the end of the list
+        size = n
+    padded = costs + [math.inf] * (-n % size + size)
+    from_start = padded[:]
+    to_end = padded[:]
+    low = math.inf
+    for i, cost in enumerate(padded):
+        if cost < low or i % size == 0:
+            low = cost
+        from_start[i] = low
+    low = math.inf
+    for i in range(len(padded) - 1, -1, -1):
+        cost = padded[i]
+        if cost < low or i % size == size - 1:
+            low = cost
+        to_end[i] = low
+    if size == n:
+        return to_end[:n]
+    return [a if a < b else b for a, b in zip(to_end[:n], from_start[width:width + n])]
+
+
+def grid_energy_kwh(soc_change_kwh: float, e: float) -> float:
+    """Energy from (positive) or to (negative) the grid for a change of SoC, e is the one-way efficiency."""
+    if soc_change_kwh >= 0:
+        return soc_change_kwh / e
+    return soc_change_kwh * e
+
+
+def state_bounds(boundaries: List[int], soc_minima: List[Segment], soc_maxima: List[Segment], min_soc_kwh: float,
+                 capacity_kwh: float) -> Tuple[List[float], List[float]]:
+    """Lower and upper bound of the SoC at each of the boundaries (slots) between the blocks.
+
+    A constraint that falls between two boundaries is applied to the boundary before it, so it is met in time.
+    """
+    lower = [min_soc_kwh] * len(boundaries)
+    upper = [capacity_kwh] * len(boundaries)
+    for segments, bounds, combine in ((soc_minima, lower, max), (soc_maxima, upper, min)):
+        for start_slot, end_slot, value in segments:
+            if end_slot < boundaries[0] or start_slot > boundaries[-1]:
+                continue
+            indices = [t for t, slot in enumerate(boundaries) if start_slot <= slot <= end_slot]
+            if len(indices) == 0:
+                indices = [max(1, max(t for t, slot in enumerate(boundaries) if slot <= start_slot))]
+            for t in indices:
+                bounds[t] = combine(bounds[t], value)
+    return lower, upper
+
+
+def correct_for_drift(values: List[float], drift_kwh: float, catch_up_slots: int, max_charge_power_w: int,
+                      max_discharge_power_w: int, roundtrip_efficiency: float, resolution: timedelta) -> List[float]:
+    """Correct the (remaining) values of a schedule so that the SoC returns to the planned SoC.
+
+    The correction is spread evenly over the first catch_up_slots, within the limits of the charger. What
+    cannot be corrected in a slot due to these limits is taken over by the next slots.
+
+    Parameters:
+        values (list): the planned power in MW per slot, starting with the current slot
+        drift_kwh (float): the actual minus the planned SoC
+        catch_up_slots (int): number of slots in which the drift should be corrected
+        max_charge_power_w, max_discharge_power_w (int): limits of the charger
+        roundtrip_efficiency (float): efficiency of charging and then discharging
+        resolution (timedelta): the duration of a slot
+    Returns:
+        The corrected values, the values after the catch up window are unchanged.
+    """
+    e = roundtrip_efficiency ** 0.5
+    hours = resolution / timedelta(hours=1)
+    max_charge_mw = max_charge_power_w / 1000000
+    max_discharge_mw = max_discharge_power_w / 1000000
+
+    to_correct_kwh = -drift_kwh
+    corrected = list(values)
+    catch_up_slots = min(catch_up_slots, len(values))
+    for i in range(catch_up_slots):
+        planned_kwh = soc_change_for_power(values[i], e, hours)
+        power_mw = power_for_soc_change(planned_kwh + to_correct_kwh / (catch_up_slots - i), e, hours)
+        power_mw = min(max(power_mw, -max_discharge_mw), max_charge_mw)
+        corrected[i] = round(power_mw, 6)
+        to_correct_kwh -= soc_change_for_power(power_mw, e, hours) - planned_kwh
+    return corrected
+
+
+def power_for_soc_change(soc_change_kwh: float, e: float, hours: float) -> float:
+    """Power in MW during hours that results in a change of SoC, e is the one-way efficiency."""
+    return grid_energy_kwh(soc_change_kwh, e) / hours / 1000
+
+
+def soc_change_for_power(power_mw: float, e: float, hours: float) -> float:
+    """Change of SoC in kWh by (dis)charging with power during hours, e is the one-way efficiency."""
+    energy_kwh = power_mw * 1000 * hours
+    if energy_kwh >= 0:
+        return energy_kwh * e
+    return energy_kwh / e
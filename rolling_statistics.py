@@ -0,0 +1,136 @@
+from collections import deque
+from typing import List, Tuple
+
+from series_cache import series_resolution
+
+
+class RollingStatistics:
+    """Totals of quantities (e.g. charged energy) over a rolling window, such as the last 7 days.
+
+    Each interval adds its contributions to the totals. The intervals are kept in a ring buffer, ordered by
+    their start, and are subtracted from the totals again when they leave the window. So keeping the totals
+    up to date costs O(1) per interval.
+    The intervals up to a moment can be replaced by data from FM (reconcile), e.g. once a day.
+    """
+
+    # Duration of the window in ms
+    window: int
+    # Per quantity the sum of the contributions of the intervals in the window
+    totals: dict
+    # Tuples of the start of an interval (in ms) and its contributions, a dict per quantity
+    _intervals: deque
+
+    def __init__(self, window: int):
+        self.window = window
+        self.totals = {}
+        self._intervals = deque()
+
+    def add(self, start: int, contributions: dict, now: int):
+        """Add the contributions of the interval that starts at start (in ms) and expire the intervals before the
+        window that ends at now (in ms)."""
+        self._intervals.append((start, contributions))
+        for quantity, value in contributions.items():
+            self.totals[quantity] = self.totals.get(quantity, 0) + value
+        self.expire(now)
+
+    def expire(self, now: int):
+        """Remove the intervals that started before the window that ends at now (in ms)."""
+        while len(self._intervals) > 0 and self._intervals[0][0] < now - self.window:
+            _, contributions = self._intervals.popleft()
+            for quantity, value in contributions.items():
+                self.totals[quantity] -= value
+
+    def reconcile(self, intervals: List[Tuple[int, dict]], until: int, now: int):
+        """Replace the intervals that start before until (in ms) by intervals (from FM), the totals are recomputed.
+
+        Parameters:
+            intervals (list): tuples of the start of an interval (in ms) and its contributions
+            until (int): end of the period the intervals cover, later intervals are kept
+            now (int): end of the window, in ms
+        """
+        kept = [interval for interval in self._intervals if interval[0] >= until]
+        replaced = sorted((interval for interval in intervals if interval[0] < until), key=lambda i: i[0])
+        self._intervals = deque(replaced + kept)
+        self.totals = {}
+        for _, contributions in self._intervals:
+            for quantity, value in contributions.items():
+                self.totals[quantity] = self.totals.get(quantity, 0) + value
+        self.expire(now)
+
+    def total(self, quantity: str) -> float:
+        """The total of a quantity over the window, 0 if no interval contributed to it."""
+        return self.totals.get(quantity, 0)
+
+
+def energy_contributions(power: float, duration: int, emission_intensity: float) -> dict:
+    """Contributions of an interval to the energy statistics.
+
+    Parameters:
+        power (float): the average power in MW, negative for discharging
+        duration (int): the duration of the interval in ms
+        emission_intensity (float): emissions in kg/MWh
+    Returns:
+        Dict with charged_energy or discharged_energy (kWh), charged_minutes or discharged_minutes and emissions
+        or saved_emissions (kg). Discharged energy and saved emissions are negative. Empty if the power is 0.
+    """
+    hours = duration / (60 * 60 * 1000)
+    minutes = duration / (60 * 1000)
+    # From average MW to kWh
+    energy = power * hours * 1000
+    # From MW * kg/MWh to kg
+    emissions = power * emission_intensity * hours
+    if power > 0:
+        return dict(charged_energy=energy, charged_minutes=minutes, emissions=emissions)
+    if power < 0:
+        return dict(discharged_energy=energy, discharged_minutes=minutes, saved_emissions=emissions)
+    return {}
+
+
+def interval_start(end: int, duration: int) -> int:
+    """The start (in ms) of the interval of duration (in ms) that was concluded at end (in ms).
+
+    The conclusion runs just around the end of the interval, so end is rounded to the nearest slot boundary
+    first, as set_fm_data.store_interval does.
+    """
+    return (end + duration // 2) // duration * duration - duration
+
+
+def charged_energy_intervals(power_values: dict, emission_intensities: dict,
+                             default_resolution: int) -> List[Tuple[int, dict]]:
+    """The contributions of each power value to the energy statistics, see energy_contributions.
+
+    The emission intensities are joined to the power values on the slot index of the emissions: each power
+    value gets the average intensity of the emission slots its interval overlaps (0 if there are none).
+    Both resolutions are derived from the data, so this works for any mix of resolutions.
+
+    Parameters:
+        power_values (dict): average power in MW, keyed by event_start in ms (None for missing values)
+        emission_intensities (dict): emissions in kg/MWh, keyed by event_start in ms
+        default_resolution (int): resolution of the power values in ms, if it cannot be derived
+    Returns:
+        List of tuples of event_start and contributions, sorted by event_start.
+    """
+    event_starts = sorted(k for k, v in power_values.items() if v is not None)
+    powers = [float(power_values[k]) for k in event_starts]
+    power_resolution = series_resolution(event_starts) or default_resolution
+
+    emission_starts = sorted(emission_intensities)
+    emission_resolution = series_resolution(emission_starts)
+    if emission_resolution is None:
+        intensities = [0.0] * len(event_starts)
+    else:
+        origin = emission_starts[0]
+        intensity_by_slot = {(k - origin) // emission_resolution: float(v) for k, v in emission_intensities.items()}
+        intensities = []
+        for event_start in event_starts:
+            first_slot = (event_start - origin) // emission_resolution
+            last_slot = (event_start + power_resolution - 1 - origin) // emission_resolution
+            slot_intensities = [
+                intensity_by_slot[slot] for slot in range(first_slot, last_slot + 1) if slot in intensity_by_slot
+            ]
+            intensities.append(sum(slot_intensities) / len(slot_intensities) if slot_intensities else 0.0)
+
+    return [
+        (event_start, energy_contributions(power, power_resolution, intensity))
+        for event_start, power, intensity in zip(event_starts, powers, intensities)
+    ]
@@ -0,0 +1,160 @@
+from datetime import date, datetime
+from typing import Callable, Dict, Iterable, Optional
+
+from rolling_statistics import charged_energy_intervals
+from series_cache import series_resolution, values_at
+from series_store import SeriesStore
+
+
+class Rollups:
+    """Totals of quantities (e.g. charged energy, cost) per day and per month, materialized in the series store.
+
+    Each concluded interval adds its contributions to the totals of its day and its month, so the totals for
+    "this month" or "the last 12 months" are read from at most 12 months, whatever the amount of data.
+    When FM revises the data of some days (e.g. costs or power that arrive later), only these days are
+    re-rolled: their totals are replaced and the difference is applied to the totals of their month.
+    """
+
+    # Store the totals are written through to, None for not persisting
+    store: Optional[SeriesStore]
+    # Totals per quantity, keyed by the first day of the period
+    days: Dict[date, dict]
+    months: Dict[date, dict]
+
+    def __init__(self, store: Optional[SeriesStore]):
+        self.store = store
+        self.days = {}
+        self.months = {}
+        if store is not None:
+            self.days = {date.fromisoformat(k): v for k, v in store.get_rollups("day").items()}
+            self.months = {date.fromisoformat(k): v for k, v in store.get_rollups("month").items()}
+
+    def is_empty(self) -> bool:
+        return len(self.days) == 0
+
+    def add(self, day: date, contributions: dict):
+        """Add the contributions of an interval to the totals of its day (and month)."""
+        month = month_of(day)
+        day_totals = self.days.setdefault(day, {})
+        month_totals = self.months.setdefault(month, {})
+        for quantity, value in contributions.items():
+            day_totals[quantity] = day_totals.get(quantity, 0) + value
+            month_totals[quantity] = month_totals.get(quantity, 0) + value
+        self._persist([day], [month])
+
+    def replace_days(self, totals: Dict[date, dict]):
+        """Re-roll days: replace their totals (e.g. recomputed from revised data) and update their months."""
+        months = set()
+        for day, new_totals in totals.items():
+            month = month_of(day)
+            months.add(month)
+            month_totals = self.months.setdefault(month, {})
+            for quantity, value in self.days.get(day, {}).items():
+                month_totals[quantity] = month_totals.get(quantity, 0) - value
+            for quantity, value in new_totals.items():
+                month_totals[quantity] = month_totals.get(quantity, 0) + value
+            self.days[day] = dict(new_totals)
+        self._persist(totals.keys(), months)
+
+    def month_totals(self, day: date) -> dict:
+        """The totals of the month of day."""
+        return self.months.get(month_of(day), {})
+
+    def last_months_totals(self, day: date, number_of_months: int = 12) -> dict:
+        """The totals of the month of day and the months before it, number_of_months in all."""
+        totals = {}
+        month = month_of(day)
+        for _ in range(number_of_months):
+            for quantity, value in self.months.get(month, {}).items():
+                totals[quantity] = totals.get(quantity, 0) + value
+            month = previous_month(month)
+        return totals
+
+    def _persist(self, days: Iterable[date], months: Iterable[date]):
+        if self.store is None:
+            return
+        self.store.put_rollups("day", {day.isoformat(): self.days[day] for day in days})
+        self.store.put_rollups("month", {month.isoformat(): self.months[month] for month in months})
+
+
+def day_of(event_start: int, tz) -> date:
+    """The (local) day of an event_start in ms."""
+    return datetime.fromtimestamp(event_start / 1000, tz=tz).date()
+
+
+def month_of(day: date) -> date:
+    """The first day of the month of day, the key of the month totals."""
+    return day.replace(day=1)
+
+
+def previous_month(month: date) -> date:
+    if month.month == 1:
+        return month.replace(year=month.year - 1, month=12)
+    return month.replace(month=month.month - 1)
+
+
+def availability_percentage(totals: dict) -> Optional[float]:
+    """The percentage of the metered time the charger was available, None if no time was metered."""
+    metered_minutes = totals.get("metered_minutes", 0)
+    if metered_minutes <= 0:
+        return None
+    return 100 * totals.get("available_minutes", 0) / metered_minutes
+
+
+def daily_totals(power_values: dict, availabilities: dict, costs: dict, emission_intensities: dict, prices: dict,
+                 price_per_kwh: Callable[[float], float], tz, default_resolution: int) -> Dict[date, dict]:
+    """The totals per (local) day of the quantities of the rollups, from the data of the series store.
+
+    The costs from FM are used for the days FM has costs for, for the other days the costs are estimated from
+    the power and the prices, as for the intervals concluded by set_fm_data.
+
+    Parameters:
+        power_values (dict): average power in MW, keyed by event_start in ms
+        availabilities (dict): availability in %, keyed by event_start in ms
+        costs (dict): costs in €, keyed by event_start in ms
+        emission_intensities (dict): emissions in kg/MWh, keyed by event_start in ms
+        prices (dict): consumption prices in €/MWh, keyed by event_start in ms
+        price_per_kwh (callable): converts a price in €/MWh to €/kWh
+        tz: timezone of the days
+        default_resolution (int): resolution of the power and availability values in ms, if it cannot be derived
+    Returns:
+        Dict of the totals per quantity, keyed by day. Days without data are left out.
+    """
+    totals = {}
+    estimated_costs = {}
+
+    intervals = charged_energy_intervals(power_values, emission_intensities, default_resolution=default_resolution)
+    interval_prices = values_at(prices, [event_start for event_start, _ in intervals])
+    for (event_start, contributions), price in zip(intervals, interval_prices):
+        day = day_of(event_start, tz)
+        add_contributions(totals.setdefault(day, {}), contributions)
+        if price is not None:
+            energy = contributions.get("charged_energy", 0) + contributions.get("discharged_energy", 0)
+            estimated_costs[day] = estimated_costs.get(day, 0) + energy * price_per_kwh(float(price))
+
+    event_starts = sorted(k for k, v in availabilities.items() if v is not None)
+    minutes = (series_resolution(event_starts) or default_resolution) / (60 * 1000)
+    for event_start in event_starts:
+        add_contributions(totals.setdefault(day_of(event_start, tz), {}), {
+            "metered_minutes": minutes,
+            "available_minutes": minutes * float(availabilities[event_start]) / 100,
+        })
+
+    cost_days = set()
+    for event_start, cost in costs.items():
+        if cost is None:
+            continue
+        day = day_of(event_start, tz)
+        cost_days.add(day)
+        add_contributions(totals.setdefault(day, {}), {"cost": float(cost)})
+    for day, cost in estimated_costs.items():
+        if day not in cost_days:
+            totals[day]["cost"] = cost
+
+    return totals
+
+
+def add_contributions(totals: dict, contributions: dict):
+    """Add contributions to totals, per quantity."""
+    for quantity, value in contributions.items():
+        totals[quantity] = totals.get(quantity, 0) + value
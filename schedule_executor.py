@@ -0,0 +1,108 @@
+from bisect import bisect_right
+from datetime import datetime, timedelta
+from typing import Callable, List, Optional, Tuple
+
+
+class ScheduleExecutor:
+    """Sends the setpoints of a schedule to the charger at the right moments, with a single timer.
+
+    The schedule is held as change points: the moments at which the setpoint changes, with runs of equal values
+    merged. There is only a timer for the next change point, when it fires the setpoint is sent and the cursor
+    moves on to the next change point.
+    Loading a new schedule replaces the change points and the (one) timer at once. Each schedule gets a new
+    generation number that is passed to its timer, so a timer of a previous schedule that fires around the
+    swap is ignored.
+    """
+
+    # The app that provides the timers (run_at, cancel_timer and get_now)
+    app: object
+    # Called with the setpoint (in MW) when it changes
+    send_setpoint: Callable[[float], None]
+
+    _moments: List[datetime]
+    _values: List[float]
+    # Index of the next change point
+    _cursor: int
+    _generation: int
+    _timer_handle: Optional[str]
+
+    def __init__(self, app, send_setpoint: Callable[[float], None]):
+        self.app = app
+        self.send_setpoint = send_setpoint
+        self._moments = []
+        self._values = []
+        self._cursor = 0
+        self._generation = 0
+        self._timer_handle = None
+
+    def load(self, start: datetime, resolution: timedelta, values: List[float]):
+        """Replace the schedule, the setpoint of the current slot (if any) is sent right away.
+
+        Parameters:
+            start (datetime): start of the first value
+            resolution (timedelta): duration of each value
+            values (List[float]): (dis)charge power in MW
+        """
+        self.clear()
+        self._moments, self._values = change_points(start, resolution, values)
+        self._cursor = bisect_right(self._moments, self.app.get_now())
+        current_setpoint = self.current_setpoint
+        if current_setpoint is not None:
+            self.send_setpoint(current_setpoint)
+        self._arm()
+
+    def clear(self):
+        """Remove the schedule and cancel its timer, the current setpoint is not changed."""
+        self._generation += 1
+        if self._timer_handle is not None:
+            self.app.cancel_timer(self._timer_handle, True)
+            self._timer_handle = None
+        self._moments = []
+        self._values = []
+        self._cursor = 0
+
+    @property
+    def current_setpoint(self) -> Optional[float]:
+        """The setpoint (in MW) that has been sent last, None if the schedule has not started yet."""
+        if self._cursor == 0:
+            return None
+        return self._values[self._cursor - 1]
+
+    @property
+    def next_setpoint(self) -> Optional[Tuple[datetime, float]]:
+        """The moment and value (in MW) of the next change of the setpoint, None if there is none."""
+        if self._cursor >= len(self._moments):
+            return None
+        return self._moments[self._cursor], self._values[self._cursor]
+
+    def _arm(self):
+        if self._cursor < len(self._moments):
+            self._timer_handle = self.app.run_at(
+                self._fire, self._moments[self._cursor], generation=self._generation
+            )
+        else:
+            self._timer_handle = None
+
+    def _fire(self, kwargs):
+        if kwargs.get("generation") != self._generation:
+            # A timer of a previous schedule
+            return
+        # Catch up on change points that have passed in the meantime, only the last one counts.
+        self._cursor = max(self._cursor + 1, bisect_right(self._moments, self.app.get_now()))
+        self.send_setpoint(self._values[self._cursor - 1])
+        self._arm()
+
+
+def change_points(start: datetime, resolution: timedelta, values: List[float]) -> Tuple[List[datetime], List[float]]:
+    """Reduce the values of a schedule to the moments the value changes, runs of equal values are merged.
+
+    Returns:
+        Tuple of the list of moments and the list of values from those moments on.
+    """
+    moments = []
+    change_values = []
+    for i, value in enumerate(values):
+        if len(change_values) == 0 or value != change_values[-1]:
+            moments.append(start + i * resolution)
+            change_values.append(value)
+    return moments, change_values
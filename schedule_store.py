@@ -0,0 +1,56 @@
+from datetime import datetime, timedelta
+import json
+import os
+from typing import List, Optional, Tuple
+
+import isodate
+
+
+def save_schedule(path: str, start: datetime, resolution: timedelta, values: List[float]):
+    """Persist a schedule to a (json) file, replacing the previous one.
+
+    The file is written to a temporary file first and then moved, so a crash while writing never leaves
+    a half written schedule behind.
+    """
+    content = {
+        "start": start.isoformat(),
+        "resolution": isodate.duration_isoformat(resolution),
+        "valid_until": (start + len(values) * resolution).isoformat(),
+        "values": values,
+    }
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w") as f:
+        json.dump(content, f)
+    os.replace(tmp_path, path)
+
+
+def load_schedule(path: str, now: datetime) -> Optional[Tuple[datetime, timedelta, List[float]]]:
+    """Load the still valid part of a persisted schedule.
+
+    Returns:
+        Tuple of start, resolution and values, starting with the value for the interval that contains now.
+        None if there is no persisted schedule or it is no longer valid.
+    """
+    try:
+        with open(path) as f:
+            content = json.load(f)
+        start = isodate.parse_datetime(content["start"])
+        resolution = isodate.parse_duration(content["resolution"])
+        values = content["values"]
+    except (OSError, ValueError, KeyError, isodate.ISO8601Error):
+        return None
+
+    if resolution <= timedelta(0) or start + len(values) * resolution <= now:
+        return None
+
+    # Skip the intervals that have passed, the first remaining one is the current interval.
+    passed = max(0, (now - start) // resolution)
+    return start + passed * resolution, resolution, values[passed:]
+
+
+def remove_schedule(path: str):
+    """Remove a persisted schedule, e.g. when the car is disconnected."""
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
@@ -0,0 +1,381 @@
+from collections import OrderedDict
+from datetime import datetime, timedelta
+import math
+import threading
+from typing import Callable, Dict, List, Optional, Tuple
+
+from series_store import SeriesStore
+
+
+class Series:
+    """Columnar representation of FM sensor data: parallel lists of event_start (in ms), value and source type.
+
+    FM responses are parsed into the lists directly, so conversions, filters and totals are single passes over
+    a list. Dict records (e.g. for the UI) are only made at the HA boundary, with records().
+    """
+
+    event_starts: List[int]
+    values: list
+    # Type of the source of each value (e.g. "scheduler"), None if not known
+    source_types: List[Optional[str]]
+
+    def __init__(self, event_starts: List[int], values: list, source_types: Optional[List[Optional[str]]] = None):
+        self.event_starts = event_starts
+        self.values = values
+        self.source_types = source_types if source_types is not None else [None] * len(event_starts)
+
+    def __len__(self):
+        return len(self.event_starts)
+
+    @classmethod
+    def from_events(cls, events: List[dict]) -> "Series":
+        """Parse the events (dicts with event_start, event_value and source) of an FM response."""
+        event_starts = [event["event_start"] for event in events]
+        values = [event["event_value"] for event in events]
+        source_types = [(event.get("source") or {}).get("type") for event in events]
+        return cls(event_starts, values, source_types)
+
+    @classmethod
+    def from_dict(cls, values: dict) -> "Series":
+        """A series sorted by event_start, from values keyed by event_start."""
+        event_starts = sorted(values)
+        return cls(event_starts, [values[k] for k in event_starts])
+
+    def select(self, mask: List[bool]) -> "Series":
+        """The series of the events for which mask is True."""
+        return Series(
+            [k for k, m in zip(self.event_starts, mask) if m],
+            [v for v, m in zip(self.values, mask) if m],
+            [t for t, m in zip(self.source_types, mask) if m],
+        )
+
+    def to_dict(self) -> dict:
+        """The values keyed by event_start."""
+        return dict(zip(self.event_starts, self.values))
+
+    def records(self, name: str, values: Optional[list] = None) -> List[dict]:
+        """Records of time (isoformat, local) and value, as used by the charts in the UI.
+
+        Parameters:
+            name (str): key of the value in the records, e.g. "price"
+            values (list): (converted) values to use instead of the values of the series
+        """
+        if values is None:
+            values = self.values
+        return [
+            {"time": datetime.fromtimestamp(event_start / 1000).isoformat(), name: value}
+            for event_start, value in zip(self.event_starts, values)
+        ]
+
+
+class SeriesCache:
+    """Local copy of the data of one FM sensor, so only new (and recently revised) events need to be fetched.
+
+    The values are kept in a dict keyed by event_start (in ms, as returned by FM), this dict is updated in place
+    so it can be shared with code that reads the values.
+    A fetch starts at the last event_start that is held (or now, if that is earlier, as future values such as
+    forecasts get revised) minus the revision overlap. The fetched events replace the held ones in the
+    fetched period.
+    The cache writes through to the local SeriesStore, so a restart does not need to fetch the whole window again.
+    The validators (ETag and Last-Modified) of the last response are kept, so the same request can be made
+    conditional: if the data has not changed FM can answer with an (empty) 304.
+    A cache is shared by all consumers of its sensor (see SeriesCaches): it covers the union of their windows
+    and one download (refresh) serves all consumers that asked for it while it was in progress.
+    """
+
+    # Store the values are written through to, None for not persisting
+    store: Optional[SeriesStore]
+    sensor_id: int
+    # Period before the last held event_start that is fetched again, for values that FM revised
+    revision_overlap: timedelta
+    values: dict
+
+    # Parameters and validators of the last successful request
+    request_params: Optional[dict]
+    etag: Optional[str]
+    last_modified: Optional[str]
+
+    # The event_starts (in ms) of values that were added, revised or removed by merges, see take_revisions
+    revisions: set
+
+    # Start (in ms) of the window each consumer needs, by name of the consumer
+    windows: Dict[str, int]
+    # Whether the values are in memory, they are unloaded when the cache is evicted (see SeriesCaches)
+    loaded: bool
+
+    # Only one download at a time, with the number of completed downloads and the response of the last one
+    _refresh_lock: threading.Lock
+    _refresh_count: int
+    _refresh_response: object
+
+    # Origin (an event_start) and resolution (both in ms) of the values, derived when first needed
+    _slots: Optional[Tuple[int, Optional[int]]]
+
+    def __init__(self, store: Optional[SeriesStore], sensor_id: int, revision_overlap: timedelta,
+                 since: Optional[int] = None):
+        self.store = store
+        self.sensor_id = sensor_id
+        self.revision_overlap = revision_overlap
+        self.values = {}
+        self.request_params = None
+        self.etag = None
+        self.last_modified = None
+        self.revisions = set()
+        self.windows = {}
+        self.loaded = False
+        self._refresh_lock = threading.Lock()
+        self._refresh_count = 0
+        self._refresh_response = None
+        self._slots = None
+        self.load(since)
+
+    @property
+    def last_event_start(self) -> Optional[int]:
+        """The last event_start (in ms) held in the cache, None if it is empty."""
+        if len(self.values) == 0:
+            return None
+        return max(self.values)
+
+    @property
+    def resolution(self) -> Optional[int]:
+        """The resolution (in ms) of the values, None if it cannot be derived."""
+        if len(self.values) == 0:
+            return None
+        if self._slots is None:
+            event_starts = sorted(self.values)
+            self._slots = (event_starts[0], series_resolution(event_starts))
+        return self._slots[1]
+
+    def value_at(self, moment: int):
+        """The value of the event that contains moment (in ms), None if there is none."""
+        resolution = self.resolution
+        if resolution is None:
+            return None
+        origin = self._slots[0]
+        return self.values.get(slot_start(moment, origin, resolution))
+
+    def series(self) -> Series:
+        """The values in the cache as a series, sorted by event_start."""
+        return Series.from_dict(self.values)
+
+    @property
+    def window_start(self) -> Optional[int]:
+        """Start (in ms) of the union of the windows of the consumers, None if there are none."""
+        if len(self.windows) == 0:
+            return None
+        return min(self.windows.values())
+
+    def request_window(self, consumer: str, window_start: datetime):
+        """Let the cache cover the window from window_start for consumer, earlier values are loaded from the store."""
+        previous_start = self.window_start
+        self.windows[consumer] = to_ms(window_start)
+        if self.loaded and previous_start is not None and self.window_start < previous_start:
+            self.load(self.window_start)
+
+    @property
+    def is_refreshing(self) -> bool:
+        return self._refresh_lock.locked()
+
+    def refresh(self, download: Callable[[], object]) -> object:
+        """Bring the cache up to date with download, unless another download completes while this call waits.
+
+        Concurrent refreshes (e.g. of two consumers of the sensor) wait for the download in progress and get
+        its response, so the sensor is downloaded once.
+
+        Parameters:
+            download (callable): fetches and merges the new events, returns the response
+        Returns:
+            The response of the download that brought the cache up to date.
+        """
+        refresh_count = self._refresh_count
+        with self._refresh_lock:
+            if self._refresh_count > refresh_count:
+                return self._refresh_response
+            # If the download fails, the waiting refreshes try themselves
+            self._refresh_response = download()
+            self._refresh_count += 1
+            return self._refresh_response
+
+    def fetch_start(self, window_start: datetime, now: datetime) -> datetime:
+        """The moment from which events need to be fetched to bring the cache up to date.
+
+        The moment is rounded down to the hour, so repeated requests (within the hour) are the same and can
+        be made conditional.
+
+        Parameters:
+            window_start (datetime): the start of the period the cache should cover
+            now (datetime): the current time, its tzinfo is used for the returned moment
+        """
+        last_event_start = self.last_event_start
+        if last_event_start is None:
+            return window_start
+        last_event_start = datetime.fromtimestamp(last_event_start / 1000, tz=now.tzinfo)
+        fetch_start = min(last_event_start, now) - self.revision_overlap
+        return max(window_start, fetch_start.replace(minute=0, second=0, microsecond=0))
+
+    def conditional_headers(self, params: dict) -> dict:
+        """Headers to make a request conditional, only if it has the same parameters as the last one."""
+        headers = {}
+        if params != self.request_params:
+            return headers
+        if self.etag is not None:
+            headers["If-None-Match"] = self.etag
+        if self.last_modified is not None:
+            headers["If-Modified-Since"] = self.last_modified
+        return headers
+
+    def remember_validators(self, params: dict, headers):
+        """Keep the validators of a successful response to the request with params."""
+        self.request_params = dict(params)
+        self.etag = headers.get("ETag")
+        self.last_modified = headers.get("Last-Modified")
+
+    def merge(self, events: dict, fetch_start: datetime, fetch_end: Optional[datetime] = None):
+        """Replace the values in the fetched period by the fetched events and write them through to the store.
+
+        Parameters:
+            events (dict): fetched values keyed by event_start in ms
+            fetch_start (datetime): start of the fetched period
+            fetch_end (datetime): end of the fetched period, None if it was open-ended
+        """
+        start = to_ms(fetch_start)
+        end = None if fetch_end is None else to_ms(fetch_end)
+        removed = [k for k in self.values if k >= start and (end is None or k < end) and k not in events]
+        self.revisions.update(removed)
+        self.revisions.update(k for k, v in events.items() if k not in self.values or self.values[k] != v)
+        for event_start in removed:
+            del self.values[event_start]
+        self.values.update(events)
+        self._slots = None
+        if self.store is not None:
+            # Only upserted, the values before the window of the cache are kept in the store
+            self.store.put(self.sensor_id, events)
+
+    def take_revisions(self) -> set:
+        """The event_starts (in ms) of the values changed by merges since the last call."""
+        revisions = self.revisions
+        self.revisions = set()
+        return revisions
+
+    def trim(self):
+        """Remove the values before the window of the consumers from memory, the store keeps them."""
+        start = self.window_start
+        if start is None:
+            return
+        for event_start in [k for k in self.values if k < start]:
+            del self.values[event_start]
+        self._slots = None
+
+    def load(self, since: Optional[int] = None):
+        """Load the values since since (in ms, None for all) from the store."""
+        self.values.clear()
+        self._slots = None
+        if self.store is not None:
+            self.values.update(self.store.get_range(self.sensor_id, start=since))
+        self.loaded = True
+
+    def unload(self):
+        """Free the memory of the values, the next request is not conditional as it has to fetch them again."""
+        self.values.clear()
+        self._slots = None
+        self.request_params = None
+        self.etag = None
+        self.last_modified = None
+        self.loaded = False
+
+
+class SeriesCaches:
+    """The caches of the FM sensors in this process, one per sensor, shared by all its consumers.
+
+    Sensors can be used by several consumers, e.g. with nl_generic the consumption and production prices are
+    the same sensor and in emissions mode the prices for the scheduler are the emissions. They share one cache,
+    so one download per sensor serves them all.
+    The number of values held in memory is capped: when the total exceeds max_values, the caches that were
+    least recently used are unloaded. They are loaded from the store again when they are used.
+    """
+
+    max_values: int
+    # The caches by sensor_id, from least to most recently used
+    _caches: OrderedDict
+    _lock: threading.Lock
+
+    def __init__(self, max_values: int):
+        self.max_values = max_values
+        self._caches = OrderedDict()
+        self._lock = threading.Lock()
+
+    def open(self, store: Optional[SeriesStore], sensor_id: int, revision_overlap: timedelta, consumer: str,
+             window_start: datetime) -> SeriesCache:
+        """The cache of a sensor, it is created if it does not exist, with the window of consumer added to it."""
+        with self._lock:
+            cache = self._caches.get(sensor_id)
+            if cache is None:
+                cache = SeriesCache(store=store, sensor_id=sensor_id, revision_overlap=revision_overlap,
+                                    since=to_ms(window_start))
+                self._caches[sensor_id] = cache
+            cache.revision_overlap = max(cache.revision_overlap, revision_overlap)
+            cache.request_window(consumer, window_start)
+            self._use(cache)
+            return cache
+
+    def touch(self, cache: SeriesCache):
+        """Mark cache as used (e.g. before reading or refreshing it), it is loaded again if it was evicted."""
+        with self._lock:
+            self._use(cache)
+
+    def _use(self, cache: SeriesCache):
+        if not cache.loaded:
+            cache.load(cache.window_start)
+        self._caches.move_to_end(cache.sensor_id)
+        total = sum(len(c.values) for c in self._caches.values())
+        for sensor_id in list(self._caches):
+            if total <= self.max_values or sensor_id == cache.sensor_id:
+                break
+            evicted = self._caches[sensor_id]
+            if evicted.is_refreshing:
+                # Its values are being merged in another thread
+                continue
+            total -= len(evicted.values)
+            evicted.unload()
+
+
+# Enough for a year of 5-minute values, the caches usually hold a week of a few sensors.
+MAX_CACHED_VALUES = 100000
+
+series_caches = SeriesCaches(MAX_CACHED_VALUES)
+
+
+def to_ms(moment: datetime) -> int:
+    """A moment as timestamp in ms, the format FM uses for event_start."""
+    return int(moment.timestamp() * 1000)
+
+
+def series_resolution(event_starts: List[int]) -> Optional[int]:
+    """The resolution (in ms) of a series, derived from its sorted event_starts.
+
+    This is the greatest common divisor of the distances between the event_starts, so gaps in the series do
+    not matter. None if there are less than two event_starts.
+    """
+    resolution = 0
+    for previous, event_start in zip(event_starts, event_starts[1:]):
+        resolution = math.gcd(resolution, event_start - previous)
+    return resolution if resolution > 0 else None
+
+
+def slot_start(moment: int, origin: int, resolution: int) -> int:
+    """The start of the slot (of a series with origin and resolution, all in ms) that contains moment."""
+    return moment - (moment - origin) % resolution
+
+
+def values_at(values: dict, moments: List[int]) -> list:
+    """The value of the event that contains each moment (in ms), None if there is none.
+
+    Parameters:
+        values (dict): the values of a series keyed by event_start in ms, the resolution is derived from them
+        moments (list): the moments to look up
+    """
+    event_starts = sorted(values)
+    resolution = series_resolution(event_starts)
+    if resolution is None:
+        return [values.get(moment) for moment in moments]
+    return [values.get(slot_start(moment, event_starts[0], resolution)) for moment in moments]
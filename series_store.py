@@ -0,0 +1,144 @@
+import os
+import sqlite3
+import threading
+from typing import Dict, Optional, Tuple
+
+# Local store of the time series of V2G Liberty: data from FM (prices, emissions, costs, power) and the metering
+# of set_fm_data. Reads for the dashboard and statistics are local, FM is used for syncing.
+#
+# The store is an SQLite database in WAL mode, so writes are appends to the log and readers do not block the
+# writer. All values are in one table with primary key (sensor_id, event_start) and without rowid, so the rows
+# of a series are stored together and in order of time, which keeps range queries cheap.
+# The store also holds the rollups (totals per day and per month) that are derived from the series.
+# The metering of set_fm_data is kept apart from the data of FM, under the negative id of the FM sensor (see
+# local_sensor_id): otherwise it would count as data from FM and the caches would not fetch the periods it covers.
+
+
+class SeriesStore:
+    """Values of series keyed by sensor_id and event_start (in ms, as FM uses), in an SQLite database."""
+
+    path: str
+    _connection: sqlite3.Connection
+    # The connection is shared by the threads of the apps (and the fetch pool of get_fm_data)
+    _lock: threading.Lock
+
+    def __init__(self, path: str):
+        self.path = path
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._lock:
+            self._connection.execute("PRAGMA journal_mode=WAL")
+            # With WAL, NORMAL is safe against corruption, only the last transactions might be lost on power failure
+            self._connection.execute("PRAGMA synchronous=NORMAL")
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS series_values ("
+                " sensor_id INTEGER NOT NULL,"
+                " event_start INTEGER NOT NULL,"
+                " value REAL,"
+                " PRIMARY KEY (sensor_id, event_start)"
+                ") WITHOUT ROWID"
+            )
+            # Materialized totals per day and per month, see rollups
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS rollups ("
+                " period TEXT NOT NULL,"
+                " period_start TEXT NOT NULL,"
+                " quantity TEXT NOT NULL,"
+                " value REAL NOT NULL,"
+                " PRIMARY KEY (period, period_start, quantity)"
+                ") WITHOUT ROWID"
+            )
+
+    def put(self, sensor_id: int, values: Dict[int, Optional[float]]):
+        """Insert or update values, keyed by event_start."""
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT OR REPLACE INTO series_values (sensor_id, event_start, value) VALUES (?, ?, ?)",
+                [(sensor_id, event_start, value) for event_start, value in values.items()],
+            )
+
+    def get_range(self, sensor_id: int, start: Optional[int] = None, end: Optional[int] = None) -> Dict[int, float]:
+        """The values from start to end (both optional), keyed by event_start and in order of time."""
+        query, params = range_query("SELECT event_start, value FROM series_values", sensor_id, start, end)
+        with self._lock:
+            rows = self._connection.execute(query + " ORDER BY event_start", params).fetchall()
+        return dict(rows)
+
+    def last_event_start(self, sensor_id: int) -> Optional[int]:
+        """The last event_start of the series, None if it has no values."""
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT MAX(event_start) FROM series_values WHERE sensor_id = ?", (sensor_id,)).fetchone()
+        return row[0]
+
+    def delete_before(self, before: int, sensor_id: Optional[int] = None):
+        """Retention: remove the values before before (in ms), of one series or of all."""
+        with self._lock, self._connection:
+            if sensor_id is None:
+                self._connection.execute("DELETE FROM series_values WHERE event_start < ?", (before,))
+            else:
+                self._connection.execute(
+                    "DELETE FROM series_values WHERE sensor_id = ? AND event_start < ?", (sensor_id, before))
+
+    def put_rollups(self, period: str, totals: Dict[str, dict]):
+        """Replace the totals of periods (e.g. "day"), keyed by the start of the period (isoformat date)."""
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "DELETE FROM rollups WHERE period = ? AND period_start = ?",
+                [(period, period_start) for period_start in totals],
+            )
+            self._connection.executemany(
+                "INSERT INTO rollups (period, period_start, quantity, value) VALUES (?, ?, ?, ?)",
+                [(period, period_start, quantity, value)
+                 for period_start, quantities in totals.items() for quantity, value in quantities.items()],
+            )
+
+    def get_rollups(self, period: str) -> Dict[str, dict]:
+        """All totals of a period (e.g. "month"), keyed by the start of the period (isoformat date)."""
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT period_start, quantity, value FROM rollups WHERE period = ?", (period,)).fetchall()
+        totals = {}
+        for period_start, quantity, value in rows:
+            totals.setdefault(period_start, {})[quantity] = value
+        return totals
+
+    def close(self):
+        with self._lock:
+            self._connection.close()
+
+
+# The stores by path, shared by the apps that run in this process
+_stores: Dict[str, SeriesStore] = {}
+_stores_lock = threading.Lock()
+
+
+def series_store_path(args: dict, config_dir: str) -> str:
+    """The path of the store from the (optional) series_store_path argument of an app, default in config_dir."""
+    return args.get("series_store_path", os.path.join(config_dir, "v2g_liberty_series.db"))
+
+
+def open_store(path: str) -> SeriesStore:
+    """The (shared) store for the database at path, it is created if it does not exist."""
+    with _stores_lock:
+        if path not in _stores:
+            _stores[path] = SeriesStore(path)
+        return _stores[path]
+
+
+def local_sensor_id(sensor_id: int) -> int:
+    """The id under which the local metering for an FM sensor is stored, FM sensor ids are positive."""
+    return -sensor_id
+
+
+def range_query(select: str, sensor_id: int, start: Optional[int], end: Optional[int]) -> Tuple[str, list]:
+    """Add the conditions for a series and the (optional) range to select, returns the query and its parameters."""
+    query = select + " WHERE sensor_id = ?"
+    params = [sensor_id]
+    if start is not None:
+        query += " AND event_start >= ?"
+        params.append(start)
+    if end is not None:
+        query += " AND event_start < ?"
+        params.append(end)
+    return query, params
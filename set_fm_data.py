@@ -2,11 +2,15 @@ from datetime import datetime, timedelta
 import json
 import math
 import requests
+import sqlite3
 import constants as c
 from typing import List, Union
 import appdaemon.plugins.hass.hassapi as hass
 from wallbox_client import WallboxModbusMixin
 from v2g_globals import time_round, time_ceil
+from event_bus import bus, MeteringInterval
+from series_cache import to_ms
+from series_store import SeriesStore, local_sensor_id, open_store, series_store_path
 
 
 # ToDo:
@@ -80,6 +84,8 @@ class SetFMdata(hass.Hass, WallboxModbusMixin):
 
     RESOLUTION_TIMEDELTA: datetime
 
+    # Local store the concluded intervals are written to (see local_sensor_id), for local-first reads.
+    series_store: SeriesStore
 
     def initialize(self):
         self.log("Initializing SetFMdata")
@@ -88,6 +94,7 @@ class SetFMdata(hass.Hass, WallboxModbusMixin):
         self.FM_ENTITY_ADDRESS_SOC =  self.args["fm_base_entity_address_soc"] + str(c.FM_ACCOUNT_SOC_SENSOR_ID)
 
         self.client = self.configure_charger_client()
+        self.series_store = open_store(series_store_path(self.args, self.config_dir))
         local_now = self.get_now()
 
         # Power related initialisation
@@ -245,6 +252,9 @@ class SetFMdata(hass.Hass, WallboxModbusMixin):
 
             self.log(
                 f"Conclude called. Average power in this period: {average_period_power} MW, Availability: {percentile_availability}%, SoC: {self.connected_car_soc}%.")
+            bus.publish(MeteringInterval(self.get_now(), average_period_power, percentile_availability,
+                                         self.connected_car_soc))
+            self.store_interval(average_period_power, percentile_availability, self.connected_car_soc)
 
         else:
             self.log(f"Period duration too short: {self.power_period_duration} s, discarding this reading.")
@@ -257,6 +267,17 @@ class SetFMdata(hass.Hass, WallboxModbusMixin):
         self.availability_duration_in_current_interval = 0
         self.un_availability_duration_in_current_interval = 0
 
+    def store_interval(self, power: float, availability: float, soc: Union[int, None]):
+        """Write the interval that has just been concluded to the local series store."""
+        interval_start = to_ms(time_round(self.get_now(), self.RESOLUTION_TIMEDELTA) - self.RESOLUTION_TIMEDELTA)
+        try:
+            self.series_store.put(local_sensor_id(c.FM_ACCOUNT_POWER_SENSOR_ID), {interval_start: power})
+            self.series_store.put(local_sensor_id(c.FM_ACCOUNT_AVAILABILITY_SENSOR_ID), {interval_start: availability})
+            if soc is not None:
+                self.series_store.put(local_sensor_id(c.FM_ACCOUNT_SOC_SENSOR_ID), {interval_start: soc})
+        except sqlite3.Error as e:
+            self.log(f"Could not write interval to the series store: {e}.")
+
     def try_send_data(self, *args):
         """ Central function for sending all readings to FM.
             Called every hour
@@ -0,0 +1,64 @@
+from datetime import datetime, timedelta
+import threading
+from typing import Hashable, Optional
+
+
+class SingleFlight:
+    """Guard that allows only one request (e.g. trigger and retrieval of a schedule) to be in flight.
+
+    + A request for the same inputs as the one in flight joins it: it is not started, the result of the request
+      in flight serves both.
+    + A request for other inputs supersedes the one in flight: it gets a new generation and the steps of the
+      previous request see (with is_current) that they should stop.
+    + A request holds a lease, if it does not finish before the lease expires a new request can be started,
+      so a request that got lost cannot block the next ones.
+    """
+
+    lease: timedelta
+
+    _lock: threading.Lock
+    _generation: int
+    _inputs: Optional[Hashable]
+    # Moment the lease of the request in flight expires, None if there is no request in flight
+    _expires_at: Optional[datetime]
+
+    def __init__(self, lease: timedelta):
+        self.lease = lease
+        self._lock = threading.Lock()
+        self._generation = 0
+        self._inputs = None
+        self._expires_at = None
+
+    def start(self, inputs: Hashable, now: datetime) -> Optional[int]:
+        """Start a request for inputs, unless the request in flight has the same inputs.
+
+        Returns:
+            The generation of the new request, None if it joins the request in flight.
+        """
+        with self._lock:
+            if self._is_in_flight(now) and inputs == self._inputs:
+                return None
+            self._generation += 1
+            self._inputs = inputs
+            self._expires_at = now + self.lease
+            return self._generation
+
+    def is_current(self, generation: int, now: datetime) -> bool:
+        """Whether the request of this generation is still in flight and not superseded."""
+        with self._lock:
+            return generation == self._generation and self._is_in_flight(now)
+
+    def finish(self, generation: int):
+        """End the request of this generation, if it has not been superseded."""
+        with self._lock:
+            if generation == self._generation:
+                self._expires_at = None
+
+    def cancel(self):
+        """Stop the request in flight, if any."""
+        with self._lock:
+            self._generation += 1
+            self._expires_at = None
+
+    def _is_in_flight(self, now: datetime) -> bool:
+        return self._expires_at is not None and now < self._expires_at
@@ -0,0 +1,167 @@
+from datetime import datetime, timedelta, tzinfo
+import math
+from typing import List, Optional, Tuple
+
+# This module has no dependency on AppDaemon so it can be used (and tested) on its own.
+#
+# All calculations are done on integer slots: the number of resolution intervals since the (UTC) epoch.
+# Only when the constraints are complete, they are formatted to isoformat in one pass (see format_segments).
+
+# A segment is a tuple of (start_slot, end_slot, value), the end_slot is inclusive.
+Segment = Tuple[int, int, float]
+
+# Names of the scenarios for the soc_maxima, see build_soc_maxima.
+SCENARIO_NO_B2MS = "0"
+SCENARIO_GRADUALLY_LOWERED = "1"
+SCENARIO_CURRENT_SOC = "2"
+SCENARIO_CALENDAR_TARGET_PRIORITY = "3"
+
+
+def resolution_in_seconds(resolution: timedelta) -> int:
+    return int(resolution.total_seconds())
+
+
+def to_slot(dt: datetime, resolution: timedelta) -> int:
+    """Round a datetime to the nearest slot (half rounds up, as v2g_globals.time_round does)."""
+    res = resolution_in_seconds(resolution)
+    return (int(dt.timestamp()) + res // 2) // res
+
+
+def ceil_slot(dt: datetime, resolution: timedelta) -> int:
+    """Slot at or directly after a datetime (as v2g_globals.time_ceil does)."""
+    res = resolution_in_seconds(resolution)
+    return -(-int(dt.timestamp()) // res)
+
+
+def minutes_to_slots(minutes: float, resolution: timedelta) -> int:
+    """Number of slots for a duration in minutes (negative for back in time), half rounds up as time_round does."""
+    res = resolution_in_seconds(resolution)
+    return (int(minutes * 60) + res // 2) // res
+
+
+def slot_to_datetime(slot: int, resolution: timedelta, tz: tzinfo) -> datetime:
+    return datetime.fromtimestamp(slot * resolution_in_seconds(resolution), tz)
+
+
+def relaxation_window_start_slot(target_slot: int, target_soc_kwh: float, max_soc_kwh: float,
+                                 max_charge_power_w: int, slack_minutes: int, resolution: timedelta) -> Optional[int]:
+    """Start of the relaxation window (SRW) before a target.
+
+    The relaxation window is the period before a calendar item where no soc_maxima should be sent to allow the
+    schedule to reach a target higher than the max_soc_kwh.
+
+    Returns:
+        The slot at which the window starts, or None if the target does not need one.
+    """
+    if target_soc_kwh <= max_soc_kwh:
+        return None
+    window_duration = math.ceil((target_soc_kwh - max_soc_kwh) / (max_charge_power_w / 1000) * 60) + slack_minutes
+    return target_slot - minutes_to_slots(window_duration, resolution)
+
+
+def build_soc_maxima(now_slot: int, srw_slot: int, current_soc_kwh: float, max_soc_kwh: float,
+                     b2ms_slot: Optional[int], max_discharge_power_w: int, resolution: timedelta,
+                     ramp_step_slots: int) -> Tuple[str, List[Segment]]:
+    """Build the soc_maxima segments for the trigger message.
+
+    The soc_maxima are used to set the boundaries for the charge schedule, the schedule cannot go above them.
+
+    Assume:
+    CTM  = Charge Target Moment which is the start of the first upcoming calendar item.
+           By default if there is no calendar item, the CTM is one week from now. This gives the
+           schedule enough freedom for the coming 27 hours (total duration of the schedule).
+    SRW  = Start of the relaxation window for the CTM, including the slack of 1 hour.
+           Only relevant for calendar items with a target SoC above the max_soc_kwh.
+           Relaxation refers to the fact that in this window the schedule does not get soc-maxima so that
+           it can charge above the max_soc_kwh to reach the higher target SoC.
+           To keep things simple, the SRW is always based on max_soc_kwh, even if the current soc is higher.
+    B2MS = The moment at which the ALLOWED_DURATION_ABOVE_MAX_SOC ends, it cannot be in the past.
+           It serves as a target with a maximum SoC (where regular targets have a minimum).
+           The CTM has a higher priority than the B2MS.
+    EMDW = End of Minimum Discharge Window. Minimum Discharge Window (MDW) = time needed to discharge from current
+           SoC to max_soc_kwh with available discharge power. EMDW = Now + MDW.
+           Note: the implementation computes EMDW as Now - MDW, unchanged from the original trigger_schedule.
+           Scenario A: In case of EMDW > B2MS then the latter is extended to EMDW.
+
+    The following scenarios need to be handled, they might in time flow from one into the other:
+    0. No B2MS
+       The soc-maxima are based on the max_soc_kwh and run from "now" up to SRW.
+    1. NOW < B2MS < SRW < CTM
+       The B2MS is not influenced by the first calendar item (or there is none)
+       SoC maxima are gradually lowered from current soc until B2MS from where they are set to max_soc_kwh.
+       TODO: A drawback of the gradual approach is that there might be discharging with low power which usually is
+             less efficient. So, if the trigger message could handle the concept "only discharge during this window"
+             it would result in better schedules. This should then replace the gradually lowered soc_maxima.
+       The FM flex-model only knows constant segments, so the line is sent as steps of ramp_step_slots.
+       Each step holds the value of the line at its start, which is never stricter than a value per slot.
+    2. NOW < SRW < B2MS < CTM and NOW < SRW < CTM < B2MS
+       In this case, the B2MS and CTM do not play a role. The soc-maxima are based on the current SoC and
+       run from "now" up to SRW.
+    3. SRW < NOW < B2MS < CTM and SRW < NOW < CTM < B2MS
+       Here the priority is to reach the CTM and so not soc-maxima.
+
+    Note that the situation where CTM < NOW is not relevant anymore and is covered by scenario 1.
+
+    Returns:
+        Tuple of the scenario and the list of segments.
+    """
+    if srw_slot < now_slot:
+        return SCENARIO_CALENDAR_TARGET_PRIORITY, []
+
+    if b2ms_slot is None:
+        return SCENARIO_NO_B2MS, constant_segment(max_soc_kwh, now_slot, srw_slot)
+
+    minimum_discharge_window = math.ceil((current_soc_kwh - max_soc_kwh) / (max_discharge_power_w / 1000) * 60)
+    # Counted back from now, as trigger_schedule always did (time_round(now - MDW)), so the schedules stay the same.
+    end_minimum_discharge_window = now_slot + minutes_to_slots(-minimum_discharge_window, resolution)
+    if end_minimum_discharge_window > b2ms_slot:
+        # Scenario A.
+        b2ms_slot = end_minimum_discharge_window
+
+    if b2ms_slot >= srw_slot:
+        return SCENARIO_CURRENT_SOC, constant_segment(current_soc_kwh, now_slot, srw_slot)
+
+    segments = ramp_segments(current_soc_kwh, max_soc_kwh, now_slot, b2ms_slot, ramp_step_slots)
+    segments += constant_segment(max_soc_kwh, b2ms_slot, srw_slot)
+    return SCENARIO_GRADUALLY_LOWERED, segments
+
+
+def constant_segment(value: float, start_slot: int, end_slot: int) -> List[Segment]:
+    """Constant value for the slots from start_slot up to (not including) end_slot, as (at most) one segment."""
+    if end_slot <= start_slot:
+        return []
+    return [(start_slot, end_slot - 1, value)]
+
+
+def ramp_segments(start_value: float, end_value: float, start_slot: int, end_slot: int,
+                  step_slots: int) -> List[Segment]:
+    """Linearly changing value for the slots from start_slot up to (not including) end_slot, as stepped segments."""
+    number_of_slots = end_slot - start_slot
+    if number_of_slots <= 0:
+        return []
+    step_kwh = (start_value - end_value) / number_of_slots
+    step_slots = max(1, step_slots)
+    return [
+        (start_slot + i, min(start_slot + i + step_slots, end_slot) - 1, start_value - (i * step_kwh))
+        for i in range(0, number_of_slots, step_slots)
+    ]
+
+
+def format_segments(segments: List[Segment], resolution: timedelta, tz: tzinfo) -> List[dict]:
+    """Format segments to soc-maxima/soc-minima items for the FM flex-model.
+
+    A segment that starts and ends in the same slot is formatted as a single datetime item.
+    SoC constraints hold at moments, the start of a slot. In the flex-model the "end" of an item is such a moment
+    and is inclusive (unlike a "duration", which excludes its end). So the end of an item is the start of the
+    (inclusive) end_slot: the item covers the same moments as the slots of the segment, not one slot more.
+    """
+    res = resolution_in_seconds(resolution)
+    items = []
+    for start_slot, end_slot, value in segments:
+        start = datetime.fromtimestamp(start_slot * res, tz).isoformat()
+        if start_slot == end_slot:
+            items.append({"value": value, "datetime": start})
+        else:
+            end = datetime.fromtimestamp(end_slot * res, tz).isoformat()
+            items.append({"value": value, "start": start, "end": end})
+    return items
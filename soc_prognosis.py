@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta
+from typing import List
+
+
+def expected_soc_values(values_in_MW: List[float], resolution: timedelta, soc: float, max_soc_in_kWh: float,
+                        round_trip_efficiency: float) -> List[float]:
+    """The expected SoC (in %) at the start of each slot of a schedule and at its end.
+
+    For example, if a 62 kWh battery produces at 0.00575 MW for a period of 15 minutes,
+    its SoC increases by just over 2.3%.
+
+    Parameters:
+        values_in_MW (list): the (dis)charge power per slot
+        resolution (timedelta): the duration of a slot
+        soc (float): the SoC (in %) at the start of the schedule
+        max_soc_in_kWh (float): the capacity of the battery
+        round_trip_efficiency (float): efficiency of charging and then discharging
+    Returns:
+        List of len(values_in_MW) + 1 SoC values.
+    """
+    # The efficiency applies half on charging, half on discharging, so there are two factors from MW to %.
+    # Plain Python instead of array operations, the apps do not depend on NumPy. With the factors computed once
+    # this is one pass, see benchmarks/bench_soc_prognosis.py.
+    e = round_trip_efficiency ** 0.5
+    scalar = resolution / timedelta(hours=1) * 1000 * 100 / max_soc_in_kWh
+    charge_factor = scalar * e
+    discharge_factor = scalar / e
+
+    soc_values = [soc]
+    for v in values_in_MW:
+        soc += v * (charge_factor if v >= 0 else discharge_factor)
+        soc_values.append(soc)
+    return soc_values
+
+
+def simplify(soc_values: List[float], tolerance: float) -> List[int]:
+    """Indices of the SoC values that are needed to draw the prognosis as lines, within tolerance.
+
+    Values that are (nearly) on the line between their neighbours are dropped (Douglas-Peucker), so a
+    schedule with long runs of equal power results in tens of points instead of hundreds.
+
+    Parameters:
+        soc_values (list): SoC values at equal distances in time
+        tolerance (float): maximum deviation (in %) of the lines from the dropped values
+    Returns:
+        Sorted list of indices of the values to keep, always including the first and the last.
+    """
+    last = len(soc_values) - 1
+    if last < 2:
+        return list(range(len(soc_values)))
+
+    keep = [False] * len(soc_values)
+    keep[0] = keep[last] = True
+    stack = [(0, last)]
+    while stack:
+        first, end = stack.pop()
+        slope = (soc_values[end] - soc_values[first]) / (end - first)
+        max_deviation = 0.0
+        max_index = None
+        for i in range(first + 1, end):
+            deviation = abs(soc_values[first] + slope * (i - first) - soc_values[i])
+            if deviation > max_deviation:
+                max_deviation = deviation
+                max_index = i
+        if max_index is not None and max_deviation > tolerance:
+            keep[max_index] = True
+            stack.append((first, max_index))
+            stack.append((max_index, end))
+    return [i for i, is_kept in enumerate(keep) if is_kept]
+
+
+def prognosis_records(start: datetime, resolution: timedelta, soc_values: List[float],
+                      tolerance: float = 0.1) -> List[dict]:
+    """Records of time (isoformat) and SoC (%) for the graph, simplified within tolerance."""
+    return [
+        dict(time=(start + i * resolution).isoformat(), soc=round(soc_values[i], 2))
+        for i in simplify(soc_values, tolerance)
+    ]
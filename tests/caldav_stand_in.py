@@ -0,0 +1,81 @@
+from typing import Dict, List, Tuple
+from xml.sax.saxutils import escape
+import xml.etree.ElementTree as ET
+
+from caldav_calendar import CALDAV, CALENDARSERVER, DAV
+
+
+class CalDAVStandIn:
+    """An in-memory CalDAV calendar collection, used as the session of a CalDAVCalendar.
+
+    It answers the requests CalDAVCalendar makes: PROPFIND of the ctag, REPORT calendar-query of the etags and
+    REPORT calendar-multiget of items. Recurring items are not expanded and the time-range is not applied,
+    the items are returned as they were put. The requests are recorded, so tests can check what was fetched.
+    """
+
+    # The iCalendar text and etag per item (href)
+    items: Dict[str, Tuple[str, str]]
+    ctag: int
+    # Method and, for a multiget, the requested hrefs of each request
+    requests: List[Tuple[str, List[str]]]
+
+    def __init__(self):
+        self.items = {}
+        self.ctag = 1
+        self.requests = []
+        self._etag = 0
+
+    def put(self, href: str, ical: str):
+        self._etag += 1
+        self.items[href] = (ical, f'"{self._etag}"')
+        self.ctag += 1
+
+    def delete(self, href: str):
+        del self.items[href]
+        self.ctag += 1
+
+    def multigets(self) -> List[List[str]]:
+        """The hrefs requested by each multiget."""
+        return [hrefs for method, hrefs in self.requests if method == "multiget"]
+
+    def request(self, method: str, url: str, data: bytes, headers: dict, timeout: int) -> "StandInResponse":
+        body = ET.fromstring(data)
+        if method == "PROPFIND":
+            self.requests.append(("PROPFIND", []))
+            return StandInResponse(multistatus(
+                f'<d:response><d:href>{url}</d:href><d:propstat><d:prop>'
+                f'<cs:getctag>{self.ctag}</cs:getctag></d:prop></d:propstat></d:response>'))
+        if body.tag == f"{{{CALDAV}}}calendar-query":
+            self.requests.append(("query", []))
+            return StandInResponse(multistatus("".join(
+                f'<d:response><d:href>{href}</d:href><d:propstat><d:prop>'
+                f'<d:getetag>{escape(etag)}</d:getetag></d:prop></d:propstat></d:response>'
+                for href, (_, etag) in self.items.items())))
+        hrefs = [href.text for href in body.iter(f"{{{DAV}}}href")]
+        self.requests.append(("multiget", hrefs))
+        return StandInResponse(multistatus("".join(
+            f'<d:response><d:href>{href}</d:href><d:propstat><d:prop>'
+            f'<d:getetag>{escape(self.items[href][1])}</d:getetag>'
+            f'<c:calendar-data>{escape(self.items[href][0])}</c:calendar-data></d:prop></d:propstat></d:response>'
+            for href in hrefs if href in self.items)))
+
+
+class StandInResponse:
+    def __init__(self, text: str):
+        self.content = text.encode("utf-8")
+
+    def raise_for_status(self):
+        pass
+
+
+def multistatus(responses: str) -> str:
+    return f'<d:multistatus xmlns:d="{DAV}" xmlns:c="{CALDAV}" xmlns:cs="{CALENDARSERVER}">{responses}</d:multistatus>'
+
+
+def vevent(uid: str, dtstart: str, summary: str = "Trip", extra: str = "") -> str:
+    """An iCalendar text with one VEVENT, dtstart is the full DTSTART line."""
+    return (
+        "BEGIN:VCALENDAR\r\nVERSION:2.0\r\nBEGIN:VEVENT\r\n"
+        f"UID:{uid}\r\n{dtstart}\r\nSUMMARY:{summary}\r\n{extra}"
+        "END:VEVENT\r\nEND:VCALENDAR\r\n"
+    )
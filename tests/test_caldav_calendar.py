@@ -0,0 +1,101 @@
+from datetime import datetime, timedelta
+
+import pytz
+
+from caldav_calendar import CalDAVCalendar, parse_vevents, unfold_lines
+from caldav_stand_in import CalDAVStandIn, vevent
+
+TZ = pytz.timezone("Europe/Amsterdam")
+START = TZ.localize(datetime(2026, 10, 19, 12, 0))
+END = START + timedelta(days=7)
+
+
+def calendar_with(server: CalDAVStandIn) -> CalDAVCalendar:
+    calendar = CalDAVCalendar("https://caldav.example.org/calendars/car/", "user", "secret", TZ)
+    calendar.session = server
+    return calendar
+
+
+def test_folded_lines_are_unfolded():
+    ical = vevent("a", "DTSTART:20261020T080000Z", summary="Trip to",
+                  extra="DESCRIPTION:Target\r\n  90%\\, on\r\n\tthe road\r\n")
+    ical = ical.replace("SUMMARY:Trip to\r\n", "SUMMARY:Trip to\r\n  Amsterdam\r\n")
+    assert "SUMMARY:Trip to Amsterdam" in unfold_lines(ical)
+    event = parse_vevents(ical, TZ)[0]
+    assert event["summary"] == "Trip to Amsterdam"
+    assert event["description"] == "Target 90%, onthe road"
+
+
+def test_dtstart_in_utc():
+    event = parse_vevents(vevent("a", "DTSTART:20261020T080000Z"), TZ)[0]
+    assert event["start"] == "2026-10-20T10:00:00+02:00"
+
+
+def test_dtstart_with_tzid():
+    event = parse_vevents(vevent("a", "DTSTART;TZID=America/New_York:20261020T080000"), TZ)[0]
+    assert event["start"] == "2026-10-20T14:00:00+02:00"
+
+
+def test_dtstart_with_unknown_tzid_is_local():
+    event = parse_vevents(vevent("a", 'DTSTART;TZID="Custom Zone":20261020T080000'), TZ)[0]
+    assert event["start"] == "2026-10-20T08:00:00+02:00"
+
+
+def test_all_day_dtstart():
+    event = parse_vevents(vevent("a", "DTSTART;VALUE=DATE:20261026", extra="DTEND;VALUE=DATE:20261027\r\n"), TZ)[0]
+    # Daylight saving time has ended on the 25th
+    assert event["start"] == "2026-10-26T00:00:00+01:00"
+    assert event["end"] == "2026-10-27T00:00:00+01:00"
+
+
+def test_event_without_dtstart_is_ignored():
+    ical = "BEGIN:VCALENDAR\r\nBEGIN:VEVENT\r\nUID:a\r\nSUMMARY:No start\r\nEND:VEVENT\r\nEND:VCALENDAR\r\n"
+    assert parse_vevents(ical, TZ) == []
+
+
+def test_sync_fetches_only_changed_items():
+    server = CalDAVStandIn()
+    server.put("/car/a.ics", vevent("a", "DTSTART:20261020T080000Z"))
+    server.put("/car/b.ics", vevent("b", "DTSTART:20261021T080000Z"))
+    calendar = calendar_with(server)
+
+    assert calendar.sync(START, END)
+    assert sorted(event["uid"] for event in calendar.events()) == ["a", "b"]
+    assert server.multigets() == [["/car/a.ics", "/car/b.ics"]]
+
+    # Unchanged ctag: only the ctag is requested
+    server.requests.clear()
+    assert not calendar.sync(START, END)
+    assert server.requests == [("PROPFIND", [])]
+
+    server.put("/car/b.ics", vevent("b", "DTSTART:20261022T080000Z"))
+    server.requests.clear()
+    assert calendar.sync(START, END)
+    assert server.multigets() == [["/car/b.ics"]]
+    assert {event["uid"]: event["start"] for event in calendar.events()}["b"] == "2026-10-22T10:00:00+02:00"
+
+
+def test_sync_removes_deleted_items():
+    server = CalDAVStandIn()
+    server.put("/car/a.ics", vevent("a", "DTSTART:20261020T080000Z"))
+    server.put("/car/b.ics", vevent("b", "DTSTART:20261021T080000Z"))
+    calendar = calendar_with(server)
+    calendar.sync(START, END)
+
+    server.delete("/car/a.ics")
+    server.requests.clear()
+    assert calendar.sync(START, END)
+    assert [event["uid"] for event in calendar.events()] == ["b"]
+    assert server.multigets() == []
+
+
+def test_forced_sync_refetches_only_recurring_items():
+    server = CalDAVStandIn()
+    server.put("/car/a.ics", vevent("a", "DTSTART:20261020T080000Z"))
+    server.put("/car/weekly.ics", vevent("weekly", "DTSTART:20261020T060000Z", extra="RRULE:FREQ=WEEKLY\r\n"))
+    calendar = calendar_with(server)
+    calendar.sync(START, END)
+
+    server.requests.clear()
+    assert not calendar.sync(START, END, force=True)
+    assert server.multigets() == [["/car/weekly.ics"]]
@@ -0,0 +1,68 @@
+from datetime import datetime, timedelta
+
+import pytest
+import pytz
+
+import constants as c
+from calendar_index import CalendarIndex
+
+TZ = pytz.timezone("Europe/Amsterdam")
+NOW = TZ.localize(datetime(2026, 10, 19, 12, 0))
+
+
+@pytest.fixture(autouse=True)
+def car(monkeypatch):
+    # Set by v2g_globals from the configuration
+    monkeypatch.setattr(c, "CAR_MAX_CAPACITY_IN_KWH", 60.0, raising=False)
+    monkeypatch.setattr(c, "CAR_MIN_SOC_IN_KWH", 12.0, raising=False)
+    monkeypatch.setattr(c, "CAR_AVERAGE_WH_PER_KM", 174, raising=False)
+
+
+def event(hours: int, summary: str, uid: str = "") -> dict:
+    start = NOW + timedelta(hours=hours)
+    return {"uid": uid, "start": start.isoformat(), "end": (start + timedelta(hours=1)).isoformat(), "summary": summary}
+
+
+def test_targets_in_order_of_start():
+    index = CalendarIndex()
+    assert index.update([event(30, "Trip 80%"), event(5, "Work 30 kWh"), event(50, "Holiday")], TZ)
+    assert [t.soc_kwh for t in index.targets_before(NOW + timedelta(days=7))] == [30.0, 48.0, 60.0]
+    assert [t.soc_kwh for t in index.targets_before(NOW + timedelta(hours=30))] == [30.0]
+    assert index.first_target_after(NOW + timedelta(hours=6)).soc_kwh == 48.0
+    assert index.first_target_after(NOW + timedelta(hours=51)) is None
+
+
+def test_targets_between_leaves_out_passed_items():
+    index = CalendarIndex()
+    index.update([event(-2, "Work 30 kWh"), event(0, "Trip 40 kWh"), event(5, "Trip 80%"), event(30, "Holiday")], TZ)
+    # The index keeps passed items until the next calendar update
+    assert len(index) == 4
+    assert [t.soc_kwh for t in index.targets_between(NOW, NOW + timedelta(hours=30))] == [40.0, 48.0]
+    assert [t.soc_kwh for t in index.targets_between(NOW + timedelta(hours=1), NOW + timedelta(days=7))] == [48.0, 60.0]
+
+
+def test_update_only_reports_changes():
+    index = CalendarIndex()
+    events = [event(5, "Work 30 kWh", uid="a"), event(30, "Trip 100 km", uid="b")]
+    assert index.update(events, TZ)
+    assert not index.update(list(reversed(events)), TZ)
+    # Editing an item replaces it
+    assert index.update([event(5, "Work 40 kWh", uid="a"), events[1]], TZ)
+    assert len(index) == 2
+    assert [t.soc_kwh for t in index.targets_before(NOW + timedelta(days=7))] == [40.0, 29.4]
+    assert index.update([events[1]], TZ)
+    assert len(index) == 1
+
+
+def test_items_with_the_same_start_are_kept_apart():
+    index = CalendarIndex()
+    index.update([event(5, "Work 30 kWh", uid="a"), event(5, "Trip 50 kWh", uid="b")], TZ)
+    assert sorted(t.soc_kwh for t in index.targets_before(NOW + timedelta(days=1))) == [30.0, 50.0]
+    index.update([event(5, "Trip 50 kWh", uid="b")], TZ)
+    assert [t.soc_kwh for t in index.targets_before(NOW + timedelta(days=1))] == [50.0]
+
+
+def test_all_day_items_start_at_midnight():
+    index = CalendarIndex()
+    index.update([{"start": "2026-10-21", "end": "2026-10-22", "summary": "Trip"}], TZ)
+    assert index.first_target_after(NOW).start == TZ.localize(datetime(2026, 10, 21, 0, 0))
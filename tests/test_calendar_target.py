@@ -0,0 +1,49 @@
+from datetime import datetime
+
+import pytest
+import pytz
+
+import constants as c
+from calendar_target import parse_calendar_datetime, search_for_soc_target, target_from_text
+
+TZ = pytz.timezone("Europe/Amsterdam")
+START = TZ.localize(datetime(2026, 10, 20, 8, 0))
+
+
+@pytest.fixture(autouse=True)
+def car(monkeypatch):
+    # Set by v2g_globals from the configuration
+    monkeypatch.setattr(c, "CAR_MAX_CAPACITY_IN_KWH", 60.0, raising=False)
+    monkeypatch.setattr(c, "CAR_MIN_SOC_IN_KWH", 12.0, raising=False)
+    monkeypatch.setattr(c, "CAR_AVERAGE_WH_PER_KM", 174, raising=False)
+
+
+@pytest.mark.parametrize("text, soc_kwh", [
+    ("Trip", 60.0),
+    ("Work 30 kWh", 30.0),
+    ("Work 30KWH, 80%", 30.0),
+    ("Trip  80 %", 48.0),
+    ("Trip 100km", 29.4),
+    ("Trip 500 km", 60.0),
+    ("Shopping 5 kwh", 12.0),
+])
+def test_target_from_text(text, soc_kwh):
+    target = target_from_text(START, text)
+    assert target.start == START
+    assert target.soc_kwh == pytest.approx(soc_kwh)
+
+
+def test_search_for_soc_target():
+    assert search_for_soc_target("%", "Back at 7:00, 90% please") == 90
+    assert search_for_soc_target("km", "No unit 200") is None
+    assert search_for_soc_target("kWh", None) is None
+
+
+@pytest.mark.parametrize("value, expected", [
+    ("2026-10-20T08:00:00+02:00", TZ.localize(datetime(2026, 10, 20, 8, 0))),
+    ("2026-10-20T06:00:00Z", TZ.localize(datetime(2026, 10, 20, 8, 0))),
+    ("2026-10-20 08:00:00", TZ.localize(datetime(2026, 10, 20, 8, 0))),
+    ("2026-10-26", TZ.localize(datetime(2026, 10, 26, 0, 0))),
+])
+def test_parse_calendar_datetime(value, expected):
+    assert parse_calendar_datetime(value, TZ) == expected
@@ -0,0 +1,78 @@
+from datetime import datetime, timedelta, timezone
+
+from chart_series import ChartPublisher, downsample_min_max, trim
+from series_cache import Series, to_ms
+
+HOUR_MS = 60 * 60 * 1000
+NOW = datetime(2026, 10, 19, 12, 20, tzinfo=timezone.utc)
+
+
+def test_trim_keeps_the_value_at_the_start():
+    event_starts = [0, HOUR_MS, 2 * HOUR_MS, 3 * HOUR_MS, 4 * HOUR_MS]
+    assert trim(event_starts, [1, 2, 3, 4, 5], HOUR_MS + 1000, 3 * HOUR_MS) == ([HOUR_MS + 1000, 2 * HOUR_MS], [2, 3])
+    assert trim(event_starts, [1, 2, 3, 4, 5], HOUR_MS, 3 * HOUR_MS) == ([HOUR_MS, 2 * HOUR_MS], [2, 3])
+    assert trim(event_starts, [1, 2, 3, 4, 5], 10 * HOUR_MS, 11 * HOUR_MS) == ([10 * HOUR_MS], [5])
+    assert trim(event_starts, [1, 2, 3, 4, 5], -2 * HOUR_MS, -HOUR_MS) == ([], [])
+
+
+def test_downsample_keeps_the_peaks():
+    values = [10.0] * 100
+    values[17] = -50.0
+    values[83] = 400.0
+    event_starts = list(range(100))
+    downsampled_starts, downsampled_values = downsample_min_max(event_starts, values, 10)
+    assert len(downsampled_starts) <= 10
+    assert downsampled_starts == sorted(downsampled_starts)
+    assert -50.0 in downsampled_values and 400.0 in downsampled_values
+
+
+def test_short_series_are_not_downsampled():
+    assert downsample_min_max([1, 2, 3], [1, None, 3], 10) == ([1, 2, 3], [1, None, 3])
+
+
+def test_none_values_are_left_out_of_the_buckets():
+    downsampled = downsample_min_max(list(range(8)), [None, None, None, None, 1, 2, 3, 4], 4)
+    assert downsampled == ([4, 7], [1, 4])
+
+
+class Recorder:
+    def __init__(self):
+        self.states = []
+
+    def set_state(self, entity_id, state, attributes):
+        self.states.append((entity_id, state, attributes))
+
+
+def publisher(recorder: Recorder) -> ChartPublisher:
+    return ChartPublisher(recorder.set_state, view_before=timedelta(hours=12), view_duration=timedelta(hours=36),
+                          max_points=200)
+
+
+def hourly_series(hours: int) -> Series:
+    start = to_ms(NOW.replace(minute=0) - timedelta(days=2))
+    return Series([start + i * HOUR_MS for i in range(hours)], [float(i) for i in range(hours)])
+
+
+def test_publish_trims_to_the_window():
+    recorder = Recorder()
+    charts = publisher(recorder)
+    series = hourly_series(24 * 7)
+    assert charts.publish("input_text.epex_prices", "price", series, series.values, state="x", now=NOW)
+    start, end = charts.window(NOW)
+    assert start <= to_ms(NOW - timedelta(hours=12)) and end >= to_ms(NOW + timedelta(hours=24))
+    records = recorder.states[-1][2]["records"]
+    assert 36 <= len(records) < 24 * 7
+    assert datetime.fromisoformat(records[0]["time"]).timestamp() * 1000 == start
+
+
+def test_unchanged_records_are_not_written_again():
+    recorder = Recorder()
+    charts = publisher(recorder)
+    series = hourly_series(24 * 7)
+    charts.publish("input_text.epex_prices", "price", series, series.values, state="x", now=NOW)
+    assert not charts.publish("input_text.epex_prices", "price", series, series.values, state="x", now=NOW)
+    # Within the same trim step the window does not change
+    charts.refresh(NOW + timedelta(minutes=30))
+    assert len(recorder.states) == 1
+    charts.refresh(NOW + ChartPublisher.TRIM_STEP)
+    assert len(recorder.states) == 2
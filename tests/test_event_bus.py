@@ -0,0 +1,104 @@
+from datetime import datetime, timezone
+
+from event_bus import EventBus, MeteringInterval, NoScheduleError, ScheduleInputChanged
+
+NOW = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+
+
+class App:
+    """The run_in of an AppDaemon app, the callbacks run when the test calls run_pending."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.pending = []
+        self.logged = []
+
+    def run_in(self, callback, delay, **kwargs):
+        self.pending.append((callback, kwargs))
+
+    def log(self, message):
+        self.logged.append(message)
+
+    def run_pending(self):
+        while self.pending:
+            callback, kwargs = self.pending.pop(0)
+            callback(kwargs)
+
+
+class Subscriber:
+    def __init__(self):
+        self.events = []
+
+    def handle(self, event):
+        self.events.append(event)
+
+
+def test_events_are_delivered_in_the_thread_of_the_subscriber():
+    bus = EventBus()
+    app = App("v2g_liberty")
+    subscriber = Subscriber()
+    bus.subscribe(ScheduleInputChanged, app, subscriber.handle)
+    bus.publish(ScheduleInputChanged("calendar"))
+    bus.publish(ScheduleInputChanged("prices"))
+    bus.publish(MeteringInterval(NOW, 0.011, 100.0, 50))
+    assert subscriber.events == []
+    # One drain for both events
+    assert len(app.pending) == 1
+    app.run_pending()
+    assert [event.reason for event in subscriber.events] == ["calendar", "prices"]
+
+
+def test_publish_without_subscribers():
+    EventBus().publish(ScheduleInputChanged("calendar"))
+
+
+def test_subscribing_again_replaces_the_subscription():
+    bus = EventBus()
+    app = App("v2g_liberty")
+    subscriber = Subscriber()
+    bus.subscribe(ScheduleInputChanged, app, subscriber.handle)
+    bus.subscribe(ScheduleInputChanged, app, subscriber.handle)
+    bus.publish(ScheduleInputChanged("calendar"))
+    app.run_pending()
+    assert len(subscriber.events) == 1
+
+
+def test_slow_subscriber_drops_the_oldest_events():
+    bus = EventBus()
+    app = App("v2g_liberty")
+    subscriber = Subscriber()
+    bus.subscribe(MeteringInterval, app, subscriber.handle, max_queue_length=2)
+    for soc in (50, 51, 52):
+        bus.publish(MeteringInterval(NOW, 0.011, 100.0, soc))
+    app.run_pending()
+    assert [event.soc for event in subscriber.events] == [51, 52]
+
+
+def test_unbounded_subscription_keeps_all_events():
+    bus = EventBus()
+    app = App("v2g_liberty")
+    subscriber = Subscriber()
+    bus.subscribe(NoScheduleError, app, subscriber.handle, max_queue_length=None)
+    for i in range(150):
+        bus.publish(NoScheduleError("timeouts_on_schedule", i % 2 == 0))
+    app.run_pending()
+    assert len(subscriber.events) == 150
+    assert subscriber.events[-1].error_state is False
+
+
+def test_failing_callback_does_not_stop_the_drain():
+    bus = EventBus()
+    app = App("v2g_liberty")
+    handled = []
+
+    def handle(event):
+        handled.append(event.reason)
+        if event.reason == "calendar":
+            raise ValueError("oops")
+
+    bus.subscribe(ScheduleInputChanged, app, handle)
+    bus.publish(ScheduleInputChanged("calendar"))
+    bus.publish(ScheduleInputChanged("prices"))
+    app.run_pending()
+    assert handled == ["calendar", "prices"]
+    assert len(app.logged) == 1
@@ -0,0 +1,119 @@
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+import local_scheduler as ls
+
+RESOLUTION = timedelta(minutes=5)
+HOUR_MS = 60 * 60 * 1000
+START = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+START_MS = int(START.timestamp() * 1000)
+START_SLOT = START_MS // (5 * 60 * 1000)
+CAPACITY_KWH = 60.0
+MAX_POWER_W = 11000
+EFFICIENCY = 0.85
+
+
+def hourly_signal(prices):
+    return {START_MS + i * HOUR_MS: price for i, price in enumerate(prices)}
+
+
+def soc_after(values, soc_kwh):
+    """The SoC after the values (MW per slot), as the scheduler accounts for the efficiency."""
+    e = EFFICIENCY ** 0.5
+    hours = RESOLUTION / timedelta(hours=1)
+    for value in values:
+        soc_kwh += ls.soc_change_for_power(value, e, hours)
+    return soc_kwh
+
+
+def plan(prices, current_soc_kwh, soc_minima=(), soc_maxima=()):
+    blocks = ls.signal_blocks(hourly_signal(prices), START_SLOT, START_SLOT + 12 * len(prices), RESOLUTION)
+    return ls.plan_schedule(blocks, current_soc_kwh, list(soc_minima), list(soc_maxima), min_soc_kwh=12.0,
+                            capacity_kwh=CAPACITY_KWH, max_charge_power_w=MAX_POWER_W,
+                            max_discharge_power_w=MAX_POWER_W, roundtrip_efficiency=EFFICIENCY,
+                            resolution=RESOLUTION)
+
+
+def test_signal_blocks_start_at_the_start_slot():
+    blocks = ls.signal_blocks(hourly_signal([10, 20, 30]), START_SLOT + 6, START_SLOT + 36, RESOLUTION)
+    assert blocks == [(START_SLOT + 6, START_SLOT + 12, 10.0), (START_SLOT + 12, START_SLOT + 24, 20.0),
+                      (START_SLOT + 24, START_SLOT + 36, 30.0)]
+
+
+def test_signal_blocks_stop_at_a_gap():
+    signal = hourly_signal([10, None, 30, 40])
+    assert ls.signal_blocks(signal, START_SLOT, START_SLOT + 48, RESOLUTION) == [(START_SLOT, START_SLOT + 12, 10.0)]
+    del signal[START_MS + HOUR_MS]
+    assert ls.signal_blocks(signal, START_SLOT, START_SLOT + 48, RESOLUTION) == [(START_SLOT, START_SLOT + 12, 10.0)]
+
+
+def test_signal_blocks_need_a_signal_at_the_start():
+    assert ls.signal_blocks(hourly_signal([10, 20]), START_SLOT - 12, START_SLOT + 24, RESOLUTION) == []
+    assert ls.signal_blocks({}, START_SLOT, START_SLOT + 24, RESOLUTION) == []
+
+
+def test_no_blocks_no_schedule():
+    assert ls.plan_schedule([], 30.0, [], [], 12.0, CAPACITY_KWH, MAX_POWER_W, MAX_POWER_W, EFFICIENCY,
+                            RESOLUTION) is None
+
+
+def test_charges_when_cheap_and_discharges_when_expensive():
+    values = plan([50, 50, 300, 300], 30.0)
+    assert len(values) == 48
+    assert all(value >= 0 for value in values[:24]) and sum(values[:24]) > 0
+    assert all(value <= 0 for value in values[24:]) and sum(values[24:]) < 0
+
+
+def test_stays_within_the_limits():
+    values = plan([10, 300, 10, 300, 10, 300], 50.0)
+    assert max(values) <= MAX_POWER_W / 1000000 + 1e-9
+    assert min(values) >= -MAX_POWER_W / 1000000 - 1e-9
+    soc_kwh = 50.0
+    for i in range(0, len(values), 12):
+        soc_kwh = soc_after(values[i:i + 12], soc_kwh)
+        assert 12.0 - 0.1 <= soc_kwh <= CAPACITY_KWH + 0.1
+
+
+def test_meets_a_soc_minimum_despite_the_prices():
+    # Expensive all the way, but the car needs to be charged to 50 kWh at the end of the third hour
+    target_slot = START_SLOT + 36
+    values = plan([300, 300, 300, 300], 30.0, soc_minima=[(target_slot, target_slot, 50.0)])
+    assert soc_after(values[:36], 30.0) >= 50.0 - 0.1
+
+
+def test_respects_a_soc_maximum():
+    values = plan([10, 10, 10], 30.0, soc_maxima=[(START_SLOT, START_SLOT + 36, 40.0)])
+    assert soc_after(values, 30.0) <= 40.0 + 0.1
+
+
+def test_grid_energy_and_soc_change_are_inverse():
+    e = EFFICIENCY ** 0.5
+    hours = RESOLUTION / timedelta(hours=1)
+    for soc_change_kwh in (0.9, -0.9, 0.0):
+        power_mw = ls.power_for_soc_change(soc_change_kwh, e, hours)
+        assert ls.soc_change_for_power(power_mw, e, hours) == pytest.approx(soc_change_kwh)
+
+
+def test_correct_for_drift_returns_to_the_planned_soc():
+    values = [0.005] * 12 + [0.0] * 12
+    corrected = ls.correct_for_drift(values, drift_kwh=-1.5, catch_up_slots=6, max_charge_power_w=MAX_POWER_W,
+                                     max_discharge_power_w=MAX_POWER_W, roundtrip_efficiency=EFFICIENCY,
+                                     resolution=RESOLUTION)
+    assert corrected[6:] == values[6:]
+    assert soc_after(corrected[:6], 30.0 - 1.5) == pytest.approx(soc_after(values[:6], 30.0), abs=1e-3)
+
+
+def test_correct_for_drift_within_the_limits_of_the_charger():
+    values = [0.011] * 12
+    # Behind the plan while charging at full power: it cannot be corrected
+    corrected = ls.correct_for_drift(values, drift_kwh=-0.5, catch_up_slots=3, max_charge_power_w=MAX_POWER_W,
+                                     max_discharge_power_w=MAX_POWER_W, roundtrip_efficiency=EFFICIENCY,
+                                     resolution=RESOLUTION)
+    assert corrected == values
+    # Ahead of the plan: charge less
+    corrected = ls.correct_for_drift(values, drift_kwh=0.5, catch_up_slots=3, max_charge_power_w=MAX_POWER_W,
+                                     max_discharge_power_w=MAX_POWER_W, roundtrip_efficiency=EFFICIENCY,
+                                     resolution=RESOLUTION)
+    assert all(value < 0.011 for value in corrected[:3])
+    assert soc_after(corrected[:3], 30.5) == pytest.approx(soc_after(values[:3], 30.0), abs=1e-3)
@@ -0,0 +1,124 @@
+import pytest
+
+from rolling_statistics import RollingStatistics, charged_energy_intervals, energy_contributions, interval_start
+
+MINUTE = 60 * 1000
+HOUR = 60 * MINUTE
+DAY = 24 * HOUR
+
+
+def test_totals_over_the_window():
+    statistics = RollingStatistics(window=7 * DAY)
+    statistics.add(0, {"charged_energy": 1.0}, now=5 * MINUTE)
+    statistics.add(5 * MINUTE, {"charged_energy": 2.0, "emissions": 0.5}, now=10 * MINUTE)
+    assert statistics.total("charged_energy") == 3.0
+    assert statistics.total("emissions") == 0.5
+    assert statistics.total("discharged_energy") == 0
+
+
+def test_intervals_expire_when_they_leave_the_window():
+    statistics = RollingStatistics(window=DAY)
+    statistics.add(0, {"charged_energy": 1.0}, now=5 * MINUTE)
+    statistics.add(HOUR, {"charged_energy": 2.0}, now=HOUR + 5 * MINUTE)
+    statistics.expire(DAY + 30 * MINUTE)
+    assert statistics.total("charged_energy") == 2.0
+    statistics.add(DAY + 2 * HOUR, {"charged_energy": 4.0}, now=DAY + 2 * HOUR + 5 * MINUTE)
+    assert statistics.total("charged_energy") == 4.0
+
+
+def test_reconcile_replaces_the_intervals_until():
+    statistics = RollingStatistics(window=7 * DAY)
+    for i in range(4):
+        statistics.add(i * HOUR, {"charged_energy": 1.0}, now=(i + 1) * HOUR)
+    # FM has data up to 2:00, one revised interval
+    statistics.reconcile([(0, {"charged_energy": 5.0}), (HOUR, {"discharged_energy": -2.0})], until=2 * HOUR,
+                         now=4 * HOUR)
+    assert statistics.total("charged_energy") == 7.0
+    assert statistics.total("discharged_energy") == -2.0
+
+
+def test_energy_contributions():
+    # 11 kW during 5 minutes
+    charging = energy_contributions(0.011, 5 * MINUTE, emission_intensity=300.0)
+    assert charging["charged_energy"] == pytest.approx(11 / 12)
+    assert charging["charged_minutes"] == 5
+    assert charging["emissions"] == pytest.approx(0.011 * 300 / 12)
+    discharging = energy_contributions(-0.011, 5 * MINUTE, emission_intensity=300.0)
+    assert discharging["discharged_energy"] == pytest.approx(-11 / 12)
+    assert discharging["saved_emissions"] == pytest.approx(-0.011 * 300 / 12)
+    assert energy_contributions(0.0, 5 * MINUTE, emission_intensity=300.0) == {}
+
+
+def test_interval_start_rounds_the_end_to_the_slot():
+    end = 1792396800000
+    assert interval_start(end, 5 * MINUTE) == end - 5 * MINUTE
+    # Concluded a little after or before the end of the interval
+    assert interval_start(end + 1500, 5 * MINUTE) == end - 5 * MINUTE
+    assert interval_start(end - 800, 5 * MINUTE) == end - 5 * MINUTE
+    assert interval_start(end + 2 * MINUTE, 5 * MINUTE) == end - 5 * MINUTE
+
+
+def series(resolution: int, values: list, origin: int = 0) -> dict:
+    return {origin + i * resolution: value for i, value in enumerate(values)}
+
+
+def test_charged_energy_intervals_5_minute_power_15_minute_emissions():
+    power = series(5 * MINUTE, [0.011, 0.011, None, -0.011, 0.0, 0.011])
+    intervals = charged_energy_intervals(power, series(15 * MINUTE, [300.0, 200.0]), default_resolution=HOUR)
+    assert [start for start, _ in intervals] == [0, 5 * MINUTE, 15 * MINUTE, 20 * MINUTE, 25 * MINUTE]
+    assert intervals[0][1]["emissions"] == pytest.approx(0.011 * 300 / 12)
+    assert intervals[2][1]["saved_emissions"] == pytest.approx(-0.011 * 200 / 12)
+    assert intervals[3][1] == {}
+    assert intervals[4][1]["charged_minutes"] == 5
+
+
+def test_charged_energy_intervals_15_minute_power_hourly_emissions():
+    power = series(15 * MINUTE, [0.004] * 5)
+    intervals = charged_energy_intervals(power, series(HOUR, [300.0, 100.0]), default_resolution=5 * MINUTE)
+    assert [contributions["charged_minutes"] for _, contributions in intervals] == [15] * 5
+    assert [contributions["emissions"] for _, contributions in intervals] == pytest.approx(
+        [0.004 * 300 / 4] * 4 + [0.004 * 100 / 4])
+
+
+def test_charged_energy_intervals_hourly_power_15_minute_emissions():
+    # An hour of power gets the average intensity of the four quarters it overlaps
+    power = series(HOUR, [0.008, 0.008])
+    emissions = series(15 * MINUTE, [100.0, 200.0, 300.0, 400.0, 500.0])
+    intervals = charged_energy_intervals(power, emissions, default_resolution=5 * MINUTE)
+    assert intervals[0][1]["charged_energy"] == pytest.approx(8.0)
+    assert intervals[0][1]["charged_minutes"] == 60
+    assert intervals[0][1]["emissions"] == pytest.approx(0.008 * 250)
+    # Only the first quarter of the second hour has an intensity
+    assert intervals[1][1]["emissions"] == pytest.approx(0.008 * 500)
+
+
+def three_key_probe(power_values: dict, emission_intensities: dict) -> dict:
+    """The totals as get_charged_energy computed them before, for 5 minute power and 15 minute emissions: the
+    intensity was looked up at the event_start of the power and at most two 5 minute steps earlier."""
+    totals = dict(charged_energy=0.0, discharged_energy=0.0, emissions=0.0, saved_emissions=0.0)
+    for key, power in power_values.items():
+        emission_intensity = 0
+        for i in range(3):
+            em = emission_intensities.get(key - i * 5 * MINUTE, None)
+            if em is not None:
+                emission_intensity = em
+                break
+        if power < 0:
+            totals["discharged_energy"] += power * 1000 / 12
+            totals["saved_emissions"] += power * emission_intensity / 12
+        elif power > 0:
+            totals["charged_energy"] += power * 1000 / 12
+            totals["emissions"] += power * emission_intensity / 12
+    return totals
+
+
+def test_charged_energy_intervals_equal_the_three_key_probe():
+    origin = 1792396800000
+    powers = [0.011, -0.0075, 0.0, 0.004, 0.011, -0.011, 0.002, 0.0, -0.003, 0.011, 0.011, -0.011]
+    power = series(5 * MINUTE, powers * 24, origin)
+    emissions = series(15 * MINUTE, [150.0 + 10 * (i % 17) for i in range(96)], origin)
+    statistics = RollingStatistics(window=7 * DAY)
+    statistics.reconcile(charged_energy_intervals(power, emissions, default_resolution=5 * MINUTE),
+                         until=origin + DAY, now=origin + DAY)
+    for quantity, total in three_key_probe(power, emissions).items():
+        assert statistics.total(quantity) == pytest.approx(total)
@@ -0,0 +1,90 @@
+from datetime import date, datetime, timezone
+
+import pytest
+import pytz
+
+from rollups import Rollups, availability_percentage, daily_totals, day_of, month_of, previous_month
+from series_store import SeriesStore
+
+
+def test_add_to_day_and_month():
+    rollups = Rollups(None)
+    assert rollups.is_empty()
+    rollups.add(date(2026, 10, 19), {"charged_energy": 2.0, "cost": 0.5})
+    rollups.add(date(2026, 10, 20), {"charged_energy": 3.0})
+    assert rollups.days[date(2026, 10, 19)] == {"charged_energy": 2.0, "cost": 0.5}
+    assert rollups.month_totals(date(2026, 10, 31)) == {"charged_energy": 5.0, "cost": 0.5}
+    assert rollups.month_totals(date(2026, 11, 1)) == {}
+
+
+def test_replace_days_updates_their_months():
+    rollups = Rollups(None)
+    rollups.add(date(2026, 10, 19), {"charged_energy": 2.0, "cost": 0.5})
+    rollups.add(date(2026, 10, 20), {"charged_energy": 3.0})
+    # FM revised the 19th, it has no costs any more
+    rollups.replace_days({date(2026, 10, 19): {"charged_energy": 4.0}, date(2026, 9, 30): {"cost": 1.0}})
+    assert rollups.days[date(2026, 10, 19)] == {"charged_energy": 4.0}
+    assert rollups.month_totals(date(2026, 10, 1)) == pytest.approx({"charged_energy": 7.0, "cost": 0.0})
+    assert rollups.month_totals(date(2026, 9, 1)) == {"cost": 1.0}
+
+
+def test_last_months_totals():
+    rollups = Rollups(None)
+    for month in range(1, 13):
+        rollups.add(date(2025, month, 15), {"charged_energy": 1.0})
+    rollups.add(date(2026, 1, 2), {"charged_energy": 10.0})
+    # January 2026 and the 11 months before it, so January 2025 is left out
+    assert rollups.last_months_totals(date(2026, 1, 31)) == {"charged_energy": 21.0}
+    assert rollups.last_months_totals(date(2026, 1, 31), 1) == {"charged_energy": 10.0}
+
+
+def test_rollups_are_persisted(tmp_path):
+    store = SeriesStore(str(tmp_path / "series.db"))
+    rollups = Rollups(store)
+    rollups.add(date(2026, 10, 19), {"charged_energy": 2.0})
+    rollups.replace_days({date(2026, 10, 20): {"charged_energy": 1.0}})
+    restarted = Rollups(store)
+    assert restarted.days == {date(2026, 10, 19): {"charged_energy": 2.0}, date(2026, 10, 20): {"charged_energy": 1.0}}
+    assert restarted.months == {date(2026, 10, 1): {"charged_energy": 3.0}}
+    store.close()
+
+
+def test_day_of_is_local():
+    tz = pytz.timezone("Europe/Amsterdam")
+    event_start = int(datetime(2026, 10, 19, 22, 30, tzinfo=timezone.utc).timestamp() * 1000)
+    assert day_of(event_start, tz) == date(2026, 10, 20)
+    assert day_of(event_start, timezone.utc) == date(2026, 10, 19)
+
+
+def test_months():
+    assert month_of(date(2026, 10, 19)) == date(2026, 10, 1)
+    assert previous_month(date(2026, 1, 1)) == date(2025, 12, 1)
+    assert previous_month(date(2026, 10, 1)) == date(2026, 9, 1)
+
+
+def test_availability_percentage():
+    assert availability_percentage({}) is None
+    assert availability_percentage({"metered_minutes": 60, "available_minutes": 45}) == 75
+
+
+def test_daily_totals_use_fm_costs_where_available():
+    minute = 60 * 1000
+    day_1 = int(datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc).timestamp() * 1000)
+    day_2 = day_1 + 24 * 60 * minute
+    totals = daily_totals(
+        power_values={day_1: 0.012, day_1 + 5 * minute: 0.012, day_2: -0.006},
+        availabilities={day_1: 100, day_1 + 5 * minute: 50, day_2: 100},
+        costs={day_1: 0.25},
+        emission_intensities={day_1: 300.0, day_2: 200.0},
+        prices={day_1: 100.0, day_2: 200.0},
+        price_per_kwh=lambda price: price / 1000,
+        tz=timezone.utc,
+        default_resolution=5 * minute,
+    )
+    assert totals[date(2026, 10, 19)] == pytest.approx(dict(
+        charged_energy=2.0, charged_minutes=10, emissions=0.012 * 300 / 6, metered_minutes=10,
+        available_minutes=7.5, cost=0.25))
+    # Without costs from FM the costs are estimated from the power and the prices
+    assert totals[date(2026, 10, 20)] == pytest.approx(dict(
+        discharged_energy=-0.5, discharged_minutes=5, saved_emissions=-0.006 * 200 / 12, metered_minutes=5,
+        available_minutes=5, cost=-0.5 * 0.2))
@@ -0,0 +1,96 @@
+from datetime import datetime, timedelta, timezone
+
+from schedule_executor import ScheduleExecutor, change_points
+
+RESOLUTION = timedelta(minutes=5)
+START = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+
+
+class TimerApp:
+    """The timers of an AppDaemon app, fired by the test."""
+
+    def __init__(self, now: datetime):
+        self.now = now
+        self.timers = {}
+        self._handles = 0
+
+    def get_now(self):
+        return self.now
+
+    def run_at(self, callback, moment, **kwargs):
+        self._handles += 1
+        self.timers[str(self._handles)] = (callback, moment, kwargs)
+        return str(self._handles)
+
+    def cancel_timer(self, handle, silent=False):
+        self.timers.pop(handle, None)
+
+    def fire_next(self):
+        """Move the time to the first timer and fire it."""
+        handle = min(self.timers, key=lambda h: self.timers[h][1])
+        callback, moment, kwargs = self.timers.pop(handle)
+        self.now = max(self.now, moment)
+        callback(kwargs)
+
+
+def executor_at(now: datetime):
+    app = TimerApp(now)
+    sent = []
+    return app, sent, ScheduleExecutor(app, sent.append)
+
+
+def test_change_points_merge_runs():
+    moments, values = change_points(START, RESOLUTION, [0.0, 0.0, 0.011, 0.011, 0.011, -0.005])
+    assert moments == [START, START + 2 * RESOLUTION, START + 5 * RESOLUTION]
+    assert values == [0.0, 0.011, -0.005]
+
+
+def test_load_sends_the_current_setpoint_and_arms_one_timer():
+    app, sent, executor = executor_at(START + timedelta(minutes=7))
+    executor.load(START, RESOLUTION, [0.0, 0.011, 0.011, 0.011, -0.005])
+    assert sent == [0.011]
+    assert len(app.timers) == 1
+    assert executor.next_setpoint == (START + 4 * RESOLUTION, -0.005)
+
+    app.fire_next()
+    assert sent == [0.011, -0.005]
+    assert executor.next_setpoint is None
+    assert app.timers == {}
+
+
+def test_schedule_in_the_future_is_not_started_yet():
+    app, sent, executor = executor_at(START - timedelta(minutes=1))
+    executor.load(START, RESOLUTION, [0.011, 0.0])
+    assert sent == []
+    assert executor.current_setpoint is None
+    app.fire_next()
+    assert sent == [0.011]
+
+
+def test_a_new_schedule_replaces_the_timer():
+    app, sent, executor = executor_at(START)
+    executor.load(START, RESOLUTION, [0.0, 0.011])
+    stale = next(iter(app.timers.values()))
+    executor.load(START, RESOLUTION, [0.005, 0.005, -0.011])
+    assert len(app.timers) == 1
+    # A timer of the previous schedule that fires anyway is ignored
+    stale[0](stale[2])
+    assert sent == [0.0, 0.005]
+
+
+def test_late_timer_catches_up_to_the_current_setpoint():
+    app, sent, executor = executor_at(START)
+    executor.load(START, RESOLUTION, [0.0, 0.011, -0.005, 0.003])
+    callback, _, kwargs = app.timers.popitem()[1]
+    app.now = START + 2 * RESOLUTION + timedelta(seconds=30)
+    callback(kwargs)
+    assert sent == [0.0, -0.005]
+    assert executor.next_setpoint == (START + 3 * RESOLUTION, 0.003)
+
+
+def test_clear():
+    app, sent, executor = executor_at(START)
+    executor.load(START, RESOLUTION, [0.0, 0.011])
+    executor.clear()
+    assert app.timers == {}
+    assert executor.current_setpoint is None and executor.next_setpoint is None
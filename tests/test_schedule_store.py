@@ -0,0 +1,51 @@
+from datetime import datetime, timedelta, timezone
+
+from schedule_store import load_schedule, remove_schedule, save_schedule
+
+RESOLUTION = timedelta(minutes=5)
+START = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+
+
+def test_load_skips_the_passed_intervals(tmp_path):
+    path = str(tmp_path / "schedule.json")
+    save_schedule(path, START, RESOLUTION, [0.1, 0.2, 0.3, 0.4])
+    start, resolution, values = load_schedule(path, START + timedelta(minutes=7))
+    assert start == START + RESOLUTION
+    assert resolution == RESOLUTION
+    assert values == [0.2, 0.3, 0.4]
+
+
+def test_load_before_the_start_returns_the_whole_schedule(tmp_path):
+    path = str(tmp_path / "schedule.json")
+    save_schedule(path, START, RESOLUTION, [0.1, 0.2])
+    assert load_schedule(path, START - timedelta(hours=1)) == (START, RESOLUTION, [0.1, 0.2])
+
+
+def test_expired_schedule_is_not_loaded(tmp_path):
+    path = str(tmp_path / "schedule.json")
+    save_schedule(path, START, RESOLUTION, [0.1, 0.2])
+    assert load_schedule(path, START + 2 * RESOLUTION) is None
+
+
+def test_missing_or_corrupt_schedule_is_not_loaded(tmp_path):
+    path = str(tmp_path / "schedule.json")
+    assert load_schedule(path, START) is None
+    with open(path, "w") as f:
+        f.write('{"start": "2026-10-19T12:00:00+00:00", "values": [0.1')
+    assert load_schedule(path, START) is None
+
+
+def test_save_replaces_and_leaves_no_temporary_file(tmp_path):
+    path = str(tmp_path / "schedule.json")
+    save_schedule(path, START, RESOLUTION, [0.1])
+    save_schedule(path, START, RESOLUTION, [0.5, 0.6])
+    assert load_schedule(path, START)[2] == [0.5, 0.6]
+    assert sorted(p.name for p in tmp_path.iterdir()) == ["schedule.json"]
+
+
+def test_remove_schedule(tmp_path):
+    path = str(tmp_path / "schedule.json")
+    save_schedule(path, START, RESOLUTION, [0.1])
+    remove_schedule(path)
+    remove_schedule(path)
+    assert load_schedule(path, START) is None
@@ -0,0 +1,218 @@
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timedelta, timezone
+import threading
+import time
+
+import pytest
+
+from series_cache import Series, SeriesCache, SeriesCaches, series_resolution, to_ms
+from series_store import SeriesStore
+
+HOUR = timedelta(hours=1)
+NOW = datetime(2026, 10, 19, 12, 20, tzinfo=timezone.utc)
+WINDOW_START = datetime(2026, 10, 12, 0, 0, tzinfo=timezone.utc)
+
+
+def hourly(start: datetime, values) -> dict:
+    return {to_ms(start + i * HOUR): value for i, value in enumerate(values)}
+
+
+def test_empty_cache_fetches_the_window():
+    cache = SeriesCache(None, 1, revision_overlap=2 * HOUR)
+    assert cache.fetch_start(WINDOW_START, NOW) == WINDOW_START
+
+
+def test_fetch_starts_the_revision_overlap_before_the_last_event():
+    cache = SeriesCache(None, 1, revision_overlap=2 * HOUR)
+    start = datetime(2026, 10, 19, 0, 0, tzinfo=timezone.utc)
+    cache.merge(hourly(start, [1.0] * 8), start)
+    # The last event starts at 7:00, rounded down to the hour
+    assert cache.fetch_start(WINDOW_START, NOW) == datetime(2026, 10, 19, 5, 0, tzinfo=timezone.utc)
+
+
+def test_future_values_are_fetched_again_from_now():
+    cache = SeriesCache(None, 1, revision_overlap=2 * HOUR)
+    start = datetime(2026, 10, 19, 0, 0, tzinfo=timezone.utc)
+    # Forecasts up to tomorrow
+    cache.merge(hourly(start, [1.0] * 48), start)
+    assert cache.fetch_start(WINDOW_START, NOW) == datetime(2026, 10, 19, 10, 0, tzinfo=timezone.utc)
+
+
+def test_merge_replaces_the_fetched_period():
+    cache = SeriesCache(None, 1, revision_overlap=2 * HOUR)
+    start = datetime(2026, 10, 19, 0, 0, tzinfo=timezone.utc)
+    cache.merge(hourly(start, [1.0, 2.0, 3.0, 4.0]), start)
+    cache.take_revisions()
+    # From 2:00 only the event at 3:00 is returned, with a revised value: the one at 2:00 was removed
+    fetch_start = start + 2 * HOUR
+    cache.merge({to_ms(start + 3 * HOUR): 5.0}, fetch_start)
+    assert cache.values == {**hourly(start, [1.0, 2.0]), to_ms(start + 3 * HOUR): 5.0}
+    assert cache.take_revisions() == {to_ms(start + 2 * HOUR), to_ms(start + 3 * HOUR)}
+    assert cache.take_revisions() == set()
+
+
+def test_merge_with_an_end_keeps_the_later_values():
+    cache = SeriesCache(None, 1, revision_overlap=2 * HOUR)
+    start = datetime(2026, 10, 19, 0, 0, tzinfo=timezone.utc)
+    cache.merge(hourly(start, [1.0, 2.0, 3.0, 4.0]), start)
+    cache.merge({}, start, start + 2 * HOUR)
+    assert cache.values == hourly(start + 2 * HOUR, [3.0, 4.0])
+
+
+def test_cache_writes_through_and_loads_from_the_store(tmp_path):
+    store = SeriesStore(str(tmp_path / "series.db"))
+    start = datetime(2026, 10, 19, 0, 0, tzinfo=timezone.utc)
+    cache = SeriesCache(store, 7, revision_overlap=2 * HOUR)
+    cache.merge(hourly(start, [1.0, 2.0, 3.0]), start)
+
+    restarted = SeriesCache(store, 7, revision_overlap=2 * HOUR, since=to_ms(start + HOUR))
+    assert restarted.values == hourly(start + HOUR, [2.0, 3.0])
+    assert restarted.fetch_start(WINDOW_START, NOW) == start
+    store.close()
+
+
+def test_value_at():
+    cache = SeriesCache(None, 1, revision_overlap=2 * HOUR)
+    start = datetime(2026, 10, 19, 0, 0, tzinfo=timezone.utc)
+    cache.merge(hourly(start, [1.0, 2.0, 3.0]), start)
+    assert cache.value_at(to_ms(start + HOUR + timedelta(minutes=35))) == 2.0
+    assert cache.value_at(to_ms(start - timedelta(minutes=5))) is None
+
+
+def test_only_the_same_request_is_made_conditional():
+    cache = SeriesCache(None, 1, revision_overlap=2 * HOUR)
+    params = {"event_starts_after": "2026-10-19T10:00:00+00:00"}
+    assert cache.conditional_headers(params) == {}
+    cache.remember_validators(params, {"ETag": '"abc"', "Last-Modified": "Mon, 19 Oct 2026 10:00:00 GMT"})
+    assert cache.conditional_headers(dict(params)) == {
+        "If-None-Match": '"abc"', "If-Modified-Since": "Mon, 19 Oct 2026 10:00:00 GMT"}
+    assert cache.conditional_headers({"event_starts_after": "2026-10-19T11:00:00+00:00"}) == {}
+
+
+def test_fetch_start_is_the_same_within_the_hour():
+    # So the requests for the same data are the same, and can be made conditional
+    cache = SeriesCache(None, 1, revision_overlap=2 * HOUR)
+    start = datetime(2026, 10, 19, 0, 0, tzinfo=timezone.utc)
+    cache.merge({to_ms(start + timedelta(minutes=5 * i)): 1.0 for i in range(12 * 8)}, start)
+    fetch_starts = {cache.fetch_start(WINDOW_START, NOW + timedelta(minutes=m)) for m in range(0, 30, 5)}
+    assert len(fetch_starts) == 1
+
+
+def test_series_from_fm_events():
+    events = [
+        {"event_start": 1000, "event_value": 1.5, "source": {"type": "reporter"}},
+        {"event_start": 2000, "event_value": 2.5, "source": {"type": "scheduler"}},
+        {"event_start": 3000, "event_value": None, "source": None},
+    ]
+    series = Series.from_events(events)
+    assert series.event_starts == [1000, 2000, 3000]
+    assert series.values == [1.5, 2.5, None]
+    assert series.source_types == ["reporter", "scheduler", None]
+
+    selected = series.select([t != "scheduler" for t in series.source_types])
+    assert selected.to_dict() == {1000: 1.5, 3000: None}
+
+
+def test_series_from_dict_is_sorted():
+    series = Series.from_dict({3000: 3.0, 1000: 1.0, 2000: 2.0})
+    assert series.event_starts == [1000, 2000, 3000]
+    assert series.values == [1.0, 2.0, 3.0]
+
+
+def test_series_records():
+    start = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+    series = Series([to_ms(start), to_ms(start + HOUR)], [10.0, 20.0])
+    records = series.records("price", values=[1, 2])
+    assert [record["price"] for record in records] == [1, 2]
+    assert [datetime.fromisoformat(record["time"]).astimezone(timezone.utc).replace(tzinfo=None)
+            for record in records] == [datetime(2026, 10, 19, 12, 0), datetime(2026, 10, 19, 13, 0)]
+
+
+def test_series_resolution_ignores_gaps():
+    assert series_resolution([0, 300000, 900000, 1200000]) == 300000
+    assert series_resolution([0]) is None
+
+
+def test_consumers_of_a_sensor_share_one_cache():
+    caches = SeriesCaches(max_values=1000)
+    prices = caches.open(None, 14, 2 * HOUR, "consumption prices", WINDOW_START)
+    production = caches.open(None, 14, 4 * HOUR, "production prices", WINDOW_START - 24 * HOUR)
+    assert production is prices
+    assert prices.revision_overlap == 4 * HOUR
+    assert prices.window_start == to_ms(WINDOW_START - 24 * HOUR)
+    assert caches.open(None, 27, 2 * HOUR, "emissions", WINDOW_START) is not prices
+
+
+def test_wider_window_is_loaded_from_the_store(tmp_path):
+    store = SeriesStore(str(tmp_path / "series.db"))
+    store.put(14, hourly(WINDOW_START - 2 * HOUR, [1.0, 2.0, 3.0]))
+    cache = SeriesCaches(max_values=1000).open(store, 14, 2 * HOUR, "prices", WINDOW_START)
+    assert cache.values == hourly(WINDOW_START, [3.0])
+    cache.request_window("charts", WINDOW_START - HOUR)
+    assert cache.values == hourly(WINDOW_START - HOUR, [2.0, 3.0])
+    store.close()
+
+
+def test_trim_keeps_the_union_of_the_windows():
+    cache = SeriesCache(None, 1, revision_overlap=2 * HOUR)
+    cache.request_window("prices", WINDOW_START)
+    cache.request_window("charts", WINDOW_START + 2 * HOUR)
+    cache.merge(hourly(WINDOW_START - HOUR, [1.0, 2.0, 3.0]), WINDOW_START - HOUR)
+    cache.trim()
+    assert cache.values == hourly(WINDOW_START, [2.0, 3.0])
+
+
+def test_least_recently_used_caches_are_unloaded(tmp_path):
+    store = SeriesStore(str(tmp_path / "series.db"))
+    caches = SeriesCaches(max_values=10)
+    first = caches.open(store, 1, 2 * HOUR, "a", WINDOW_START)
+    first.merge(hourly(WINDOW_START, [1.0] * 6), WINDOW_START)
+    second = caches.open(store, 2, 2 * HOUR, "b", WINDOW_START)
+    second.merge(hourly(WINDOW_START, [2.0] * 6), WINDOW_START)
+    caches.touch(second)
+    assert not first.loaded and first.values == {}
+    assert second.loaded
+    # Using it again loads it from the store, and unloads the other one
+    caches.touch(first)
+    assert first.values == hourly(WINDOW_START, [1.0] * 6)
+    assert not second.loaded
+    store.close()
+
+
+def test_concurrent_refreshes_download_once():
+    cache = SeriesCache(None, 1, revision_overlap=2 * HOUR)
+    started = threading.Event()
+    release = threading.Event()
+    downloads = []
+
+    def download():
+        downloads.append(1)
+        started.set()
+        release.wait(5)
+        return "response"
+
+    first = ThreadPoolExecutor(max_workers=1).submit(cache.refresh, download)
+    started.wait(5)
+    assert cache.is_refreshing
+    waiters = ThreadPoolExecutor(max_workers=3)
+    # Three consumers ask for a refresh while the download is in progress
+    results = [waiters.submit(cache.refresh, download) for _ in range(3)]
+    time.sleep(0.2)
+    release.set()
+    assert first.result(5) == "response"
+    assert [result.result(5) for result in results] == ["response"] * 3
+    assert len(downloads) == 1
+    # A later refresh downloads again
+    cache.refresh(download)
+    assert len(downloads) == 2
+
+
+def test_failed_download_is_not_shared():
+    cache = SeriesCache(None, 1, revision_overlap=2 * HOUR)
+
+    def failing_download():
+        raise ConnectionError("no connection")
+
+    with pytest.raises(ConnectionError):
+        cache.refresh(failing_download)
+    assert cache.refresh(lambda: "response") == "response"
@@ -0,0 +1,66 @@
+import pytest
+
+from series_store import SeriesStore, local_sensor_id, open_store
+
+
+@pytest.fixture
+def store(tmp_path):
+    store = SeriesStore(str(tmp_path / "series.db"))
+    yield store
+    store.close()
+
+
+def test_range_queries(store):
+    store.put(1, {3000: 3.0, 1000: 1.0, 2000: None})
+    store.put(2, {1000: 10.0})
+    assert list(store.get_range(1).items()) == [(1000, 1.0), (2000, None), (3000, 3.0)]
+    assert store.get_range(1, start=2000) == {2000: None, 3000: 3.0}
+    assert store.get_range(1, start=1000, end=3000) == {1000: 1.0, 2000: None}
+    assert store.get_range(3) == {}
+
+
+def test_put_replaces_values(store):
+    store.put(1, {1000: 1.0, 2000: 2.0})
+    store.put(1, {2000: 5.0})
+    assert store.get_range(1) == {1000: 1.0, 2000: 5.0}
+    assert store.last_event_start(1) == 2000
+    assert store.last_event_start(2) is None
+
+
+def test_local_metering_is_kept_apart(store):
+    store.put(local_sensor_id(1), {4000: 0.5})
+    store.put(1, {1000: 1.0})
+    assert store.get_range(1) == {1000: 1.0}
+    assert store.last_event_start(1) == 1000
+    assert store.get_range(local_sensor_id(1)) == {4000: 0.5}
+
+
+def test_retention(store):
+    store.put(1, {1000: 1.0, 2000: 2.0})
+    store.put(2, {1000: 1.0, 2000: 2.0})
+    store.delete_before(2000, sensor_id=1)
+    assert store.get_range(1) == {2000: 2.0}
+    assert store.get_range(2) == {1000: 1.0, 2000: 2.0}
+    store.delete_before(3000)
+    assert store.get_range(2) == {}
+
+
+def test_store_is_in_wal_mode_and_shared(tmp_path):
+    path = str(tmp_path / "shared.db")
+    store = open_store(path)
+    assert open_store(path) is store
+    assert store._connection.execute("PRAGMA journal_mode").fetchone()[0] == "wal"
+    store.put(1, {1000: 1.0})
+    # Another connection (e.g. a restart) reads what has been written
+    other = SeriesStore(path)
+    assert other.get_range(1) == {1000: 1.0}
+    other.close()
+    store.close()
+
+
+def test_rollups(store):
+    store.put_rollups("day", {"2026-10-19": {"charged_energy": 5.0, "cost": 1.2}})
+    store.put_rollups("day", {"2026-10-19": {"charged_energy": 6.0}, "2026-10-20": {"cost": 0.5}})
+    store.put_rollups("month", {"2026-10-01": {"charged_energy": 6.0}})
+    assert store.get_rollups("day") == {"2026-10-19": {"charged_energy": 6.0}, "2026-10-20": {"cost": 0.5}}
+    assert store.get_rollups("month") == {"2026-10-01": {"charged_energy": 6.0}}
@@ -0,0 +1,67 @@
+from datetime import datetime, timedelta, timezone
+import threading
+
+from single_flight import SingleFlight
+
+NOW = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+LEASE = timedelta(minutes=5)
+
+
+def test_same_inputs_join_the_request_in_flight():
+    flight = SingleFlight(LEASE)
+    generation = flight.start(("soc", 40.0), NOW)
+    assert generation is not None
+    assert flight.start(("soc", 40.0), NOW + timedelta(minutes=1)) is None
+    assert flight.is_current(generation, NOW + timedelta(minutes=1))
+
+
+def test_other_inputs_supersede_the_request_in_flight():
+    flight = SingleFlight(LEASE)
+    first = flight.start(("soc", 40.0), NOW)
+    second = flight.start(("soc", 45.0), NOW)
+    assert second != first
+    assert not flight.is_current(first, NOW)
+    assert flight.is_current(second, NOW)
+    # Finishing the superseded request does not end the current one
+    flight.finish(first)
+    assert flight.is_current(second, NOW)
+
+
+def test_expired_lease_allows_a_new_request():
+    flight = SingleFlight(LEASE)
+    first = flight.start(("soc", 40.0), NOW)
+    assert not flight.is_current(first, NOW + LEASE)
+    assert flight.start(("soc", 40.0), NOW + LEASE) is not None
+
+
+def test_finished_request_is_not_joined():
+    flight = SingleFlight(LEASE)
+    generation = flight.start(("soc", 40.0), NOW)
+    flight.finish(generation)
+    assert not flight.is_current(generation, NOW)
+    assert flight.start(("soc", 40.0), NOW) is not None
+
+
+def test_cancel():
+    flight = SingleFlight(LEASE)
+    generation = flight.start(("soc", 40.0), NOW)
+    flight.cancel()
+    assert not flight.is_current(generation, NOW)
+    assert flight.start(("soc", 40.0), NOW) is not None
+
+
+def test_concurrent_starts_with_the_same_inputs_start_one_request():
+    flight = SingleFlight(LEASE)
+    barrier = threading.Barrier(8)
+    generations = []
+
+    def start():
+        barrier.wait()
+        generations.append(flight.start(("soc", 40.0), NOW))
+
+    threads = [threading.Thread(target=start) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert len([generation for generation in generations if generation is not None]) == 1
@@ -0,0 +1,146 @@
+from datetime import datetime, timedelta, timezone
+import math
+
+import pytest
+
+import soc_constraints as sc
+
+RESOLUTION = timedelta(minutes=5)
+NOW = datetime(2026, 10, 19, 12, 2, 40, tzinfo=timezone.utc)
+MAX_SOC_KWH = 48.0
+MAX_POWER_W = 11000
+
+
+def time_round(time, delta):
+    """As v2g_globals.time_round, which cannot be imported without AppDaemon."""
+    mod = (time - datetime(1970, 1, 1, tzinfo=time.tzinfo)) % delta
+    if mod < (delta / 2):
+        return time - mod
+    return time + (delta - mod)
+
+
+def baseline_soc_maxima(current_soc_kwh, back_to_max_soc, start_relaxation_window):
+    """The soc_maxima (value per slot) as trigger_schedule computed them before the soc_constraints module."""
+    resolution = RESOLUTION
+    rounded_now = time_round(NOW, resolution)
+    if start_relaxation_window < rounded_now:
+        return "3", []
+    if back_to_max_soc is None:
+        return "0", [(rounded_now + x * resolution, MAX_SOC_KWH)
+                     for x in range(0, (start_relaxation_window - rounded_now) // resolution)]
+    minimum_discharge_window = math.ceil((current_soc_kwh - MAX_SOC_KWH) / (MAX_POWER_W / 1000) * 60)
+    end_minimum_discharge_window = time_round(rounded_now - timedelta(minutes=minimum_discharge_window), resolution)
+    if end_minimum_discharge_window > back_to_max_soc:
+        back_to_max_soc = end_minimum_discharge_window
+    if back_to_max_soc >= start_relaxation_window:
+        return "2", [(rounded_now + x * resolution, current_soc_kwh)
+                     for x in range(0, (start_relaxation_window - rounded_now) // resolution)]
+    maxima = []
+    number_of_steps = (back_to_max_soc - rounded_now) // resolution
+    if number_of_steps > 0:
+        step_kwh = (current_soc_kwh - MAX_SOC_KWH) / number_of_steps
+        maxima += [(rounded_now + i * resolution, current_soc_kwh - (i * step_kwh)) for i in range(number_of_steps)]
+    maxima += [(back_to_max_soc + x * resolution, MAX_SOC_KWH)
+               for x in range(0, (start_relaxation_window - back_to_max_soc) // resolution)]
+    return "1", maxima
+
+
+def expand(segments):
+    """The segments as a value per slot."""
+    return [
+        (sc.slot_to_datetime(slot, RESOLUTION, timezone.utc), value)
+        for start_slot, end_slot, value in segments
+        for slot in range(start_slot, end_slot + 1)
+    ]
+
+
+def build(current_soc_kwh, back_to_max_soc, start_relaxation_window, ramp_step_slots=1):
+    return sc.build_soc_maxima(
+        now_slot=sc.to_slot(NOW, RESOLUTION),
+        srw_slot=sc.to_slot(start_relaxation_window, RESOLUTION),
+        current_soc_kwh=current_soc_kwh,
+        max_soc_kwh=MAX_SOC_KWH,
+        b2ms_slot=None if back_to_max_soc is None else sc.to_slot(back_to_max_soc, RESOLUTION),
+        max_discharge_power_w=MAX_POWER_W,
+        resolution=RESOLUTION,
+        ramp_step_slots=ramp_step_slots,
+    )
+
+
+@pytest.mark.parametrize("current_soc_kwh, back_to_max_soc, start_relaxation_window", [
+    # Scenario 0
+    (40.0, None, NOW + timedelta(days=7)),
+    # Scenario 1, also with a discharge window that is longer than the time to B2MS
+    (55.0, NOW + timedelta(hours=3), NOW + timedelta(days=2)),
+    (70.0, NOW + timedelta(minutes=20), NOW + timedelta(hours=30)),
+    # Scenario 2
+    (55.0, NOW + timedelta(hours=10), NOW + timedelta(hours=8)),
+    # Scenario 3
+    (55.0, NOW + timedelta(hours=3), NOW - timedelta(hours=1)),
+])
+def test_soc_maxima_equal_baseline(current_soc_kwh, back_to_max_soc, start_relaxation_window):
+    scenario, segments = build(current_soc_kwh, time_round(back_to_max_soc, RESOLUTION) if back_to_max_soc else None,
+                               time_round(start_relaxation_window, RESOLUTION))
+    expected_scenario, expected = baseline_soc_maxima(
+        current_soc_kwh, time_round(back_to_max_soc, RESOLUTION) if back_to_max_soc else None,
+        time_round(start_relaxation_window, RESOLUTION))
+    assert scenario == expected_scenario
+    assert expand(segments) == pytest.approx(expected)
+
+
+def test_ramp_steps_are_never_stricter_than_per_slot_values():
+    b2ms = time_round(NOW + timedelta(hours=4), RESOLUTION)
+    srw = time_round(NOW + timedelta(days=1), RESOLUTION)
+    _, per_slot = build(60.0, b2ms, srw, ramp_step_slots=1)
+    _, stepped = build(60.0, b2ms, srw, ramp_step_slots=6)
+    assert len(stepped) < len(per_slot)
+    for (moment, value), (_, step_value) in zip(expand(per_slot), expand(stepped)):
+        assert step_value >= value - 1e-9
+
+
+def test_slots_round_as_time_round():
+    for seconds in range(0, 900, 10):
+        moment = NOW + timedelta(seconds=seconds)
+        assert sc.slot_to_datetime(sc.to_slot(moment, RESOLUTION), RESOLUTION, timezone.utc) == \
+            time_round(moment, RESOLUTION)
+
+
+def test_minutes_to_slots_back_in_time_rounds_as_time_round():
+    now_slot = sc.to_slot(NOW, RESOLUTION)
+    rounded_now = sc.slot_to_datetime(now_slot, RESOLUTION, timezone.utc)
+    for minutes in range(0, 30):
+        slot = now_slot + sc.minutes_to_slots(-minutes, RESOLUTION)
+        assert sc.slot_to_datetime(slot, RESOLUTION, timezone.utc) == \
+            time_round(rounded_now - timedelta(minutes=minutes), RESOLUTION)
+
+
+def test_relaxation_window_only_for_targets_above_max_soc():
+    target_slot = sc.to_slot(NOW + timedelta(hours=10), RESOLUTION)
+    assert sc.relaxation_window_start_slot(target_slot, 40.0, MAX_SOC_KWH, MAX_POWER_W, 60, RESOLUTION) is None
+    # 12 kWh at 11 kW takes 66 minutes, plus 60 minutes slack: 126 minutes is 25 slots
+    assert sc.relaxation_window_start_slot(target_slot, 60.0, MAX_SOC_KWH, MAX_POWER_W, 60, RESOLUTION) == \
+        target_slot - 25
+
+
+def test_format_segments():
+    slot = sc.to_slot(NOW, RESOLUTION)
+    items = sc.format_segments([(slot, slot, 10.0), (slot, slot + 2, 20.0)], RESOLUTION, timezone.utc)
+    assert items == [
+        {"value": 10.0, "datetime": "2026-10-19T12:05:00+00:00"},
+        {"value": 20.0, "start": "2026-10-19T12:05:00+00:00", "end": "2026-10-19T12:15:00+00:00"},
+    ]
+
+
+def test_formatted_segments_cover_the_same_moments_as_the_baseline():
+    # The "end" of an item is inclusive in the flex-model, so each item covers start, start + resolution, ..., end.
+    srw = time_round(NOW + timedelta(hours=6), RESOLUTION)
+    _, segments = sc.build_soc_maxima(
+        now_slot=sc.to_slot(NOW, RESOLUTION), srw_slot=sc.to_slot(srw, RESOLUTION), current_soc_kwh=40.0,
+        max_soc_kwh=MAX_SOC_KWH, b2ms_slot=None, max_discharge_power_w=MAX_POWER_W, resolution=RESOLUTION,
+        ramp_step_slots=6,
+    )
+    [item] = sc.format_segments(segments, RESOLUTION, timezone.utc)
+    start, end = datetime.fromisoformat(item["start"]), datetime.fromisoformat(item["end"])
+    moments = [start + i * RESOLUTION for i in range((end - start) // RESOLUTION + 1)]
+    _, maxima = baseline_soc_maxima(40.0, None, srw)
+    assert moments == [moment for moment, _ in maxima]
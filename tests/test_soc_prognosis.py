@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta, timezone
+from itertools import accumulate
+
+import pytest
+
+from soc_prognosis import expected_soc_values, prognosis_records, simplify
+
+RESOLUTION = timedelta(minutes=15)
+START = datetime(2026, 10, 19, 12, 0, tzinfo=timezone.utc)
+
+
+def baseline_soc_values(values, soc, max_soc_in_kWh, round_trip_efficiency):
+    """The expected SoC as v2g_liberty computed it before soc_prognosis (convert_MW_to_percentage_points)."""
+    e = round_trip_efficiency ** 0.5
+    scalar = RESOLUTION / timedelta(hours=1) * 1000 * 100 / max_soc_in_kWh
+    return list(accumulate([soc] + [v * scalar * e if v >= 0 else v * scalar / e for v in values]))
+
+
+def test_expected_soc_values_equal_baseline():
+    values = [0.011, 0.011, 0.0, -0.005, -0.011, 0.00575, 0.0]
+    assert expected_soc_values(values, RESOLUTION, 40.0, 62.0, 0.85) == \
+        pytest.approx(baseline_soc_values(values, 40.0, 62.0, 0.85))
+
+
+def test_expected_soc_values_example():
+    # A 62 kWh battery that charges at 0.00575 MW for 15 minutes (without losses) gains just over 2.3%
+    assert expected_soc_values([0.00575], RESOLUTION, 50.0, 62.0, 1.0)[1] == pytest.approx(52.32, abs=0.01)
+
+
+def test_simplify_keeps_the_corners():
+    soc_values = expected_soc_values([0.011] * 10 + [0.0] * 10 + [-0.011] * 10, RESOLUTION, 40.0, 62.0, 0.85)
+    assert simplify(soc_values, 0.1) == [0, 10, 20, 30]
+
+
+def test_simplify_stays_within_tolerance():
+    values = [0.011, -0.005, 0.003, 0.0, 0.011, 0.011, -0.011, 0.002] * 6
+    soc_values = expected_soc_values(values, RESOLUTION, 40.0, 62.0, 0.85)
+    kept = simplify(soc_values, 0.1)
+    assert kept[0] == 0 and kept[-1] == len(soc_values) - 1
+    for first, end in zip(kept, kept[1:]):
+        slope = (soc_values[end] - soc_values[first]) / (end - first)
+        for i in range(first + 1, end):
+            assert abs(soc_values[first] + slope * (i - first) - soc_values[i]) <= 0.1
+
+
+def test_prognosis_records():
+    records = prognosis_records(START, RESOLUTION, [40.0, 41.0, 42.0, 42.0])
+    assert records == [
+        {"time": "2026-10-19T12:00:00+00:00", "soc": 40.0},
+        {"time": "2026-10-19T12:30:00+00:00", "soc": 42.0},
+        {"time": "2026-10-19T12:45:00+00:00", "soc": 42.0},
+    ]
@@ -7,6 +7,8 @@ import constants as c
 
 
 class V2GLibertyGlobals(hass.Hass):
+    # Used if car_average_wh_per_km is not set, neither here nor (as before) for the v2g_liberty app
+    DEFAULT_CAR_AVERAGE_WH_PER_KM: int = 174
 
     def initialize(self):
         self.log("Initializing V2GLibertyGlobals")
@@ -32,6 +34,14 @@ class V2GLibertyGlobals(hass.Hass):
         c.CAR_MAX_SOC_IN_KWH = c.CAR_MAX_CAPACITY_IN_KWH * c.CAR_MAX_SOC_IN_PERCENT / 100
         self.log(f"v2g_globals car-max-soc: {c.CAR_MAX_SOC_IN_PERCENT} % or {c.CAR_MAX_SOC_IN_KWH} kWh.")
 
+        # This setting used to be read by the v2g_liberty app, existing configurations might still have it there.
+        # If it is not set at all, a typical usage is used (it is only needed for targets in km).
+        car_average_wh_per_km = self.app_config.get("v2g_liberty", {}).get(
+            "car_average_wh_per_km", self.DEFAULT_CAR_AVERAGE_WH_PER_KM)
+        c.CAR_AVERAGE_WH_PER_KM = self.read_and_process_int_setting(
+            "car_average_wh_per_km", 100, 400, default=car_average_wh_per_km)
+        self.log(f"v2g_globals car-average-wh-per-km: {c.CAR_AVERAGE_WH_PER_KM} Wh/km.")
+
         c.ALLOWED_DURATION_ABOVE_MAX_SOC = self.read_and_process_int_setting("allowed_duration_above_max_soc_in_hrs", 2, 36)
         self.log(f"v2g_globals allowed_duration_above_max_soc: {c.ALLOWED_DURATION_ABOVE_MAX_SOC} hrs.")
 
@@ -73,9 +83,15 @@ class V2GLibertyGlobals(hass.Hass):
 
         self.log("Completed initializing V2GLibertyGlobals")
 
-    def read_and_process_int_setting(self, setting_name: str, lower_limit: int, upper_limit: int) -> int:
-        """Read and integer setting_name from HASS and guard the lower and upper limit"""
-        reading = int(float(self.args[setting_name]))
+    def read_and_process_int_setting(self, setting_name: str, lower_limit: int, upper_limit: int,
+                                     default=None) -> int:
+        """Read and integer setting_name from HASS and guard the lower and upper limit.
+        If a default is given the setting is optional, the default is used if it is not set."""
+        if default is not None and setting_name not in self.args:
+            self.log(f"The setting '{setting_name}' is not set, using '{default}'.")
+            reading = int(float(default))
+        else:
+            reading = int(float(self.args[setting_name]))
         # Make sure this value is between lower_limit and upper_limit
         tmp = max(min(upper_limit, reading), lower_limit)
         if reading != tmp:
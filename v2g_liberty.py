@@ -4,10 +4,15 @@ import time
 import pytz
 from v2g_globals import time_round
 import math
-from itertools import accumulate
-from typing import AsyncGenerator, List, Optional
+import os
+from typing import List, Optional
 import constants as c
 from v2g_globals import V2GLibertyGlobals
+from schedule_store import save_schedule, load_schedule, remove_schedule
+from schedule_executor import ScheduleExecutor
+from soc_prognosis import expected_soc_values, prognosis_records
+from event_bus import bus, NoScheduleError, ScheduleInputChanged, ScheduleReady
+from local_scheduler import SCHEDULER_NAME as LOCAL_SCHEDULER_NAME, correct_for_drift
 
 import appdaemon.plugins.hass.hassapi as hass
 
@@ -28,7 +33,8 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
     # Utility variables for preventing a frozen app. Call set_next_action at least every x seconds
     timer_handle_set_next_action: str  # ToDo: Should be a general object instead of string
     call_next_action_atleast_every: int
-    scheduling_timer_handles: List[AsyncGenerator]
+    # Sends the setpoints of the current schedule to the charger
+    schedule_executor: ScheduleExecutor
 
     # A SoC of 0 means: unknown/car not connected.
     connected_car_soc: int
@@ -60,11 +66,21 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
     # Ignore soc changes and charger_state changes.
     try_get_new_soc_in_process: bool
 
+    # File in which the last valid schedule is kept, so it can be re-armed right away after a restart.
+    schedule_store_path: str
+
+    # The last schedule (from FM or the local scheduler) with its SoC prognosis, used as reference for tracking.
+    # Between schedules the actual SoC is compared to the prognosis every slot: a drift is corrected locally
+    # within CATCH_UP_WINDOW and only when it exceeds MAX_SOC_DRIFT_IN_PERCENT a new schedule is requested.
+    schedule_reference: Optional[dict]
+    MAX_SOC_DRIFT_IN_PERCENT: int = 3
+    CATCH_UP_WINDOW: timedelta = timedelta(hours=1)
+
     def initialize(self):
         self.log("Initializing V2Gliberty")
 
         self.MIN_RESOLUTION = timedelta(minutes=c.FM_EVENT_RESOLUTION_IN_MINUTES)
-        self.CAR_AVERAGE_WH_PER_KM = int(float(self.args["car_average_wh_per_km"]))
+        self.CAR_AVERAGE_WH_PER_KM = c.CAR_AVERAGE_WH_PER_KM
 
         # If this variable is None it means the current SoC is below the max-soc.
         self.back_to_max_soc = None
@@ -111,13 +127,26 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
         self.listen_event(self.disconnect_charger, "DISCONNECT_CHARGER")
 
         self.listen_state(self.handle_soc_change, "sensor.charger_connected_car_state_of_charge", attribute="all")
-        self.listen_state(self.schedule_charge_point, "input_text.chargeschedule", attribute="all")
-        self.scheduling_timer_handles = []
+        self.schedule_executor = ScheduleExecutor(self, self.send_setpoint)
+        # Every schedule and error state counts, these queues are not bounded
+        bus.subscribe(ScheduleReady, self, self.handle_schedule_ready, max_queue_length=None)
+        bus.subscribe(NoScheduleError, self, self.handle_no_schedule_error, max_queue_length=None)
+        bus.subscribe(ScheduleInputChanged, self, self.handle_schedule_input_changed)
+        self.schedule_reference = None
+        self.run_every(self.track_schedule, f"now+{int(self.MIN_RESOLUTION.total_seconds())}",
+                       int(self.MIN_RESOLUTION.total_seconds()))
+        self.schedule_store_path = self.args.get(
+            "schedule_store_path",
+            os.path.join(self.config_dir, "v2g_liberty_schedule.json")
+        )
 
         # Set to initial 'empty' values, makes rendering of graph faster.
         self.set_soc_prognosis_boost_in_ui()
         self.set_soc_prognosis_in_ui()
 
+        # Re-arm the last schedule before anything else, a new schedule is retrieved in the background.
+        self.restore_last_schedule()
+
         if self.is_car_connected():
             self.log("Car is connected. Trying to get a reliable SoC reading.")
             self.try_get_new_soc()
@@ -306,6 +335,9 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
         self.notify_no_new_schedule(reset = True)
 
 
+    def handle_no_schedule_error(self, event: NoScheduleError):
+        self.handle_no_new_schedule(event.error_name, event.error_state)
+
     def handle_no_new_schedule(self, error_name: str, error_state: bool):
         """ Keep track of situations where no new schedules are available:
             - invalid schedule
@@ -323,6 +355,10 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
         self.no_schedule_errors[error_name] = error_state
         self.notify_no_new_schedule()
 
+        if error_state and error_name in ["invalid_schedule", "no_communication_with_fm"]:
+            # Do not wait for the current schedule to run out, fall back on a locally computed schedule.
+            self.plan_local_schedule()
+
     def notify_no_new_schedule(self, reset: Optional[bool] = False):
         """ Check if notification of user about no new schedule available is needed,
             based on self.no_schedule_errors. The administration for the errors is done by
@@ -400,12 +436,15 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
         )
         self.log("Notification 'No new schedules' sent.")
 
-    def decide_whether_to_ask_for_new_schedule(self):
+    def decide_whether_to_ask_for_new_schedule(self, soc_changed: bool = False):
         """
         This function is meant to be called upon:
-        - SOC updates
+        - SOC updates (then soc_changed is True)
         - charger state updates
         - every 15 minutes if none of the above
+
+        For a SoC update no new schedule is requested if the SoC is still close to the prognosis of the current
+        schedule, see track_schedule.
         """
         self.log("Deciding whether to ask for a new schedule...")
 
@@ -420,31 +459,61 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
             self.log(f"Not getting new schedule. SoC below minimum, boosting to reach that first.")
             return
 
+        if soc_changed and self.track_schedule():
+            self.log("Not getting new schedule, SoC is tracking the current schedule.")
+            return
+
+        if self.no_schedule_errors["no_communication_with_fm"]:
+            self.log("Computing a local schedule, there is no communication with FM.")
+            self.plan_local_schedule()
+            return
+
         self.get_app("flexmeasures-client").get_new_schedule(self.connected_car_soc_kwh, self.back_to_max_soc)
 
+    def plan_local_schedule(self):
+        """Let a schedule be computed locally, for when FlexMeasures cannot deliver a (valid) schedule."""
+        if not self.is_car_connected() or self.connected_car_soc == 0:
+            self.log("Not computing a local schedule, car is not connected or SoC is unknown.")
+            return
+
+        mode = self.get_state("input_select.charge_mode")
+        if mode != "Automatic" or self.in_boost_to_reach_min_soc:
+            self.log(f"Not computing a local schedule, charge mode is '{mode}' or boosting to reach min. SoC.")
+            return
+
+        self.get_app("flexmeasures-client").get_local_schedule(self.connected_car_soc_kwh, self.back_to_max_soc)
+
     def cancel_charging_timers(self):
-        for h in self.scheduling_timer_handles:
-            self.cancel_timer(h, True)
+        self.schedule_executor.clear()
         # Also remove any visible schedule from the graph in the UI..
         self.set_soc_prognosis_in_ui(None)
+        self.schedule_reference = None
+
+    def handle_schedule_input_changed(self, event: ScheduleInputChanged):
+        self.log(f"The {event.reason} changed, setting next action.")
+        self.set_next_action()
 
-    def set_charging_timers(self, handles):
-        self.scheduling_timer_handles = handles
+    def handle_schedule_ready(self, event: ScheduleReady):
+        self.schedule_charge_point(event.schedule, event.schedule_id)
 
-    def schedule_charge_point(self, entity, attribute, old, new, kwargs):
+    def schedule_charge_point(self, schedule: dict, schedule_id: Optional[str] = None):
         """Process a schedule by setting timers to send new control signals to the Charge Point.
 
         If appropriate, also sends a new control signal right away.
-        Finally, the expected SoC (given the schedule) is calculated and saved to input_text.soc_prognosis.
+        Finally, the expected SoC (given the schedule) is calculated and saved to input_text.soc_prognosis and
+        a summary of the schedule is saved to input_text.chargeschedule.
+
+        Parameters:
+            schedule (dict): the schedule as returned by FM (or the local scheduler), with start, duration,
+                             values (in MW) and scheduler_info
+            schedule_id (str): id of the schedule in FM, None for a local schedule
         """
-        self.log("Schedule_charge_point called, triggerd by change in input_text.chargeschedule.")
+        self.log(f"Schedule_charge_point called for schedule {schedule_id}.")
 
         if not self.is_car_connected():
             self.log("Stopped processing schedule; car is not connected")
             return
 
-        schedule = self.get_state("input_text.chargeschedule", attribute="all")
-        schedule = schedule["attributes"]
         values = schedule["values"]
         duration = isodate.parse_duration(schedule["duration"])
         resolution = duration / len(values)
@@ -459,51 +528,176 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
 
         # Detect invalid schedules
         # If a fallback schedule is sent assume that the schedule is invalid if all values (usually 0) are the same
-        is_fallback = (schedule["scheduler_info"]["scheduler"] == "StorageFallbackScheduler")
+        scheduler = schedule["scheduler_info"]["scheduler"]
+        is_fallback = (scheduler == "StorageFallbackScheduler")
         if is_fallback and (all(val == values[0] for val in values)):
             self.log(f"Invalid fallback schedule, all values are the same: {values[0]}. Stopped processing.")
             self.handle_no_new_schedule("invalid_schedule", True)
             # Skip processing this schedule to keep the previous
             return
-        else:
+        elif scheduler != LOCAL_SCHEDULER_NAME:
+            # A local schedule does not solve the problems with schedules from FM.
             self.handle_no_new_schedule("invalid_schedule", False)
 
-        # Cancel previous scheduling timers
-        self.cancel_charging_timers()
+        try:
+            save_schedule(self.schedule_store_path, start, resolution, values)
+        except OSError as e:
+            self.log(f"Could not persist schedule to '{self.schedule_store_path}': {e}.")
 
-        # Create new scheduling timers, to send a control signal for each value
-        handles = []
-        now = self.get_now()
-        timer_datetimes = [start + i * resolution for i in range(len(values))]
-        for t, value in zip(timer_datetimes, values):
-            if t > now:
-                # AJO 17-10-2021
-                # ToDo: If value is the same as previous, combine them so we have less timers and switching moments?
-                h = self.run_at(self.send_control_signal, t, charge_rate=value * 1000)  # convert from MW to kW
-                handles.append(h)
-            else:
-                self.log(f"Cannot time a charging scheduling in the past, specifically, at {t}."
-                         f" Setting it immediately instead.")
-                self.send_control_signal(kwargs=dict(charge_rate=value * 1000))
+        self.process_schedule(start, resolution, values)
+        self.set_schedule_summary_in_ui(schedule_id, scheduler, schedule["start"], schedule["duration"])
+
+    def set_schedule_summary_in_ui(self, schedule_id: Optional[str], scheduler: str, start: str, duration: str):
+        """Write a compact summary of the current schedule to input_text.chargeschedule.
+
+        The schedule itself is not stored in HA, this would needlessly grow the recorder database.
+        """
+        next_setpoint = self.schedule_executor.next_setpoint
+        summary = dict(
+            id=schedule_id,
+            scheduler=scheduler,
+            start=start,
+            duration=duration,
+            current_setpoint=self.schedule_executor.current_setpoint,
+            next_setpoint=None if next_setpoint is None else next_setpoint[1],
+            next_setpoint_at=None if next_setpoint is None else next_setpoint[0].isoformat(),
+        )
+        # To make sure HA considers this as new info a datetime is added
+        self.set_state("input_text.chargeschedule",
+                       state="ChargeScheduleAvailable" + self.get_now().isoformat(),
+                       attributes=summary)
+
+    def process_schedule(self, start: datetime, resolution: timedelta, values: List[float],
+                         is_reference: bool = True):
+        """Set timers to send a control signal for each value in the schedule and show the SoC prognosis.
 
-        self.set_charging_timers(handles)
-        self.log(f"{len(handles)} charging timers set.")
+        Parameters:
+            start (datetime): start of the first value
+            resolution (timedelta): duration of each value
+            values (List[float]): (dis)charge power in MW
+            is_reference (bool): False for a correction of the current schedule, that stays the reference, and
+                                 for a restored schedule, that is not tracked
+        """
+        self.schedule_executor.load(start, resolution, values)
+        self.log(f"Schedule loaded, current setpoint: {self.schedule_executor.current_setpoint} MW, "
+                 f"next setpoint: {self.schedule_executor.next_setpoint}.")
 
         # Keep track of the expected SoC by adding each scheduled value to the current SoC
         soc = float(self.get_state("input_number.car_state_of_charge", attribute="state"))
         if int(soc) != int(self.connected_car_soc):
-            # todo: consider calling try_get_new_soc() and then using accumulate(self.connected_car_soc) below instead
+            # todo: consider calling try_get_new_soc() and then using self.connected_car_soc below instead
             self.log(f"input_number.car_state_of_charge ({soc}) is not equal to self.connected_car_soc"
                      f" ({self.connected_car_soc}), consider calling try_get_new_soc()")
 
-        exp_soc_values = list(accumulate([soc] + convert_MW_to_percentage_points(values,
-                                                                                 resolution,
-                                                                                 c.CAR_MAX_CAPACITY_IN_KWH,
-                                                                                 c.CHARGER_PLUS_CAR_ROUNDTRIP_EFFICIENCY)))
-        exp_soc_datetimes = [start + i * resolution for i in range(len(exp_soc_values))]
-        expected_soc_based_on_scheduled_charges = [dict(time=t.isoformat(), soc=round(v, 2)) for v, t in
-                                                   zip(exp_soc_values, exp_soc_datetimes)]
-        self.set_soc_prognosis_in_ui(expected_soc_based_on_scheduled_charges)
+        exp_soc_values = expected_soc_values(values, resolution, soc, c.CAR_MAX_CAPACITY_IN_KWH,
+                                             c.CHARGER_PLUS_CAR_ROUNDTRIP_EFFICIENCY)
+        # The graph only needs the points where the line changes direction.
+        self.set_soc_prognosis_in_ui(prognosis_records(start, resolution, exp_soc_values))
+        if is_reference:
+            self.schedule_reference = dict(start=start, resolution=resolution, values=values, soc=exp_soc_values)
+
+    def track_schedule(self, *args) -> bool:
+        """Compare the actual SoC with the prognosis of the current schedule and correct for the drift.
+
+        Called every slot and on SoC updates. A drift of a percent or more is corrected by re-arming the rest of
+        the schedule with values that return to the prognosis within the CATCH_UP_WINDOW.
+
+        Returns:
+            True if the SoC tracks the schedule (the drift is at most MAX_SOC_DRIFT_IN_PERCENT),
+            False if there is no schedule to track or a new schedule is needed.
+        """
+        reference = self.schedule_reference
+        if reference is None or not self.is_car_connected() or self.connected_car_soc == 0:
+            return False
+        if self.in_boost_to_reach_min_soc or self.get_state("input_select.charge_mode") != "Automatic":
+            return False
+
+        start = reference["start"]
+        resolution = reference["resolution"]
+        values = reference["values"]
+        now = self.get_now()
+        expected_soc = self.get_expected_soc(now)
+        if expected_soc is None:
+            return False
+        index = int((now - start) // resolution)
+        drift = self.connected_car_soc - expected_soc
+        if abs(drift) > self.MAX_SOC_DRIFT_IN_PERCENT:
+            self.log(f"SoC {self.connected_car_soc}% drifted {round(drift, 1)}% from prognosis, a new schedule "
+                     f"is needed.")
+            return False
+
+        # The SoC is reported in whole percents, smaller drifts are not corrected.
+        if abs(drift) >= 1:
+            corrected_values = correct_for_drift(
+                values=values[index:],
+                drift_kwh=drift / 100 * c.CAR_MAX_CAPACITY_IN_KWH,
+                catch_up_slots=int(self.CATCH_UP_WINDOW // resolution),
+                max_charge_power_w=c.CHARGER_MAX_CHARGE_POWER,
+                max_discharge_power_w=c.CHARGER_MAX_DIS_CHARGE_POWER,
+                roundtrip_efficiency=c.CHARGER_PLUS_CAR_ROUNDTRIP_EFFICIENCY,
+                resolution=resolution,
+            )
+            self.log(f"SoC {self.connected_car_soc}% drifted {round(drift, 1)}% from prognosis, correcting it "
+                     f"within {self.CATCH_UP_WINDOW}.")
+            self.process_schedule(start + index * resolution, resolution, corrected_values, is_reference=False)
+        return True
+
+    def send_setpoint(self, value: float):
+        """Send a setpoint of the schedule (in MW) to the charger."""
+        self.send_control_signal(kwargs=dict(charge_rate=value * 1000))  # convert from MW to kW
+
+    def get_expected_soc(self, moment: datetime) -> Optional[float]:
+        """The SoC (in %) at moment according to the prognosis of the current schedule.
+
+        Returns:
+            The SoC in between the prognosis at the start and the end of the slot that contains moment,
+            None if there is no current schedule or moment is outside of it.
+        """
+        reference = self.schedule_reference
+        if reference is None:
+            return None
+        start = reference["start"]
+        resolution = reference["resolution"]
+        index = int((moment - start) // resolution)
+        if index < 0 or index >= len(reference["values"]):
+            return None
+        fraction = ((moment - start) - index * resolution) / resolution
+        soc_at_start = reference["soc"][index]
+        return soc_at_start + (reference["soc"][index + 1] - soc_at_start) * fraction
+
+    def restore_last_schedule(self):
+        """Re-arm the still valid part of the last persisted schedule, e.g. after a restart of the app.
+
+        This gives the charger a setpoint right away instead of after a reliable SoC reading and a new
+        schedule from FlexMeasures. The regular flow (set_next_action) replaces it with a new schedule.
+        """
+        if not self.is_car_connected():
+            self.log("Not restoring last schedule; car is not connected.")
+            return
+
+        mode = self.get_state("input_select.charge_mode")
+        if mode != "Automatic":
+            self.log(f"Not restoring last schedule; charge mode is not 'Automatic' but '{mode}'.")
+            return
+
+        schedule = load_schedule(self.schedule_store_path, self.get_now())
+        if schedule is None:
+            self.log("No valid persisted schedule to restore.")
+            return
+
+        start, resolution, values = schedule
+        self.log(f"Restoring last schedule, {len(values)} values from {start.isoformat()}.")
+        self.set_charger_control("take")
+        # The SoC it was made for is not known, so it is no reference for track_schedule: the first SoC update
+        # leads to a new schedule from FM.
+        self.process_schedule(start, resolution, values, is_reference=False)
+
+    def remove_persisted_schedule(self):
+        """Remove the persisted schedule, it should not be restored for a next connection of a car."""
+        try:
+            remove_schedule(self.schedule_store_path)
+        except OSError as e:
+            self.log(f"Could not remove persisted schedule '{self.schedule_store_path}': {e}.")
 
     def set_soc_prognosis_in_ui(self, records: Optional[dict] = None):
         """Write or remove SoC prognosis in graph via HA entity input_text.soc_prognosis
@@ -587,11 +781,11 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
         self.log("restart_set_next_action_time_based")
         self.set_next_action()
 
-    def set_next_action(self):
+    def set_next_action(self, soc_changed: bool = False):
         """The function determines what action should be taken next based on current SoC, Charge_mode, Charger_state
 
         This function is meant to be called upon:
-        - SOC updates
+        - SOC updates (then soc_changed is True)
         - calendar updates
         - charger state updates
         - every 15 minutes if none of the above
@@ -619,9 +813,12 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
         if (self.back_to_max_soc is None) and (self.connected_car_soc_kwh > c.CAR_MAX_SOC_IN_KWH):
             self.back_to_max_soc = time_round((self.get_now() + timedelta(hours=c.ALLOWED_DURATION_ABOVE_MAX_SOC)), self.MIN_RESOLUTION)
             self.log(f"SoC above max-soc, aiming to schedule with target {c.CAR_MAX_SOC_IN_PERCENT}% at {self.back_to_max_soc}.")
+            # The current schedule does not take this target into account.
+            soc_changed = False
         elif (self.back_to_max_soc is not None) and self.connected_car_soc_kwh <= c.CAR_MAX_SOC_IN_KWH:
             self.back_to_max_soc = None
             self.log(f"SoC was below max-soc, has been restored.")
+            soc_changed = False
 
         charge_mode = self.get_state("input_select.charge_mode", attribute="state")
         self.log(f"Setting next action based on charge_mode '{charge_mode}'.")
@@ -680,7 +877,7 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
             # Not checking for > max charge (97%) because we could also want to discharge based on schedule
 
             # Check for discharging below minimum done in the function for setting the (dis)charge_current.
-            self.decide_whether_to_ask_for_new_schedule()
+            self.decide_whether_to_ask_for_new_schedule(soc_changed=soc_changed)
 
         elif charge_mode == "Max boost now":
             self.set_charger_control("take")
@@ -737,23 +934,3 @@ class V2Gliberty(hass.Hass, WallboxModbusMixin):
         else:
             self.log(f"Successfully set charge_mode in UI to '{setting}'.")
 
-
-def convert_MW_to_percentage_points(
-        values_in_MW,
-        resolution: timedelta,
-        max_soc_in_kWh: float,
-        round_trip_efficiency: float,
-):
-    """
-    For example, if a 62 kWh battery produces at 0.00575 MW for a period of 15 minutes,
-    its SoC increases by just over 2.3%.
-    """
-    e = round_trip_efficiency ** 0.5
-    scalar = resolution / timedelta(hours=1) * 1000 * 100 / max_soc_in_kWh
-    lst = []
-    for v in values_in_MW:
-        if v >= 0:
-            lst.append(v * scalar * e)
-        else:
-            lst.append(v * scalar / e)
-    return lst
@@ -406,7 +406,7 @@ class WallboxModbusMixin:
         res = self.process_soc(reported_soc)
         if not res:
             return
-        self.set_next_action()
+        self.set_next_action(soc_changed=True)
         return
 
     def process_soc(self, reported_soc: str) -> bool:
@@ -519,6 +519,7 @@ class WallboxModbusMixin:
 
             # Cancel current scheduling timers
             self.cancel_charging_timers()
+            self.remove_persisted_schedule()
 
             # This might seem strange but sometimes the charger starts charging when
             # reconnected even though it has not received an instruction to do so.